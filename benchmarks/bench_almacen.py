@@ -0,0 +1,101 @@
+"""Micro-benchmarks de las funciones de almacenamiento y de alertas, con ambos backends.
+
+Uso:
+    python benchmarks/bench_almacen.py
+    python benchmarks/bench_almacen.py --cuentas 50000 --backends json --repeticiones 5
+
+Genera los datos en un directorio temporal (o usa los de --datos, creados con
+generar_datos.py) y reporta el mejor tiempo por operación en microsegundos.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+from datetime import datetime
+
+from comun import medir, sc
+from generar_datos import escribir_datos, generar_cuentas, generar_usuarios
+
+
+def crear_almacen(backend, directorio):
+    archivo = os.path.join(directorio, 'archivo_cuentas')
+    if backend == 'sqlite':
+        return sc.AlmacenSQLite(os.path.join(directorio, 'cuentas.db'), normalizar=sc.normalizar_cuentas, ruta_archivo=archivo)
+    return sc.AlmacenJSON(
+        os.path.join(directorio, 'cuentas.json'), os.path.join(directorio, 'cuentas.journal'),
+        os.path.join(directorio, 'usuarios.json'), normalizar=sc.normalizar_cuentas, ruta_archivo=archivo
+    )
+
+
+def operaciones(backend, directorio, azar):
+    """(nombre, función, llamadas por medición) de cada operación a medir"""
+    almacen = crear_almacen(backend, directorio)
+    ids = [c['id'] for c in almacen.cargar_cuentas()]
+    en_revision = [c for c in almacen.cargar_cuentas() if c['estado_actual'] in sc.ESTADOS_EN_REVISION]
+    ahora = datetime.now().strftime(sc.FORMATO_FECHA)
+    usuarios = almacen.cargar_usuarios()
+    contratista = next(u for u in usuarios if u['rol'] == 'contratista')
+    usuario_epb = next(u for u in usuarios if u['rol'] == 'epb')
+
+    def guardar_una():
+        cuenta = almacen.obtener_cuenta(azar.choice(ids))
+        cuenta['descripcion'] = f'Editada {azar.random()}'
+        almacen.guardar_cuenta(cuenta)
+
+    def insertar_lote():
+        datos = {'numero_contrato': 'CT-B', 'numero_acta': 'AC-B', 'valor': 1000.0, 'descripcion': 'bench'}
+        almacen.confirmar(nuevas=[sc.construir_cuenta_radicada(contratista, datos, usuario_epb) for _ in range(100)])
+
+    return [
+        ('cargar_cuentas (en frío)', lambda: crear_almacen(backend, directorio).cargar_cuentas(), 1),
+        ('cargar_cuentas (en caché)', almacen.cargar_cuentas, 100),
+        ('obtener_cuenta', lambda: almacen.obtener_cuenta(azar.choice(ids)), 1000),
+        ('consultar_cuentas (página)', lambda: almacen.consultar_cuentas({}, 'fecha', True, 20), 200),
+        ('consultar_cuentas (estado)', lambda: almacen.consultar_cuentas({'estado': 'revision_epb'}, 'valor', False, 20), 200),
+        ('conteo_estados', almacen.conteo_estados, 1000),
+        ('carga_responsables', almacen.carga_responsables, 1000),
+        ('obtener + guardar_cuenta', guardar_una, 50),
+        ('confirmar (100 nuevas)', insertar_lote, 1),
+        ('marcar_vencidas', lambda: almacen.marcar_vencidas(ahora), 10),
+        ('verificar_alerta_3_dias (todas)', lambda: [sc.verificar_alerta_3_dias(c) for c in en_revision], 1),
+        ('alertas_plazo (todas)', lambda: [sc.alertas_plazo(c, ahora) for c in en_revision], 1),
+        ('guardar_cuentas (reescritura)', lambda: almacen.guardar_cuentas(almacen.cargar_cuentas()), 1),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cuentas', type=int, default=10_000)
+    parser.add_argument('--datos', default=None, help='Directorio con cuentas.json y usuarios.json ya generados')
+    parser.add_argument('--backends', nargs='+', choices=['json', 'sqlite'], default=['json', 'sqlite'])
+    parser.add_argument('--repeticiones', type=int, default=3)
+    args = parser.parse_args()
+
+    resultados = {}
+    with tempfile.TemporaryDirectory() as directorio:
+        if args.datos:
+            for nombre in ('cuentas.json', 'usuarios.json'):
+                shutil.copy(os.path.join(args.datos, nombre), directorio)
+        else:
+            usuarios = generar_usuarios(contratistas=200, revisores_por_rol=5)
+            escribir_datos(directorio, generar_cuentas(args.cuentas, usuarios), usuarios)
+        if 'sqlite' in args.backends:
+            sc.migrar_json_a_sqlite(os.path.join(directorio, 'cuentas.db'), *(os.path.join(directorio, n) for n in
+                                    ('cuentas.json', 'cuentas.journal', 'usuarios.json', 'archivo_cuentas')))
+        total = crear_almacen('json', directorio).contar_cuentas()
+
+        for backend in args.backends:
+            azar = random.Random(7)
+            for nombre, funcion, llamadas in operaciones(backend, directorio, azar):
+                segundos = medir(lambda: [funcion() for _ in range(llamadas)], args.repeticiones)
+                resultados.setdefault(nombre, {})[backend] = segundos / llamadas * 1e6
+
+    print(f"\n{total} cuentas (µs por operación, mejor de {args.repeticiones})")
+    print(f"{'operación':<34}" + ''.join(f'{b:>14}' for b in args.backends))
+    for nombre, tiempos in resultados.items():
+        print(f'{nombre:<34}' + ''.join(f'{tiempos[b]:>14,.1f}' for b in args.backends))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Compara el guardado y la carga de la instantánea de cuentas con cada codec disponible.
+
+Uso:
+    python benchmarks/bench_codecs.py
+    python benchmarks/bench_codecs.py --cuentas 10000 100000 --repeticiones 5
+
+Mide codificar + escribir (escribir_atomico, con fsync) y leer + decodificar
+(decodificar_datos), más el tamaño del archivo. 'json-legible' es el formato
+anterior (indent=2), como referencia.
+"""
+import argparse
+import os
+import tempfile
+
+from comun import medir, sc
+from generar_datos import generar_cuentas, generar_usuarios
+
+
+def comparar(cuentas, repeticiones, directorio):
+    codecs = {'json-legible': sc.CodecJSON(sangria=2)}
+    codecs.update((nombre, sc.crear_codec(nombre)) for nombre in sc.codecs_disponibles())
+    ruta = os.path.join(directorio, 'cuentas.bench')
+
+    print(f"\n{len(cuentas)} cuentas")
+    print(f"{'codec':<14}{'guardar (s)':>13}{'cargar (s)':>13}{'tamaño (MB)':>14}")
+    for nombre, codec in codecs.items():
+        guardar = medir(lambda: sc.escribir_atomico(ruta, codec.codificar(cuentas)), repeticiones)
+
+        def cargar():
+            with open(ruta, 'rb') as f:
+                return sc.decodificar_datos(f.read())
+
+        assert len(cargar()) == len(cuentas)
+        cargar_s = medir(cargar, repeticiones)
+        print(f"{nombre:<14}{guardar:>13.3f}{cargar_s:>13.3f}{os.path.getsize(ruta) / 1e6:>14.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cuentas', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--repeticiones', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"Codecs disponibles: {', '.join(sc.codecs_disponibles())}")
+    usuarios = generar_usuarios(contratistas=200, revisores_por_rol=5)
+    with tempfile.TemporaryDirectory() as directorio:
+        for total in args.cuentas:
+            comparar(generar_cuentas(total, usuarios), args.repeticiones, directorio)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Prueba de carga con el cliente de pruebas de Flask: latencias p50/p95/p99 por ruta.
+
+Uso:
+    python benchmarks/carga_http.py
+    python benchmarks/carga_http.py --cuentas 20000 --cadenas 300 --hilos 8 --backend sqlite
+
+Cada cadena reproduce el recorrido de una cuenta: el contratista inicia sesión, radica
+y revisa su lista; EPB, supervisor y general la aprueban y hacienda la paga, cada uno
+consultando además su dashboard, la lista de cuentas y el detalle. Los revisores
+mantienen su sesión durante toda la prueba; cada hilo usa su propio contratista para
+identificar sin ambigüedad la cuenta que radicó.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from comun import percentil, sc
+from generar_datos import escribir_datos, generar_cuentas, generar_usuarios
+
+PASOS_REVISION = [('epb', 'aprobar'), ('supervisor', 'aprobar'), ('general', 'aprobar'), ('hacienda', 'pagar')]
+
+
+class Registro:
+    """Latencias por ruta (patrón, no URL concreta) acumuladas por todos los hilos"""
+
+    def __init__(self):
+        self.tiempos = defaultdict(list)
+        self.errores = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def pedir(self, cliente, metodo, url, ruta, **kwargs):
+        inicio = time.perf_counter()
+        respuesta = cliente.open(url, method=metodo, **kwargs)
+        respuesta.get_data()  # las vistas en streaming se generan al consumir el cuerpo
+        duracion = time.perf_counter() - inicio
+        fallo = respuesta.status_code >= 400 or respuesta.headers.get('Location', '').endswith('/login')
+        with self._lock:
+            self.tiempos[f'{metodo} {ruta}'].append(duracion)
+            if fallo:
+                self.errores[f'{metodo} {ruta}'] += 1
+        return respuesta
+
+
+def iniciar_sesion(registro, cliente, username):
+    respuesta = registro.pedir(cliente, 'POST', '/login', '/login', data={'username': username, 'password': '123'})
+    if not respuesta.headers.get('Location', '').endswith('/dashboard'):
+        raise RuntimeError(f'No se pudo iniciar sesión como {username}')
+
+
+def ejecutar_hilo(app, registro, numero_hilo, cadenas):
+    contratista = f'contratista{numero_hilo + 1}'
+    revisores = {}
+    for rol, _ in PASOS_REVISION:
+        revisores[rol] = app.test_client()
+        iniciar_sesion(registro, revisores[rol], f'{rol}{numero_hilo % 5 + 1}')
+    contratista_id = next(u['id'] for u in sc.cargar_usuarios() if u['username'] == contratista)
+
+    for i in range(cadenas):
+        cliente = app.test_client()
+        iniciar_sesion(registro, cliente, contratista)
+        registro.pedir(cliente, 'POST', '/radicar', '/radicar', data={
+            'numero_contrato': f'CT-{numero_hilo}-{i}', 'numero_acta': f'AC-{i}', 'valor': '1500000', 'descripcion': 'Carga'
+        })
+        registro.pedir(cliente, 'GET', '/cuentas', '/cuentas')
+        cuentas, _ = sc.consultar_cuentas({'contratista_id': contratista_id}, 'fecha', True, 1)
+        cuenta_id = cuentas[0]['id']
+
+        for rol, accion in PASOS_REVISION:
+            revisor = revisores[rol]
+            registro.pedir(revisor, 'GET', '/dashboard', '/dashboard')
+            registro.pedir(revisor, 'GET', '/cuentas?estado=revision_epb', '/cuentas?estado')
+            registro.pedir(revisor, 'GET', f'/cuenta/{cuenta_id}', '/cuenta/<id>')
+            registro.pedir(revisor, 'GET', f'/accion-cuenta/{cuenta_id}/{accion}', f'/accion-cuenta/<id>/{accion}')
+
+
+def preparar_datos(args, directorio):
+    if args.datos:
+        for nombre in ('cuentas.json', 'usuarios.json'):
+            shutil.copy(os.path.join(args.datos, nombre), directorio)
+    else:
+        usuarios = generar_usuarios(contratistas=max(200, args.hilos), revisores_por_rol=5)
+        escribir_datos(directorio, generar_cuentas(args.cuentas, usuarios), usuarios)
+    os.chdir(directorio)
+    sc.app.config.update(ALMACEN_BACKEND=args.backend, INTERVALO_ALERTAS=0, TESTING=True)
+    if args.backend == 'sqlite':
+        sc.migrar_json_a_sqlite(sc.app.config['ALMACEN_SQLITE'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cuentas', type=int, default=5_000, help='Cuentas existentes antes de la prueba')
+    parser.add_argument('--datos', default=None, help='Directorio con cuentas.json y usuarios.json ya generados')
+    parser.add_argument('--cadenas', type=int, default=100, help='Cadenas radicar → pagar por hilo')
+    parser.add_argument('--hilos', type=int, default=1)
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    args = parser.parse_args()
+
+    directorio_original = os.getcwd()
+    with tempfile.TemporaryDirectory() as directorio:
+        preparar_datos(args, directorio)
+        registro = Registro()
+        hilos = [threading.Thread(target=ejecutar_hilo, args=(sc.app, registro, n, args.cadenas)) for n in range(args.hilos)]
+        inicio = time.perf_counter()
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        duracion = time.perf_counter() - inicio
+        os.chdir(directorio_original)
+
+    total = sum(len(t) for t in registro.tiempos.values())
+    print(f"\n{args.backend}: {args.hilos} hilos × {args.cadenas} cadenas, {total} peticiones en {duracion:.1f} s "
+          f"({total / duracion:,.0f} peticiones/s)")
+    print(f"{'ruta':<34}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'máx ms':>10}{'errores':>9}")
+    for ruta, tiempos in sorted(registro.tiempos.items()):
+        ordenados = sorted(tiempos)
+        print(f'{ruta:<34}{len(ordenados):>7}' + ''.join(f'{percentil(ordenados, p) * 1e3:>10.1f}' for p in (50, 95, 99))
+              + f'{ordenados[-1] * 1e3:>10.1f}{registro.errores[ruta]:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Genera cuentas.json y usuarios.json sintéticos con la forma de los datos reales.
+
+Uso:
+    python benchmarks/generar_datos.py --destino datos_bench --cuentas 100000
+    python benchmarks/generar_datos.py --destino datos_bench --cuentas 20000 --profundidad 3 \\
+        --distribucion revision_epb=0.4,pagado=0.4,devuelto=0.2
+
+Las cuentas siguen el flujo de la aplicación (mismas claves de timestamps, historial,
+responsables y campos derivados que dejan /radicar y las acciones). --profundidad es el
+máximo de rondas de devolución y nueva radicación antes del estado final, para variar
+la longitud del historial. La contraseña de todos los usuarios es '123'.
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+from comun import sc
+
+# Estados finales por defecto: la mayoría de las cuentas ya se pagaron
+DISTRIBUCION_DEFECTO = {
+    'revision_epb': 0.12,
+    'revision_supervisor': 0.08,
+    'revision_general': 0.06,
+    'revision_hacienda': 0.06,
+    'pagado': 0.58,
+    'devuelto': 0.10
+}
+DEPENDENCIAS = {'epb': 'EPB', 'supervisor': 'Calidad', 'general': 'Secretaría General', 'hacienda': 'Hacienda'}
+ROLES_REVISORES = ('epb', 'supervisor', 'general', 'hacienda')
+ROL_REVISOR = {f'revision_{rol}': rol for rol in ROLES_REVISORES}
+
+
+def leer_distribucion(texto):
+    """'estado=peso,...' → {estado: peso}; los pesos no necesitan sumar 1"""
+    distribucion = {}
+    for parte in filter(None, (p.strip() for p in texto.split(','))):
+        estado, _, peso = parte.partition('=')
+        if estado not in DISTRIBUCION_DEFECTO:
+            raise argparse.ArgumentTypeError(f'Estado final no válido: {estado}')
+        distribucion[estado] = float(peso)
+    return distribucion
+
+
+def generar_usuarios(contratistas, revisores_por_rol):
+    """Contratistas contratista1..N y revisores epb1, supervisor1... por cada rol"""
+    creado = datetime.now().strftime(sc.FORMATO_FECHA)
+    usuarios = []
+    for i in range(1, contratistas + 1):
+        usuarios.append({'username': f'contratista{i}', 'rol': 'contratista', 'nombre': f'Contratista {i} S.A.S.', 'dependencia': ''})
+    for rol in ROLES_REVISORES:
+        for i in range(1, revisores_por_rol + 1):
+            usuarios.append({'username': f'{rol}{i}', 'rol': rol, 'nombre': f'{rol.title()} {i}', 'dependencia': DEPENDENCIAS[rol]})
+    for usuario_id, usuario in enumerate(usuarios, start=1):
+        usuario.update({'id': usuario_id, 'password': '123', 'activo': True, 'fecha_creacion': creado})
+    return usuarios
+
+
+def generar_cuentas(total, usuarios, distribucion=None, profundidad=0, dias=365, semilla=42):
+    """Cuentas completas (con id, número y campos derivados) que terminan en los estados de la distribución"""
+    azar = random.Random(semilla)
+    distribucion = distribucion or DISTRIBUCION_DEFECTO
+    estados_finales, pesos = list(distribucion), list(distribucion.values())
+    por_rol = {}
+    for usuario in usuarios:
+        por_rol.setdefault(usuario['rol'], []).append(usuario)
+    ahora = datetime.now()
+
+    cuentas = []
+    for cuenta_id in range(1, total + 1):
+        final = azar.choices(estados_finales, pesos)[0]
+        contratista = azar.choice(por_rol['contratista'])
+        marcas = iter(_marcas(azar, ahora, dias, pasos=12 + 6 * profundidad))
+        radicacion = next(marcas)
+        cuenta = sc.construir_cuenta_radicada(
+            contratista,
+            {
+                'numero_contrato': f'CT-{azar.randint(1000, 9999)}',
+                'numero_acta': f'AC-{azar.randint(1, 99)}',
+                'valor': round(azar.uniform(1e5, 5e8), 2),
+                'descripcion': 'Servicios profesionales del periodo'
+            },
+            azar.choice(por_rol['epb']),
+            radicacion.strftime(sc.FORMATO_FECHA)
+        )
+        for _ in range(azar.randint(0, profundidad)):
+            _avanzar(cuenta, azar, por_rol, azar.choice(sc.ESTADOS_EN_REVISION), marcas)
+            _devolver(cuenta, azar, por_rol, next(marcas))
+            _reradicar(cuenta, azar, por_rol, next(marcas))
+        if final == 'devuelto':
+            _avanzar(cuenta, azar, por_rol, azar.choice(sc.ESTADOS_EN_REVISION), marcas)
+            _devolver(cuenta, azar, por_rol, next(marcas))
+        else:
+            _avanzar(cuenta, azar, por_rol, final, marcas)
+
+        cuenta['numero_cuenta'] = sc.generar_numero_cuenta(cuenta_id, radicacion)
+        sc.asignar_identificacion(cuenta, cuenta_id)
+        cuenta['version'] = len(cuenta['historial']) - 1
+        sc.normalizar_cuentas([cuenta])
+        sc.preparar_cuenta(cuenta, ahora.strftime(sc.FORMATO_FECHA))
+        cuentas.append(cuenta)
+    return cuentas
+
+
+def _marcas(azar, ahora, dias, pasos):
+    """Instantes crecientes para los movimientos de una cuenta, sin pasar de ahora"""
+    duraciones = [timedelta(hours=azar.uniform(1, 120)) for _ in range(pasos)]
+    inicio = ahora - timedelta(days=azar.uniform(0, dias)) - sum(duraciones, timedelta())
+    for duracion in duraciones:
+        yield inicio
+        inicio += duracion
+
+
+def _avanzar(cuenta, azar, por_rol, hasta, marcas):
+    """Aprueba etapa por etapa (y paga si hasta == 'pagado') como lo hacen las acciones"""
+    while cuenta['estado_actual'] != hasta:
+        estado = cuenta['estado_actual']
+        momento = next(marcas).strftime(sc.FORMATO_FECHA)
+        revisor = azar.choice(por_rol[ROL_REVISOR[estado]])
+        if estado == 'revision_hacienda':
+            sc.aplicar_pago(cuenta, revisor, momento)
+        else:
+            siguiente = azar.choice(por_rol[sc.ROL_RESPONSABLE_POR_ESTADO[estado]])
+            sc.aplicar_aprobacion(cuenta, revisor, siguiente, momento)
+
+
+def _devolver(cuenta, azar, por_rol, momento):
+    revisor = azar.choice(por_rol[ROL_REVISOR[cuenta['estado_actual']]])
+    contratista = {'id': cuenta['contratista_id'], 'nombre': cuenta['contratista_nombre']}
+    tipo = azar.choice(['documentacion', 'calculos', 'informacion', 'procedimiento'])
+    sc.aplicar_devolucion(cuenta, revisor, contratista, 'Revisar soportes y valores del acta', tipo,
+                          momento.strftime(sc.FORMATO_FECHA))
+
+
+def _reradicar(cuenta, azar, por_rol, momento):
+    """Nueva radicación tras una devolución: vuelve a revisión EPB con un nuevo responsable"""
+    marca = momento.strftime(sc.FORMATO_FECHA)
+    usuario_epb = azar.choice(por_rol['epb'])
+    cuenta['estado_actual'] = 'revision_epb'
+    cuenta['responsable_actual'] = usuario_epb['id']
+    cuenta['responsable_nombre'] = usuario_epb['nombre']
+    cuenta['timestamps']['inicio_revision_epb'] = marca
+    cuenta['historial'].append({
+        'estado': 'revision_epb',
+        'usuario': cuenta['contratista_nombre'],
+        'timestamp': marca,
+        'accion': 'correccion',
+        'comentario': 'Cuenta corregida y radicada nuevamente',
+        'responsable_asignado': usuario_epb['nombre'],
+        'responsable_id': usuario_epb['id']
+    })
+
+
+def escribir_datos(destino, cuentas, usuarios, codec='json'):
+    """cuentas.json con el codec pedido (sin diario) y usuarios.json legible"""
+    os.makedirs(destino, exist_ok=True)
+    sc.escribir_atomico(os.path.join(destino, 'cuentas.json'), sc.crear_codec(codec).codificar(cuentas))
+    sc.escribir_atomico(os.path.join(destino, 'usuarios.json'), sc.CodecJSON(sangria=2).codificar(usuarios))
+    diario = os.path.join(destino, 'cuentas.journal')
+    if os.path.exists(diario):
+        os.remove(diario)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--destino', default='datos_bench', help='Directorio de salida')
+    parser.add_argument('--cuentas', type=int, default=10_000)
+    parser.add_argument('--contratistas', type=int, default=200)
+    parser.add_argument('--revisores', type=int, default=5, help='Usuarios por rol de revisión')
+    parser.add_argument('--profundidad', type=int, default=1, help='Máximo de rondas de devolución por cuenta')
+    parser.add_argument('--distribucion', type=leer_distribucion, default=None, help='estado=peso,... del estado final')
+    parser.add_argument('--dias', type=int, default=365, help='Antigüedad máxima de las radicaciones')
+    parser.add_argument('--codec', choices=['json', 'orjson', 'msgpack'], default='json')
+    parser.add_argument('--semilla', type=int, default=42)
+    args = parser.parse_args()
+
+    usuarios = generar_usuarios(args.contratistas, args.revisores)
+    cuentas = generar_cuentas(args.cuentas, usuarios, args.distribucion, args.profundidad, args.dias, args.semilla)
+    escribir_datos(args.destino, cuentas, usuarios, args.codec)
+    print(f"✅ {len(cuentas)} cuentas y {len(usuarios)} usuarios en {args.destino}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,88 @@
-from flask import Flask, render_template, request, redirect, session, flash, jsonify
-from datetime import datetime, timedelta
+from flask import Flask, Response, render_template, stream_template, stream_with_context, request, redirect, session, flash, jsonify, g, send_from_directory
+from datetime import date, datetime, timedelta
+import atexit
+import base64
+import bisect
+import copy
+import cProfile
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import heapq
 import json
+import math
 import os
-from functools import wraps
+import queue
+import re
+import smtplib
+import sqlite3
+import sys
+import itertools
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import Counter, deque
+from contextlib import contextmanager
+from email.message import EmailMessage
+from functools import lru_cache, wraps
+
+import click
+from werkzeug.security import check_password_hash, generate_password_hash
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+try:
+    import openpyxl
+except ImportError:  # la exportación a Excel es opcional
+    openpyxl = None
+
+try:
+    import orjson
+except ImportError:  # codificador JSON rápido opcional
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # instantánea binaria opcional
+    msgpack = None
 
 app = Flask(__name__)
 app.secret_key = 'clave_secreta_muy_segura_para_produccion_cambiar'
+app.config['ALMACEN_BACKEND'] = os.environ.get('ALMACEN_BACKEND', 'json')  # 'json' o 'sqlite'
+app.config['ALMACEN_SQLITE'] = os.environ.get('ALMACEN_SQLITE', 'cuentas.db')
+app.config['INTERVALO_ALERTAS'] = int(os.environ.get('INTERVALO_ALERTAS', 60))  # segundos; 0 desactiva el motor
+app.config['FESTIVOS_ADICIONALES'] = os.environ.get('FESTIVOS_ADICIONALES', '')  # 'AAAA-MM-DD,...' no previstos por la ley
+app.config['ARCHIVO_CUENTAS'] = os.environ.get('ARCHIVO_CUENTAS', 'archivo_cuentas')  # directorio de cuentas pagadas archivadas
+app.config['DIAS_PARA_ARCHIVAR'] = int(os.environ.get('DIAS_PARA_ARCHIVAR', 90))  # días desde el pago
+# Formato de cuentas.json y del archivo: 'auto' (orjson si está instalado, si no JSON compacto),
+# 'json', 'orjson' o 'msgpack'. Los nombres de archivo no cambian: el formato se detecta al leer.
+app.config['CODEC_CUENTAS'] = os.environ.get('CODEC_CUENTAS', 'auto')
+app.config['DIRECTORIO_METRICAS'] = os.environ.get('DIRECTORIO_METRICAS', 'metricas')  # un archivo por worker
+app.config['METRICAS_TOKEN'] = os.environ.get('METRICAS_TOKEN', '')  # si se define, /metrics exige 'Bearer <token>'
+app.config['PERFILADO_DIRECTORIO'] = os.environ.get('PERFILADO_DIRECTORIO', 'perfiles')
+app.config['PERFILADO_INTERVALO'] = int(os.environ.get('PERFILADO_INTERVALO', 30))  # segundos entre perfiles por worker; 0 desactiva
+app.config['PERFILADO_MAXIMO'] = int(os.environ.get('PERFILADO_MAXIMO', 50))  # perfiles conservados
+# Usuarios (username, separados por comas) que pueden perfilar y descargar perfiles; vacío lo desactiva
+app.config['PERFILADO_USUARIOS'] = os.environ.get('PERFILADO_USUARIOS', '')
+app.config['ARCHIVO_EVENTOS'] = os.environ.get('ARCHIVO_EVENTOS', 'eventos.log')  # bus de /eventos entre workers
+# Conexiones /eventos abiertas a la vez en cada worker; cada una ocupa un hilo, así que debe
+# quedar por debajo de --threads para que el resto de las peticiones siga teniendo hilos
+app.config['EVENTOS_MAXIMO_POR_WORKER'] = int(os.environ.get('EVENTOS_MAXIMO_POR_WORKER', 8))
+# Correo de las notificaciones; sin SMTP_SERVIDOR no se generan. Para probar en local:
+# python -m aiosmtpd -n -l localhost:1025 y SMTP_SERVIDOR=localhost SMTP_PUERTO=1025
+app.config['SMTP_SERVIDOR'] = os.environ.get('SMTP_SERVIDOR', '')
+app.config['SMTP_PUERTO'] = int(os.environ.get('SMTP_PUERTO', 25))
+app.config['SMTP_USUARIO'] = os.environ.get('SMTP_USUARIO', '')
+app.config['SMTP_PASSWORD'] = os.environ.get('SMTP_PASSWORD', '')
+app.config['SMTP_STARTTLS'] = os.environ.get('SMTP_STARTTLS', '') == '1'
+app.config['SMTP_REMITENTE'] = os.environ.get('SMTP_REMITENTE', 'seguimiento@localhost')
+app.config['INTERVALO_NOTIFICACIONES'] = int(os.environ.get('INTERVALO_NOTIFICACIONES', 30))  # segundos; 0 desactiva el envío de fondo
 
 # ==================== CONFIGURACIÓN ====================
 ROLES_PERMISOS = {
@@ -46,21 +123,117 @@ ESTADOS_FLUJO = [
     'devuelto'            # Devuelto para correcciones
 ]
 
+# Estados en los que la cuenta espera a un revisor (cuentan como carga de su responsable)
+ESTADOS_EN_REVISION = ('revision_epb', 'revision_supervisor', 'revision_general', 'revision_hacienda')
+
+# Colores y títulos de presentación (compartidos por todas las plantillas)
+COLORES_ESTADO = {
+    'radicado': '#ffc107',
+    'revision_epb': '#17a2b8',
+    'revision_supervisor': '#fd7e14',
+    'revision_general': '#20c997',
+    'revision_hacienda': '#6f42c1',
+    'pagado': '#28a745',
+    'devuelto': '#dc3545'
+}
+
+COLORES_ROL = {
+    'contratista': '#6c757d',
+    'epb': '#007bff',
+    'supervisor': '#fd7e14',
+    'general': '#20c997',
+    'hacienda': '#6f42c1'
+}
+
+TITULOS_ESTADO = {
+    'radicado': 'Radicado',
+    'revision_epb': 'Revisión EPB',
+    'revision_supervisor': 'Revisión Supervisor',
+    'revision_general': 'Revisión General',
+    'revision_hacienda': 'Revisión Hacienda',
+    'pagado': 'Pagado',
+    'devuelto': 'Devuelto'
+}
+
+# Permisos de cada rol como conjunto, para consultarlos sin recorrer listas
+PERMISOS_POR_ROL = {rol: frozenset(datos['permisos']) for rol, datos in ROLES_PERMISOS.items()}
+
+# ==================== CONTRASEÑAS ====================
+# Hashes con sal de werkzeug ('scrypt:...$sal$hash'); las contraseñas guardadas en texto
+# plano por versiones anteriores se aceptan una vez y se reemplazan por su hash al iniciar sesión
+PREFIJOS_HASH = ('scrypt:', 'pbkdf2:')
+
+def cifrar_password(password):
+    return generate_password_hash(password)
+
+def password_cifrada(guardada):
+    return guardada.startswith(PREFIJOS_HASH)
+
+def verificar_password(usuario, password):
+    guardada = usuario.get('password') or ''
+    if password_cifrada(guardada):
+        return check_password_hash(guardada, password)
+    return hmac.compare_digest(guardada.encode(), password.encode())
+
+def actualizar_password(usuario_id, password):
+    """Reemplaza la contraseña del usuario por su hash (sin alterar los usuarios en caché)"""
+    usuarios = cargar_usuarios()
+    for i, usuario in enumerate(usuarios):
+        if usuario['id'] == usuario_id:
+            usuarios[i] = {**usuario, 'password': cifrar_password(password)}
+            guardar_usuarios(usuarios)
+            return
+
+# ==================== USUARIO DE LA PETICIÓN ====================
+@app.before_request
+def cargar_usuario_actual():
+    """Deja en g.usuario el usuario de la sesión, leído una vez por petición del directorio
+    en caché. Un usuario desactivado o eliminado pierde la sesión en su siguiente petición."""
+    g.usuario = None
+    usuario_id = session.get('user_id')
+    if usuario_id is None:
+        return
+    usuario = obtener_directorio().obtener(usuario_id)
+    if not usuario or not usuario.get('activo', True):
+        session.clear()
+        flash('Su usuario no está activo', 'error')
+        return
+    g.usuario = {
+        'id': usuario['id'],
+        'username': usuario['username'],
+        'rol': usuario['rol'],
+        'nombre': usuario['nombre'],
+        'dependencia': usuario.get('dependencia'),
+        'permisos': PERMISOS_POR_ROL.get(usuario['rol'], frozenset())
+    }
+
+def tiene_permiso(permiso):
+    return g.get('usuario') is not None and permiso in g.usuario['permisos']
+
 # ==================== DECORADORES DE SEGURIDAD ====================
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if g.get('usuario') is None:
             flash('Debe iniciar sesión para acceder a esta página', 'error')
             return redirect('/login')
         return f(*args, **kwargs)
     return decorated_function
 
+def api_login_required(f):
+    """Como login_required, pero responde 401 en JSON en lugar de redirigir al login"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.get('usuario') is None:
+            return jsonify({'error': 'Debe iniciar sesión'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
 def rol_required(rol):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if 'user_rol' not in session or session['user_rol'] != rol:
+            if g.get('usuario') is None or g.usuario['rol'] != rol:
                 flash(f'No tiene permisos de {rol} para acceder a esta página', 'error')
                 return redirect('/dashboard')
             return f(*args, **kwargs)
@@ -71,39 +244,2349 @@ def permiso_required(permiso):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            user_rol = session.get('user_rol')
-            if not user_rol or permiso not in ROLES_PERMISOS.get(user_rol, {}).get('permisos', []):
+            if not tiene_permiso(permiso):
                 flash(f'No tiene permiso para: {permiso}', 'error')
                 return redirect('/dashboard')
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
+# ==================== PLANTILLAS ====================
+# Las vistas de listas se renderizan con plantillas de templates/ que Jinja compila una
+# sola vez y guarda en su caché; stream_template envía el HTML por partes a medida que se
+# recorren las cuentas en lugar de armar una sola cadena con toda la página.
+app.jinja_env.globals.update(
+    colores_estado=COLORES_ESTADO,
+    colores_rol=COLORES_ROL,
+    titulos_estado=TITULOS_ESTADO,
+    estados=ESTADOS_FLUJO
+)
+
+@app.template_filter('moneda')
+def formato_moneda(valor):
+    """Valor en pesos sin decimales: 1234567.8 -> $1,234,568"""
+    return f'${valor:,.0f}'
+
+@app.template_filter('estado_legible')
+def estado_legible(estado):
+    return estado.replace('_', ' ').title()
+
+def precompilar_plantillas():
+    """Compilar las plantillas al arrancar para que la primera petición no pague el costo"""
+    for nombre in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(nombre)
+
+# ==================== MÉTRICAS ====================
+# Límites superiores (segundos) de las cubetas de los histogramas de duración
+CUBETAS_DURACION = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+DEFINICIONES_METRICAS = {
+    'seguimiento_peticiones_total': ('counter', 'Peticiones atendidas por ruta, método y código de estado'),
+    'seguimiento_peticion_segundos': ('histogram', 'Duración de las peticiones por ruta y método'),
+    'seguimiento_almacen_segundos': ('histogram', 'Duración de las funciones de acceso a cuentas y usuarios'),
+    'seguimiento_archivo_segundos': ('histogram', 'Duración de las lecturas y escrituras de archivos de datos'),
+    'seguimiento_archivo_bytes_total': ('counter', 'Bytes leídos y escritos en archivos de datos'),
+    'seguimiento_transiciones_total': ('counter', 'Cambios de estado de cuentas por acción y rol'),
+    'seguimiento_notificaciones_total': ('counter', 'Notificaciones por correo procesadas por resultado')
+}
+
+def etiquetas_prometheus(etiquetas):
+    if not etiquetas:
+        return ''
+    escapar = lambda valor: str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{clave}="{escapar(valor)}"' for clave, valor in etiquetas) + '}'
+
+class Metricas:
+    """Contadores e histogramas del proceso. Cada worker vuelca los suyos en un archivo propio
+    de DIRECTORIO_METRICAS y /metrics suma los de todos; los archivos de workers ya terminados
+    se siguen sumando para que los contadores no retrocedan (limpiar-metricas los borra al
+    arrancar el servidor). Solo se vuelca tras activar(), que hace la primera petición HTTP:
+    los comandos de consola no escriben en el directorio del servidor."""
+
+    def __init__(self, directorio, intervalo_volcado=2.0):
+        self.directorio = directorio
+        self.intervalo_volcado = intervalo_volcado
+        self._reiniciar()
+        os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        # Tras un fork el hijo empieza de cero con su propio archivo (lo del padre ya está en el
+        # del padre) y con un lock nuevo, por si otro hilo del padre lo tenía tomado
+        self._lock = threading.Lock()
+        self._lock_volcado = threading.Lock()  # serializa la escritura del archivo
+        self.activo = False
+        self.pid = os.getpid()
+        self.ruta = os.path.join(self.directorio, f'{self.pid}-{time.time_ns()}.json')
+        self.contadores = {}
+        self.histogramas = {}
+        self._volcado = None
+
+    def activar(self):
+        self.activo = True
+
+    def _clave(self, nombre, etiquetas):
+        return (nombre, tuple(sorted(etiquetas.items())))
+
+    def incrementar(self, nombre, valor=1, **etiquetas):
+        with self._lock:
+            clave = self._clave(nombre, etiquetas)
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+            self._programar_volcado()
+
+    def observar(self, nombre, segundos, **etiquetas):
+        with self._lock:
+            clave = self._clave(nombre, etiquetas)
+            # Conteos por cubeta (no acumulados; la última es > al mayor límite) y suma
+            cubetas, suma = self.histogramas.get(clave) or ([0] * (len(CUBETAS_DURACION) + 1), 0.0)
+            cubetas[bisect.bisect_left(CUBETAS_DURACION, segundos)] += 1
+            self.histogramas[clave] = (cubetas, suma + segundos)
+            self._programar_volcado()
+
+    @contextmanager
+    def cronometro(self, nombre, **etiquetas):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nombre, time.perf_counter() - inicio, **etiquetas)
+
+    def _programar_volcado(self):
+        """Un temporizador agrupa los cambios de varias peticiones en una escritura y
+        garantiza que un worker inactivo también publique sus últimos valores"""
+        if self.activo and self._volcado is None:
+            self._volcado = threading.Timer(self.intervalo_volcado, self.volcar)
+            self._volcado.daemon = True
+            self._volcado.start()
+
+    def volcar(self):
+        if not self.activo:
+            return
+        # El temporizador y exponer() pueden volcar a la vez; el segundo espera y escribe
+        # valores tan o más recientes. Las peticiones solo esperan el lock de los valores.
+        with self._lock_volcado:
+            with self._lock:
+                self._volcado = None
+                if not (self.contadores or self.histogramas):
+                    return
+                contenido = json.dumps({
+                    'contadores': [[nombre, etiquetas, valor] for (nombre, etiquetas), valor in self.contadores.items()],
+                    'histogramas': [[nombre, etiquetas, h] for (nombre, etiquetas), h in self.histogramas.items()]
+                })
+                ruta = self.ruta
+            # Sin fsync: perder el último volcado ante una caída del equipo es aceptable
+            os.makedirs(self.directorio, exist_ok=True)
+            with open(f'{ruta}.tmp', 'w', encoding='utf-8') as f:
+                f.write(contenido)
+            os.replace(f'{ruta}.tmp', ruta)
+
+    def _sumar_workers(self):
+        contadores, histogramas = Counter(), {}
+        try:
+            nombres = os.listdir(self.directorio)
+        except FileNotFoundError:
+            nombres = []
+        for nombre_archivo in nombres:
+            if not nombre_archivo.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directorio, nombre_archivo), 'r', encoding='utf-8') as f:
+                    datos = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            for nombre, etiquetas, valor in datos['contadores']:
+                contadores[(nombre, tuple(map(tuple, etiquetas)))] += valor
+            for nombre, etiquetas, (cubetas, suma) in datos['histogramas']:
+                if len(cubetas) != len(CUBETAS_DURACION) + 1:
+                    continue  # volcado con otras cubetas (versión anterior)
+                clave = (nombre, tuple(map(tuple, etiquetas)))
+                acumuladas, total = histogramas.get(clave, ([0] * len(cubetas), 0.0))
+                histogramas[clave] = ([a + b for a, b in zip(acumuladas, cubetas)], total + suma)
+        return contadores, histogramas
+
+    def exponer(self):
+        """Formato de texto de Prometheus con la suma de todos los workers"""
+        self.volcar()
+        contadores, histogramas = self._sumar_workers()
+        lineas = []
+        for nombre, (tipo, ayuda) in DEFINICIONES_METRICAS.items():
+            lineas += [f'# HELP {nombre} {ayuda}', f'# TYPE {nombre} {tipo}']
+            if tipo == 'counter':
+                for (_, etiquetas), valor in sorted(i for i in contadores.items() if i[0][0] == nombre):
+                    lineas.append(f'{nombre}{etiquetas_prometheus(etiquetas)} {valor}')
+                continue
+            for (_, etiquetas), (cubetas, suma) in sorted(i for i in histogramas.items() if i[0][0] == nombre):
+                for limite, acumulado in zip([*map(str, CUBETAS_DURACION), '+Inf'], itertools.accumulate(cubetas)):
+                    lineas.append(f'{nombre}_bucket{etiquetas_prometheus(etiquetas + (("le", limite),))} {acumulado}')
+                lineas.append(f'{nombre}_sum{etiquetas_prometheus(etiquetas)} {suma}')
+                lineas.append(f'{nombre}_count{etiquetas_prometheus(etiquetas)} {sum(cubetas)}')
+        return '\n'.join(lineas) + '\n'
+
+    def limpiar(self):
+        """Borra los volcados de todos los workers (al arrancar el servidor, con ninguno activo)"""
+        with self._lock:
+            self.contadores, self.histogramas = {}, {}
+        for nombre_archivo in os.listdir(self.directorio) if os.path.isdir(self.directorio) else ():
+            os.remove(os.path.join(self.directorio, nombre_archivo))
+
+metricas = Metricas(app.config['DIRECTORIO_METRICAS'])
+atexit.register(metricas.volcar)
+
+def medir_almacen(f):
+    """Registra la duración de una función de acceso a datos con su nombre como operación"""
+    @wraps(f)
+    def funcion_medida(*args, **kwargs):
+        with metricas.cronometro('seguimiento_almacen_segundos', operacion=f.__name__):
+            return f(*args, **kwargs)
+    return funcion_medida
+
+def registrar_transicion(accion, rol, cuentas):
+    """Cuenta la transición de las cuentas ya guardadas y la publica para /eventos"""
+    if cuentas:
+        metricas.incrementar('seguimiento_transiciones_total', len(cuentas), accion=accion, rol=rol)
+        publicar_transiciones(accion, cuentas)
+
+# ==================== CODECS DE SERIALIZACIÓN ====================
+class CodecJSON:
+    """JSON de la biblioteca estándar: compacto, o con sangría para archivos que se editan a mano"""
+    nombre = 'json'
+    binario = False
+
+    def __init__(self, sangria=None):
+        self.sangria = sangria
+
+    def codificar(self, datos):
+        separadores = None if self.sangria else (',', ':')
+        return json.dumps(datos, ensure_ascii=False, indent=self.sangria, separators=separadores).encode('utf-8')
+
+    def decodificar(self, contenido):
+        return json.loads(contenido)
+
+class CodecORJSON:
+    """orjson: el mismo JSON compacto, varias veces más rápido de codificar y leer"""
+    nombre = 'orjson'
+    binario = False
+
+    def codificar(self, datos):
+        return orjson.dumps(datos, option=orjson.OPT_NON_STR_KEYS)
+
+    def decodificar(self, contenido):
+        return orjson.loads(contenido)
+
+class CodecMsgpack:
+    """MessagePack: instantánea binaria más pequeña y rápida de leer, para volúmenes grandes"""
+    nombre = 'msgpack'
+    binario = True
+
+    def codificar(self, datos):
+        return msgpack.packb(datos, use_bin_type=True)
+
+    def decodificar(self, contenido):
+        return msgpack.unpackb(contenido, raw=False, strict_map_key=False)
+
+def codecs_disponibles():
+    return ['json'] + [nombre for nombre, modulo in (('orjson', orjson), ('msgpack', msgpack)) if modulo]
+
+def crear_codec(nombre):
+    """Codec por nombre; 'auto' usa orjson si está instalado y si no el JSON compacto"""
+    if nombre == 'auto':
+        nombre = 'orjson' if orjson else 'json'
+    if nombre not in ('json', 'orjson', 'msgpack'):
+        raise ValueError(f'Codec de serialización desconocido: {nombre}')
+    if nombre not in codecs_disponibles():
+        raise ValueError(f'El codec {nombre} requiere instalar el paquete {nombre}')
+    return {'json': CodecJSON, 'orjson': CodecORJSON, 'msgpack': CodecMsgpack}[nombre]()
+
+# Registros del diario y lectura de cualquier JSON: el codificador más rápido disponible
+CODEC_JSON_RAPIDO = crear_codec('auto')
+
+def decodificar_datos(contenido):
+    """Lee un archivo de datos en cualquier formato: el JSON empieza por '[' o '{' y lo demás
+    es MessagePack, así que cambiar CODEC_CUENTAS no requiere migrar los archivos"""
+    inicio = contenido[:64].lstrip()[:1]
+    if not inicio or inicio in (b'[', b'{'):
+        return CODEC_JSON_RAPIDO.decodificar(contenido)
+    if msgpack is None:
+        raise ValueError('El archivo está en formato MessagePack y el paquete msgpack no está instalado')
+    return CodecMsgpack().decodificar(contenido)
+
+# ==================== CACHÉ EN MEMORIA ====================
+@contextmanager
+def bloqueo_archivo(ruta, exclusivo=True):
+    """Bloqueo entre procesos (workers de gunicorn) sobre un archivo auxiliar"""
+    with open(ruta, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusivo else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def escribir_atomico(ruta, contenido, etiqueta=None):
+    """Escribe en un temporal y lo renombra, para que un fallo no deje el archivo a medias"""
+    etiqueta = etiqueta or os.path.basename(ruta)
+    temporal = f'{ruta}.tmp'
+    with metricas.cronometro('seguimiento_archivo_segundos', archivo=etiqueta, operacion='escritura'):
+        with open(temporal, 'wb') as f:
+            f.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, ruta)
+    metricas.incrementar('seguimiento_archivo_bytes_total', len(contenido), archivo=etiqueta, operacion='escritura')
+
+def leer_archivo(ruta, etiqueta=None):
+    """Contenido completo de un archivo de datos, registrando duración y bytes leídos"""
+    etiqueta = etiqueta or os.path.basename(ruta)
+    with metricas.cronometro('seguimiento_archivo_segundos', archivo=etiqueta, operacion='lectura'):
+        with open(ruta, 'rb') as f:
+            contenido = f.read()
+    metricas.incrementar('seguimiento_archivo_bytes_total', len(contenido), archivo=etiqueta, operacion='lectura')
+    return contenido
+
+class CacheArchivoJSON:
+    """Mantiene en memoria el contenido de un archivo de datos (JSON, o MessagePack según
+    el codec) y solo lo vuelve a leer cuando cambia su versión en disco (inodo, mtime y tamaño).
+    Sin codec se escribe JSON con sangría, para archivos que se editan a mano."""
+
+    def __init__(self, ruta, normalizar=None, codec=None, etiqueta=None):
+        self.ruta = ruta
+        self.normalizar = normalizar
+        self.codec = codec or CodecJSON(sangria=2)
+        self.etiqueta = etiqueta or os.path.splitext(os.path.basename(ruta))[0]
+        self.datos = None
+        self.version = None
+        self.generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self._lock = threading.RLock()
+
+    def _version_en_disco(self):
+        try:
+            st = os.stat(self.ruta)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def obtener(self):
+        with self._lock:
+            self._sincronizar()
+            return self.datos
+
+    def _sincronizar(self):
+        if self.datos is not None and self._version_en_disco() == self.version:
+            self.aciertos += 1
+            self._refrescar()
+        else:
+            self.fallos += 1
+            self._recargar()
+
+    def _refrescar(self):
+        """Punto de extensión para aplicar cambios incrementales sobre datos vigentes"""
+
+    def _recargar(self):
+        self.version = self._version_en_disco()
+        datos = []
+        if self.version is not None:
+            datos = decodificar_datos(leer_archivo(self.ruta, self.etiqueta))
+            if self.normalizar:
+                self.normalizar(datos)
+        self.datos = datos
+        self.generacion += 1
+
+    def guardar(self, datos):
+        with self._lock:
+            escribir_atomico(self.ruta, self.codec.codificar(datos), self.etiqueta)
+            self.datos = datos
+            self.version = self._version_en_disco()
+            self.generacion += 1
+
+    def invalidar(self):
+        with self._lock:
+            self.datos = None
+            self.version = None
+
+    def estadisticas(self):
+        return {
+            'archivo': self.ruta,
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+            'generacion': self.generacion,
+            'registros': len(self.datos) if self.datos is not None else 0
+        }
+
+# ==================== BÚSQUEDA DE TEXTO ====================
+# Campos de búsqueda de una cuenta y su peso en la puntuación: los números la identifican
+# y pesan más que el texto libre. El orden es el de las columnas de texto_cuentas en SQLite.
+CAMPOS_BUSQUEDA = {
+    'numeros': 4.0,
+    'contratista': 2.0,
+    'descripcion': 1.0,
+    'comentarios': 1.0
+}
+PALABRAS_VACIAS = frozenset('a al con de del el en la las lo los o para por que se su un una y'.split())
+PREFIJO_MINIMO = 2  # desde esta longitud la última palabra de la consulta también busca por prefijo
+PATRON_PALABRA = re.compile(r'[^\W_]+')
+
+def _letra_base(letra):
+    return ''.join(c for c in unicodedata.normalize('NFKD', letra) if not unicodedata.combining(c))
+
+# Letras latinas con tilde → letra base ('á' → 'a', 'ñ' → 'n') y marcas sueltas → ''. Se
+# reemplazan solo los caracteres no ASCII (str.translate recorre todo el texto y es más lento)
+SIN_TILDES = {chr(cp): _letra_base(chr(cp)) for cp in itertools.chain(range(0xC0, 0x250), range(0x300, 0x370))}
+PATRON_NO_ASCII = re.compile(r'[^\x00-\x7f]')
+
+def tokenizar(texto):
+    """Palabras en minúsculas y sin tildes ('Devolución' → 'devolucion'); separa en todo lo que
+    no sea letra o dígito, como el tokenizador unicode61 de SQLite con remove_diacritics"""
+    texto = texto.lower()
+    if not texto.isascii():
+        texto = PATRON_NO_ASCII.sub(lambda letra: SIN_TILDES.get(letra[0], letra[0]), texto)
+    return PATRON_PALABRA.findall(texto)
+
+def terminos_consulta(consulta):
+    """Palabras de la consulta sin las vacías (salvo que solo haya vacías)"""
+    palabras = tokenizar(consulta)
+    return [p for p in palabras if p not in PALABRAS_VACIAS] or palabras
+
+def textos_busqueda(cuenta):
+    return {
+        'numeros': ' '.join(str(cuenta.get(campo) or '') for campo in ('numero_cuenta', 'numero_contrato', 'numero_acta')),
+        'contratista': cuenta.get('contratista_nombre') or '',
+        'descripcion': cuenta.get('descripcion') or '',
+        'comentarios': ' '.join(movimiento.get('comentario') or '' for movimiento in cuenta.get('historial') or ())
+    }
+
+class IndiceTexto:
+    """Índice invertido palabra → {cuenta_id: peso} que se actualiza cuenta por cuenta. El
+    peso suma las apariciones de la palabra en cada campo multiplicadas por el peso del campo."""
+
+    def __init__(self, cuentas=()):
+        self._listas = {}
+        self.documentos = 0
+        self._vocabulario = None  # palabras ordenadas para buscar por prefijo (se arma al usarlo)
+        for cuenta in cuentas:
+            self.actualizar(None, cuenta)
+
+    def _pesos(self, cuenta):
+        pesos = {}
+        for campo, texto in textos_busqueda(cuenta).items():
+            peso_campo = CAMPOS_BUSQUEDA[campo]
+            for palabra, veces in Counter(tokenizar(texto)).items():
+                pesos[palabra] = pesos.get(palabra, 0.0) + veces * peso_campo
+        return pesos
+
+    def actualizar(self, anterior, cuenta):
+        """Reemplaza las palabras de la versión anterior de la cuenta (None: cuenta nueva)"""
+        if anterior is not None:
+            self.eliminar(anterior)
+        self.documentos += 1
+        for palabra, peso in self._pesos(cuenta).items():
+            lista = self._listas.get(palabra)
+            if lista is None:
+                lista = self._listas[palabra] = {}
+                if self._vocabulario is not None:
+                    bisect.insort(self._vocabulario, palabra)
+            lista[cuenta['id']] = peso
+
+    def eliminar(self, cuenta):
+        self.documentos -= 1
+        for palabra in self._pesos(cuenta):
+            lista = self._listas.get(palabra)
+            if lista is None:
+                continue
+            lista.pop(cuenta['id'], None)
+            if not lista:
+                del self._listas[palabra]
+                if self._vocabulario is not None:
+                    del self._vocabulario[bisect.bisect_left(self._vocabulario, palabra)]
+
+    def _con_prefijo(self, prefijo):
+        if self._vocabulario is None:
+            self._vocabulario = sorted(self._listas)
+        inicio = bisect.bisect_left(self._vocabulario, prefijo)
+        for palabra in itertools.islice(self._vocabulario, inicio, None):
+            if not palabra.startswith(prefijo):
+                return
+            yield palabra
+
+    def _lista_termino(self, termino, prefijo):
+        """{cuenta_id: peso} del término; con prefijo, el mayor peso entre las palabras que
+        empiezan por él"""
+        if not prefijo:
+            return self._listas.get(termino, {})
+        palabras = list(self._con_prefijo(termino))
+        if len(palabras) == 1:
+            return self._listas[palabras[0]]
+        unidas = {}
+        for palabra in palabras:
+            for cuenta_id, peso in self._listas[palabra].items():
+                if peso > unidas.get(cuenta_id, 0.0):
+                    unidas[cuenta_id] = peso
+        return unidas
+
+    def buscar(self, terminos, candidatos=None):
+        """{cuenta_id: puntuación} de las cuentas que tienen todos los términos (el último
+        también como prefijo). Cada término aporta su peso saturado (como en BM25) por su idf.
+        Se recorre solo la lista más corta y las demás se consultan por id."""
+        if not terminos:
+            return {}
+        listas = [
+            self._lista_termino(termino, posicion == len(terminos) - 1 and len(termino) >= PREFIJO_MINIMO)
+            for posicion, termino in enumerate(terminos)
+        ]
+        if not all(listas):
+            return {}
+        listas.sort(key=len)
+        idfs = [math.log(1 + self.documentos / len(lista)) for lista in listas]
+        resultados = {}
+        for cuenta_id in listas[0]:
+            if candidatos is not None and cuenta_id not in candidatos:
+                continue
+            puntos = 0.0
+            for lista, idf in zip(listas, idfs):
+                peso = lista.get(cuenta_id)
+                if peso is None:
+                    break
+                puntos += idf * peso * 2.2 / (peso + 1.2)
+            else:
+                resultados[cuenta_id] = puntos
+        return resultados
+
+# ==================== DIARIO DE CAMBIOS DE CUENTAS ====================
+UMBRAL_COMPACTACION_DIARIO = 1000
+
+class ConflictoVersion(Exception):
+    """La cuenta fue modificada por otro usuario (u otro worker) después de leerla"""
+
+    def __init__(self, cuenta_id):
+        super().__init__(f'La cuenta {cuenta_id} cambió desde que fue leída')
+        self.cuenta_id = cuenta_id
+
+class NumeroCuentaDuplicado(Exception):
+    """Ya existe otra cuenta con el mismo numero_cuenta"""
+
+    def __init__(self, numero_cuenta):
+        super().__init__(f'Ya existe una cuenta con el número {numero_cuenta}')
+        self.numero_cuenta = numero_cuenta
+
+def diferencias_contadores(antes, despues):
+    """{contador: {clave: (mantenido, recalculado)}} solo para las claves que no coinciden"""
+    diferencias = {}
+    for nombre in despues:
+        claves = set(antes[nombre]) | set(despues[nombre])
+        distintas = {
+            clave: (antes[nombre].get(clave, 0), despues[nombre].get(clave, 0))
+            for clave in claves if antes[nombre].get(clave, 0) != despues[nombre].get(clave, 0)
+        }
+        if distintas:
+            diferencias[nombre] = distintas
+    return diferencias
+
+# Claves de ordenamiento de /cuentas; el id desempata y hace única cada clave (paginación por cursor)
+CLAVES_ORDEN = {
+    'fecha': lambda c: (c.get('timestamps', {}).get('radicacion') or '', c['id']),
+    'valor': lambda c: (float(c.get('valor') or 0), c['id'])
+}
+
+# Tipo del primer elemento de cada clave, para validar los cursores recibidos
+TIPOS_CLAVE_ORDEN = {
+    'fecha': (str,),
+    'valor': (int, float)
+}
+
+# Filtros de rango aplicables sobre cada clave de ordenamiento
+RANGOS_ORDEN = {
+    'fecha': ('desde', 'hasta'),
+    'valor': ('valor_min', 'valor_max')
+}
+
+def cuenta_cumple_filtros(cuenta, filtros):
+    fecha = cuenta.get('timestamps', {}).get('radicacion') or ''
+    valor = float(cuenta.get('valor') or 0)
+    return (
+        filtros.get('estado') in (None, cuenta['estado_actual'])
+        and filtros.get('contratista_id') in (None, cuenta.get('contratista_id'))
+        and filtros.get('responsable_id') in (None, cuenta.get('responsable_actual'))
+        and (filtros.get('desde') is None or fecha >= filtros['desde'])
+        and (filtros.get('hasta') is None or fecha <= filtros['hasta'])
+        and (filtros.get('valor_min') is None or valor >= filtros['valor_min'])
+        and (filtros.get('valor_max') is None or valor <= filtros['valor_max'])
+    )
+
+def codificar_cursor(clave, orden):
+    return base64.urlsafe_b64encode(json.dumps([orden, *clave]).encode('utf-8')).decode('ascii')
+
+def decodificar_cursor(texto, orden):
+    """Clave (valor, id) de la última cuenta de la página anterior, o None si no es válido.
+    Un cursor de otro orden (p. ej. de fecha con ?orden=valor) tampoco lo es: su clave no se
+    puede comparar con las de este orden."""
+    if not texto:
+        return None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(texto.encode('ascii')))
+    except (ValueError, UnicodeError):
+        return None
+    if not (isinstance(cursor, list) and len(cursor) == 3 and cursor[0] == orden):
+        return None
+    _, valor, cuenta_id = cursor
+    if not (isinstance(valor, TIPOS_CLAVE_ORDEN[orden]) and not isinstance(valor, bool)
+            and isinstance(cuenta_id, int) and not isinstance(cuenta_id, bool)):
+        return None
+    return valor, cuenta_id
+
+def generar_numero_cuenta(cuenta_id, fecha=None):
+    return f"CC-{(fecha or datetime.now()).strftime('%Y%m%d')}-{cuenta_id:03d}"
+
+def asignar_identificacion(cuenta, cuenta_id):
+    """Completa id, número y versión de una cuenta nueva con el id reservado por el almacén"""
+    cuenta['id'] = cuenta_id
+    if not cuenta.get('numero_cuenta'):
+        cuenta['numero_cuenta'] = generar_numero_cuenta(cuenta_id)
+    cuenta['version'] = 1
+
+@contextmanager
+def versiones_provisionales(cuentas):
+    """Incrementa la versión de las cuentas a confirmar y la restaura si la escritura falla"""
+    anteriores = [c.get('version', 0) for c in cuentas]
+    for cuenta, version in zip(cuentas, anteriores):
+        cuenta['version'] = version + 1
+    try:
+        yield anteriores
+    except BaseException:
+        for cuenta, version in zip(cuentas, anteriores):
+            cuenta['version'] = version
+        raise
+
+# Plazo máximo (en días hábiles) de cada etapa de revisión; fecha_limite se guarda al entrar en la etapa.
+# Como en verificar_alerta_3_dias ("más de 3 días"), la etapa vence al empezar el cuarto día hábil
+# después del día de inicio, no a la misma hora del tercero.
+DIAS_MAXIMOS_ETAPA = 3
+FORMATO_FECHA = '%Y-%m-%d %H:%M:%S'
+
+@lru_cache(maxsize=8192)
+def epoch_de(texto):
+    """Segundos desde 1970 (hora local) de una marca 'AAAA-MM-DD HH:MM:SS'. En caché:
+    las mismas marcas se repiten en timestamps, historial y entre peticiones."""
+    return int(datetime.fromisoformat(texto).timestamp())
+
+def calcular_fecha_limite(cuenta):
+    """Fin del plazo de la etapa de revisión actual (medianoche del primer día hábil en que la
+    etapa lleva más de DIAS_MAXIMOS_ETAPA), o None si la cuenta no está en revisión"""
+    estado = cuenta['estado_actual']
+    clave = f'inicio_{estado}'
+    inicio = cuenta.get('timestamps', {}).get(clave) if estado in ESTADOS_EN_REVISION else None
+    if not inicio:
+        return None
+    epoch = cuenta.get('timestamps_epoch', {}).get(clave) or epoch_de(inicio)
+    return vencimiento_dias_habiles(datetime.fromtimestamp(epoch), DIAS_MAXIMOS_ETAPA).strftime(FORMATO_FECHA)
+
+def actualizar_plazo(cuenta, ahora=None):
+    """Recalcula fecha_limite y vencida antes de confirmar la cuenta. vencida se deriva
+    siempre del plazo, así que marcarla no necesita cambiar la versión de la cuenta."""
+    cuenta['fecha_limite'] = limite = calcular_fecha_limite(cuenta)
+    cuenta['vencida'] = limite is not None and limite <= (ahora or datetime.now().strftime(FORMATO_FECHA))
+
+# Versión del formato de cada cuenta (campo 'esquema'); las cuentas anteriores se migran al leerlas
+#   1: marcas de tiempo solo como texto
+#   2: timestamps_epoch y 'epoch' en cada movimiento del historial, dias_por_etapa calculado
+VERSION_ESQUEMA_CUENTAS = 2
+
+def sincronizar_epochs(cuenta):
+    """Copia en enteros (epoch) las marcas de tiempo en texto de la cuenta y su historial"""
+    cuenta['timestamps_epoch'] = {clave: epoch_de(valor) for clave, valor in cuenta.get('timestamps', {}).items() if valor}
+    for movimiento in cuenta.get('historial') or ():
+        if 'epoch' not in movimiento and movimiento.get('timestamp'):
+            movimiento['epoch'] = epoch_de(movimiento['timestamp'])
+
+def calcular_dias_por_etapa(historial):
+    """Días (naturales, con decimales) que la cuenta pasó en cada estado ya terminado"""
+    segundos = Counter()
+    for movimiento, siguiente in itertools.pairwise(historial):
+        if 'epoch' in movimiento and 'epoch' in siguiente:
+            segundos[movimiento['estado']] += siguiente['epoch'] - movimiento['epoch']
+    return {estado: round(total / 86400, 2) for estado, total in segundos.items()}
+
+def preparar_cuenta(cuenta, ahora=None):
+    """Campos derivados que se recalculan en cada confirmación: epochs, tiempos por etapa y plazo"""
+    sincronizar_epochs(cuenta)
+    if cuenta.get('historial') is not None:
+        cuenta['dias_por_etapa'] = calcular_dias_por_etapa(cuenta['historial'])
+    actualizar_plazo(cuenta, ahora)
+    cuenta['esquema'] = VERSION_ESQUEMA_CUENTAS
+
+def migrar_cuenta(cuenta):
+    """Lleva una cuenta de un esquema anterior al actual (en el lugar)"""
+    if cuenta.get('esquema', 1) < 2:
+        sincronizar_epochs(cuenta)
+        if cuenta.get('historial') is not None:
+            cuenta['dias_por_etapa'] = calcular_dias_por_etapa(cuenta['historial'])
+    cuenta['esquema'] = VERSION_ESQUEMA_CUENTAS
+
+class AlmacenCuentasJSON(CacheArchivoJSON):
+    """Cuentas en memoria sobre una instantánea (cuentas.json) y un diario de solo
+    anexado (cuentas.journal). Cada cambio agrega una línea compacta al diario y la
+    instantánea solo se reescribe al compactar.
+    
+    El diario también lleva la bandeja de salida de notificaciones, escrita en la misma
+    línea de diario que la cuenta que las origina; al compactar, las que siguen vigentes
+    pasan a notificaciones.json (junto a la instantánea)."""
+
+    def __init__(self, ruta, ruta_diario, normalizar=None, umbral_compactacion=UMBRAL_COMPACTACION_DIARIO, archivo=None,
+                 codec=None, ruta_notificaciones=None):
+        super().__init__(ruta, normalizar, codec or CodecJSON())
+        self.ruta_diario = ruta_diario
+        self.ruta_notificaciones = ruta_notificaciones or os.path.join(os.path.dirname(ruta), 'notificaciones.json')
+        self.archivo = archivo
+        self.ruta_bloqueo = f'{ruta}.lock'
+        self.umbral_compactacion = umbral_compactacion
+        self.registros_diario = 0
+        self.registros_reproducidos = 0
+        self.compactaciones = 0
+        self._offset_diario = 0
+        self._indice = {}
+        self._indice_numero = {}
+        self._carga = Counter()
+        self._conteo = Counter()
+        self._por_campo = {}
+        self._orden = {}
+        self._plazos = []
+        self._vencidas = set()
+        self._texto = None
+        self._texto_cambios = None
+        self._texto_lock = threading.Lock()
+        self.ultimo_id = 0
+        self._notificaciones = {}
+        self.ultima_notificacion = 0
+        self._compactando = False
+
+    def obtener(self):
+        with self._vigente():
+            return self.datos
+
+    @contextmanager
+    def _vigente(self):
+        """Sincroniza con el disco bajo bloqueo compartido, que evita leer el diario
+        mientras otro proceso lo compacta"""
+        with bloqueo_archivo(self.ruta_bloqueo, exclusivo=False):
+            with self._lock:
+                self._sincronizar()
+                yield
+
+    def _recargar(self):
+        super()._recargar()
+        self._reindexar()
+        self._cargar_notificaciones()
+        self._offset_diario = 0
+        self.registros_diario = 0
+        self._leer_diario()
+
+    def _refrescar(self):
+        self._leer_diario()
+
+    def _leer_diario(self):
+        """Reproduce los registros que otros procesos agregaron desde la última lectura"""
+        try:
+            with open(self.ruta_diario, 'rb') as f:
+                f.seek(self._offset_diario)
+                pendiente = f.read()
+        except FileNotFoundError:
+            return
+        if pendiente:
+            metricas.incrementar('seguimiento_archivo_bytes_total', len(pendiente), archivo='diario', operacion='lectura')
+        
+        # Una última línea sin salto es una escritura interrumpida: se ignora
+        fin = pendiente.rfind(b'\n') + 1
+        for linea in pendiente[:fin].splitlines():
+            if linea.strip():
+                registro = CODEC_JSON_RAPIDO.decodificar(linea)
+                if registro['op'] == 'notificacion':
+                    self._aplicar_notificacion(registro['notificacion'])
+                else:
+                    self._aplicar(registro['cuenta'])
+                self.registros_reproducidos += 1
+        self._offset_diario += fin
+
+    def obtener_cuenta(self, cuenta_id):
+        """Copia de la cuenta: se puede modificar libremente y confirmar con guardar_cuenta"""
+        with self._vigente():
+            posicion = self._indice.get(cuenta_id)
+            return copy.deepcopy(self.datos[posicion]) if posicion is not None else None
+
+    def obtener_cuenta_por_numero(self, numero_cuenta):
+        with self._vigente():
+            cuenta_id = self._indice_numero.get(numero_cuenta)
+            return copy.deepcopy(self.datos[self._indice[cuenta_id]]) if cuenta_id is not None else None
+
+    def _reindexar(self):
+        """Reconstruye los índices id → posición y numero_cuenta → id y los contadores"""
+        self._indice = {c['id']: i for i, c in enumerate(self.datos)}
+        self._indice_numero = {c['numero_cuenta']: c['id'] for c in self.datos if c.get('numero_cuenta')}
+        self._recontar()
+        # El índice de texto se vuelve a construir en la próxima búsqueda (y se descarta el
+        # que se estuviera construyendo sobre los datos anteriores)
+        self._texto = None
+        self._texto_cambios = None
+        # Los ids de las cuentas archivadas tampoco se reutilizan
+        self.ultimo_id = max(max(self._indice, default=0), self.archivo.ultimo_id() if self.archivo else 0)
+
+    def _recontar(self):
+        self._carga = Counter()
+        self._conteo = Counter()
+        self._por_campo = {'estado': {}, 'contratista_id': {}, 'responsable_id': {}}
+        for cuenta in self.datos:
+            self._contar(cuenta, +1)
+        self._orden = {nombre: sorted(map(clave, self.datos)) for nombre, clave in CLAVES_ORDEN.items()}
+        self._vencidas = {c['id'] for c in self.datos if c.get('vencida')}
+        self._plazos = [(c['fecha_limite'], c['id']) for c in self.datos if c.get('fecha_limite') and not c.get('vencida')]
+        heapq.heapify(self._plazos)
+
+    def _contar(self, cuenta, delta):
+        """Actualiza contadores e índices por campo al entrar (+1) o salir (-1) una cuenta"""
+        estado = cuenta['estado_actual']
+        self._conteo[(None, estado)] += delta
+        if cuenta.get('contratista_id') is not None:
+            self._conteo[(cuenta['contratista_id'], estado)] += delta
+        if estado in ESTADOS_EN_REVISION:
+            self._carga[cuenta.get('responsable_actual')] += delta
+        
+        for campo, valor in (('estado', estado), ('contratista_id', cuenta.get('contratista_id')),
+                             ('responsable_id', cuenta.get('responsable_actual'))):
+            ids = self._por_campo[campo].setdefault(valor, set())
+            if delta > 0:
+                ids.add(cuenta['id'])
+            else:
+                ids.discard(cuenta['id'])
+
+    def _ordenar(self, anterior, cuenta):
+        """Mantiene las listas ordenadas por fecha y por valor (solo si la clave cambió)"""
+        for nombre, clave in CLAVES_ORDEN.items():
+            lista = self._orden[nombre]
+            nueva = clave(cuenta)
+            if anterior is not None:
+                vieja = clave(anterior)
+                if vieja == nueva:
+                    continue
+                del lista[bisect.bisect_left(lista, vieja)]
+            bisect.insort(lista, nueva)
+
+    def _programar(self, anterior, cuenta):
+        """Mantiene el montículo de plazos pendientes y el conjunto de cuentas vencidas.
+        Las entradas del montículo que dejan de valer se descartan al salir de él."""
+        if cuenta.get('vencida'):
+            self._vencidas.add(cuenta['id'])
+            return
+        self._vencidas.discard(cuenta['id'])
+        limite = cuenta.get('fecha_limite')
+        if limite and (anterior is None or anterior.get('fecha_limite') != limite or anterior.get('vencida')):
+            heapq.heappush(self._plazos, (limite, cuenta['id']))
+
+    def marcar_vencidas(self, ahora):
+        """Marca como vencidas las cuentas cuyo plazo ya pasó, sacándolas del montículo.
+        Se escriben al diario sin cambiar su versión: no invalida copias leídas por usuarios."""
+        with bloqueo_archivo(self.ruta_bloqueo):
+            with self._lock:
+                self._sincronizar()
+                vencidas = []
+                while self._plazos and self._plazos[0][0] <= ahora:
+                    limite, cuenta_id = heapq.heappop(self._plazos)
+                    cuenta = self.datos[self._indice[cuenta_id]]
+                    if cuenta.get('fecha_limite') == limite and not cuenta.get('vencida'):
+                        vencidas.append(dict(cuenta, vencida=True))
+                if vencidas:
+                    self._anexar(vencidas)
+                    for cuenta in vencidas:
+                        self._aplicar(cuenta)
+                    self.generacion += 1
+                return [cuenta['id'] for cuenta in vencidas]
+
+    def recalcular_plazos(self, ahora):
+        """Recalcula fecha_limite y vencida de todas las cuentas (p. ej. tras cambiar los
+        festivos) y escribe al diario solo las que cambiaron, sin cambiar su versión"""
+        with bloqueo_archivo(self.ruta_bloqueo):
+            with self._lock:
+                self._sincronizar()
+                cambiadas = []
+                for cuenta in self.datos:
+                    nueva = dict(cuenta)
+                    actualizar_plazo(nueva, ahora)
+                    if (nueva['fecha_limite'], nueva['vencida']) != (cuenta.get('fecha_limite'), cuenta.get('vencida')):
+                        cambiadas.append(nueva)
+                if cambiadas:
+                    self._anexar(cambiadas)
+                    for cuenta in cambiadas:
+                        self._aplicar(cuenta)
+                    self.generacion += 1
+                return len(cambiadas)
+
+    def vencidas(self, limite=None):
+        """Cuentas con el plazo vencido, de la más atrasada a la más reciente"""
+        with self._vigente():
+            cuentas = sorted((self.datos[self._indice[i]] for i in self._vencidas), key=lambda c: (c['fecha_limite'], c['id']))
+            return cuentas[:limite] if limite is not None else cuentas
+
+    def marca(self):
+        """Identifica el estado actual de las cuentas: cambia con cada escritura de cualquier
+        proceso (versión de la instantánea más posición en el diario)"""
+        with self._vigente():
+            return f'{self.version}:{self._offset_diario}'
+
+    def carga_responsables(self):
+        """Cuentas en revisión por responsable, mantenido en cada cambio"""
+        with self._vigente():
+            return dict(self._carga)
+
+    def conteo_estados(self, contratista_id=None):
+        """Cuentas por estado (de todas o de un contratista), sin recorrer la lista"""
+        with self._vigente():
+            return {estado: self._conteo[(contratista_id, estado)] for estado in ESTADOS_FLUJO}
+
+    def _candidatos(self, filtros):
+        """Intersección de los índices por campo para los filtros de igualdad (None: sin filtro)"""
+        candidatos = None
+        for campo, indice in self._por_campo.items():
+            if filtros.get(campo) is not None:
+                ids = indice.get(filtros[campo], set())
+                candidatos = ids if candidatos is None else candidatos & ids
+        return candidatos
+
+    def filtrar(self, filtros, limite=None):
+        """Cuentas que cumplen los filtros de igualdad, en orden de id"""
+        with self._vigente():
+            candidatos = self._candidatos(filtros)
+            ids = sorted(candidatos) if candidatos is not None else sorted(self._indice)
+            return [self.datos[self._indice[i]] for i in itertools.islice(ids, limite)]
+
+    def consultar(self, filtros, orden='fecha', descendente=False, limite=50, cursor=None, desplazamiento=0):
+        """Página de cuentas filtradas y ordenadas sin materializar la lista completa.
+        
+        Recorre la lista ordenada por la clave pedida (o, si los filtros de igualdad son
+        muy selectivos, solo los candidatos de sus índices) a partir de la posición del
+        cursor, acotada por bisección a los rangos de fecha o valor. Devuelve la página y
+        la clave de su última cuenta si hay más resultados."""
+        clave = CLAVES_ORDEN[orden]
+        with self._vigente():
+            lista = self._orden[orden]
+            candidatos = self._candidatos(filtros)
+            if candidatos is not None and len(candidatos) * 8 < len(lista):
+                lista = sorted(clave(self.datos[self._indice[i]]) for i in candidatos)
+            
+            minimo, maximo = (filtros.get(nombre) for nombre in RANGOS_ORDEN[orden])
+            inicio = bisect.bisect_left(lista, (minimo,)) if minimo is not None else 0
+            fin = bisect.bisect_right(lista, (maximo, math.inf)) if maximo is not None else len(lista)
+            if cursor is not None:
+                if descendente:
+                    fin = min(fin, bisect.bisect_left(lista, cursor))
+                else:
+                    inicio = max(inicio, bisect.bisect_right(lista, cursor))
+            posiciones = range(fin - 1, inicio - 1, -1) if descendente else range(inicio, fin)
+            
+            pagina = []
+            for posicion in posiciones:
+                cuenta_id = lista[posicion][1]
+                if candidatos is not None and cuenta_id not in candidatos:
+                    continue
+                cuenta = self.datos[self._indice[cuenta_id]]
+                if not cuenta_cumple_filtros(cuenta, filtros):
+                    continue
+                if desplazamiento:
+                    desplazamiento -= 1
+                    continue
+                if len(pagina) == limite:
+                    return pagina, clave(pagina[-1])
+                pagina.append(cuenta)
+            return pagina, None
+
+    def _preparar_texto(self):
+        """Construye el índice de texto sin retener el lock del almacén (con muchas cuentas
+        toma segundos): indexa una copia de la lista y luego aplica las cuentas que cambiaron
+        mientras tanto. Desde ahí _aplicar lo mantiene con cada cambio."""
+        with self._texto_lock:
+            with self._vigente():
+                if self._texto is not None:
+                    return
+                cuentas = list(self.datos)
+                self._texto_cambios = cambios = set()
+            indice = IndiceTexto(cuentas)
+            with self._lock:
+                if self._texto_cambios is not cambios:
+                    return  # se reindexó entretanto: la próxima búsqueda vuelve a construirlo
+                indexadas = {cuenta['id']: cuenta for cuenta in cuentas} if cambios else {}
+                for cuenta_id in cambios:
+                    indice.actualizar(indexadas.get(cuenta_id), self.datos[self._indice[cuenta_id]])
+                self._texto, self._texto_cambios = indice, None
+
+    def buscar(self, consulta, filtros, limite=20, desplazamiento=0):
+        """Página de cuentas con todas las palabras de la consulta, de la más a la menos
+        relevante, y el total de coincidencias"""
+        while True:
+            self._preparar_texto()
+            with self._vigente():
+                if self._texto is None:
+                    continue  # otro proceso reescribió la instantánea mientras se construía
+                resultados = self._texto.buscar(terminos_consulta(consulta), self._candidatos(filtros))
+                if any(filtros.get(campo) is not None for campos in RANGOS_ORDEN.values() for campo in campos):
+                    resultados = {i: p for i, p in resultados.items() if cuenta_cumple_filtros(self.datos[self._indice[i]], filtros)}
+                # Solo se ordenan las mejores hasta la página pedida; empates: la más reciente primero
+                mejores = heapq.nlargest(desplazamiento + limite, resultados.items(), key=lambda item: (item[1], item[0]))
+                return [self.datos[self._indice[i]] for i, _ in mejores[desplazamiento:]], len(resultados)
+
+    def reconstruir_contadores(self):
+        """Recalcula los contadores desde cero y devuelve las diferencias con los mantenidos"""
+        with self._vigente():
+            antes = {'conteo': dict(self._conteo), 'carga': dict(self._carga)}
+            self._recontar()
+            despues = {'conteo': dict(self._conteo), 'carga': dict(self._carga)}
+        return diferencias_contadores(antes, despues)
+
+    def _aplicar(self, cuenta):
+        if self.normalizar:
+            self.normalizar([cuenta])
+        posicion = self._indice.get(cuenta['id'])
+        anterior = None
+        if posicion is None:
+            self._indice[cuenta['id']] = len(self.datos)
+            self.datos.append(cuenta)
+            self.ultimo_id = max(self.ultimo_id, cuenta['id'])
+        else:
+            anterior = self.datos[posicion]
+            if anterior.get('numero_cuenta') != cuenta.get('numero_cuenta'):
+                self._indice_numero.pop(anterior.get('numero_cuenta'), None)
+            self._contar(anterior, -1)
+            self.datos[posicion] = cuenta
+        self._contar(cuenta, +1)
+        self._ordenar(anterior, cuenta)
+        self._programar(anterior, cuenta)
+        if self._texto is not None:
+            self._texto.actualizar(anterior, cuenta)
+        elif self._texto_cambios is not None:
+            self._texto_cambios.add(cuenta['id'])
+        if cuenta.get('numero_cuenta'):
+            self._indice_numero[cuenta['numero_cuenta']] = cuenta['id']
+        self.registros_diario += 1
+
+    def _cargar_notificaciones(self):
+        """Bandeja de salida guardada en la última compactación; el diario trae lo posterior"""
+        self._notificaciones = {}
+        self.ultima_notificacion = 0
+        if os.path.exists(self.ruta_notificaciones):
+            bandeja = decodificar_datos(leer_archivo(self.ruta_notificaciones, 'notificaciones'))
+            self.ultima_notificacion = bandeja['ultimo_id']
+            self._notificaciones = {n['id']: n for n in bandeja['notificaciones']}
+
+    def _aplicar_notificacion(self, notificacion):
+        # Las enviadas salen de la bandeja; las fallidas se conservan para revisarlas
+        if notificacion['estado'] == 'enviada':
+            self._notificaciones.pop(notificacion['id'], None)
+        else:
+            self._notificaciones[notificacion['id']] = notificacion
+        self.ultima_notificacion = max(self.ultima_notificacion, notificacion['id'])
+        self.registros_diario += 1
+
+    def reclamar_notificaciones(self, ahora, limite, reserva_hasta):
+        """Reserva hasta reserva_hasta las notificaciones pendientes cuyo intento ya venció
+        (las más antiguas primero), para que ningún otro proceso las envíe entretanto"""
+        with bloqueo_archivo(self.ruta_bloqueo):
+            with self._lock:
+                self._sincronizar()
+                vencidas = sorted(
+                    (n for n in self._notificaciones.values() if n['estado'] == 'pendiente' and n['proximo_intento'] <= ahora),
+                    key=lambda n: (n['proximo_intento'], n['id'])
+                )
+                reclamadas = [dict(n, proximo_intento=reserva_hasta) for n in vencidas[:limite]]
+                if reclamadas:
+                    self._anexar((), reclamadas)
+                    for notificacion in reclamadas:
+                        self._aplicar_notificacion(dict(notificacion))
+                return reclamadas
+
+    def actualizar_notificaciones(self, notificaciones):
+        """Registra el resultado de los envíos con una sola escritura del diario"""
+        if not notificaciones:
+            return
+        with bloqueo_archivo(self.ruta_bloqueo):
+            with self._lock:
+                self._sincronizar()
+                self._anexar((), notificaciones)
+                for notificacion in notificaciones:
+                    self._aplicar_notificacion(dict(notificacion))
+        if self.registros_diario >= self.umbral_compactacion:
+            self.compactar_en_segundo_plano()
+
+    def _validar_numeros(self, nuevas):
+        vistos = set()
+        for cuenta in nuevas:
+            numero = cuenta['numero_cuenta']
+            if numero in vistos or self._indice_numero.get(numero, cuenta['id']) != cuenta['id']:
+                raise NumeroCuentaDuplicado(numero)
+            vistos.add(numero)
+
+    def guardar_cuenta(self, cuenta):
+        self.confirmar(modificadas=[cuenta])
+
+    def insertar_cuenta(self, cuenta):
+        self.confirmar(nuevas=[cuenta])
+
+    def confirmar(self, modificadas=(), nuevas=(), notificaciones=()):
+        """Confirma cuentas modificadas y nuevas, y las notificaciones que originan, con una
+        sola escritura del diario y un fsync.
+        
+        Control optimista: cada cuenta modificada debe conservar la versión con la que se
+        leyó; si otro proceso la cambió entretanto se lanza ConflictoVersion y no se escribe
+        nada. El bloqueo entre procesos solo se mantiene durante la confirmación, y los ids
+        de las cuentas nuevas se reservan dentro de él para que nunca se repitan."""
+        modificadas, nuevas, notificaciones = list(modificadas), list(nuevas), list(notificaciones)
+        with bloqueo_archivo(self.ruta_bloqueo):
+            with self._lock:
+                self._sincronizar()
+                for cuenta in modificadas:
+                    posicion = self._indice.get(cuenta['id'])
+                    if posicion is None or self.datos[posicion].get('version', 0) != cuenta.get('version', 0):
+                        raise ConflictoVersion(cuenta['id'])
+                
+                with versiones_provisionales(modificadas):
+                    for i, cuenta in enumerate(nuevas, start=1):
+                        asignar_identificacion(cuenta, self.ultimo_id + i)
+                    for cuenta in modificadas + nuevas:
+                        preparar_cuenta(cuenta)
+                    self._validar_numeros(nuevas)
+                    for i, notificacion in enumerate(notificaciones, start=1):
+                        notificacion['id'] = self.ultima_notificacion + i
+                    self._anexar(modificadas + nuevas, notificaciones)
+                for cuenta in modificadas + nuevas:
+                    self._aplicar(copy.deepcopy(cuenta))
+                for notificacion in notificaciones:
+                    self._aplicar_notificacion(dict(notificacion))
+                self.generacion += 1
+        
+        if self.registros_diario >= self.umbral_compactacion:
+            self.compactar_en_segundo_plano()
+
+    def _anexar(self, cuentas, notificaciones=()):
+        # El diario es siempre JSON de una línea por registro, sea cual sea el codec de la instantánea
+        lineas = b''.join(
+            [CODEC_JSON_RAPIDO.codificar({'op': 'cuenta', 'cuenta': c}) + b'\n' for c in cuentas]
+            + [CODEC_JSON_RAPIDO.codificar({'op': 'notificacion', 'notificacion': n}) + b'\n' for n in notificaciones]
+        )
+        with metricas.cronometro('seguimiento_archivo_segundos', archivo='diario', operacion='escritura'):
+            with open(self.ruta_diario, 'ab') as f:
+                f.write(lineas)
+                f.flush()
+                os.fsync(f.fileno())
+                self._offset_diario = f.tell()
+        metricas.incrementar('seguimiento_archivo_bytes_total', len(lineas), archivo='diario', operacion='escritura')
+
+    def guardar(self, datos):
+        """Reescribe la instantánea completa y descarta el diario"""
+        with bloqueo_archivo(self.ruta_bloqueo):
+            with self._lock:
+                # Las notificaciones del diario de otros procesos se conservan
+                self._sincronizar()
+                super().guardar(datos)
+                self._vaciar_diario()
+                self._reindexar()
+
+    def _vaciar_diario(self):
+        # La bandeja de salida se guarda aparte antes de vaciar el diario que la contiene
+        if self._notificaciones or self.ultima_notificacion:
+            bandeja = {'ultimo_id': self.ultima_notificacion, 'notificaciones': list(self._notificaciones.values())}
+            escribir_atomico(self.ruta_notificaciones, CODEC_JSON_RAPIDO.codificar(bandeja), 'notificaciones')
+        with open(self.ruta_diario, 'wb'):
+            pass
+        self._offset_diario = 0
+        self.registros_diario = 0
+
+    def compactar(self, minimo=0):
+        """Vuelca el estado actual en la instantánea y trunca el diario.
+        Si el proceso se cae entre ambos pasos, reproducir el diario es idempotente."""
+        with bloqueo_archivo(self.ruta_bloqueo):
+            with self._lock:
+                self._sincronizar()
+                if self.registros_diario < minimo:
+                    return False
+                escribir_atomico(self.ruta, self.codec.codificar(self.datos), self.etiqueta)
+                self._vaciar_diario()
+                self.version = self._version_en_disco()
+                self.compactaciones += 1
+                return True
+
+    def archivar(self, limite_pago):
+        """Pasa al archivo las cuentas pagadas antes de limite_pago y reescribe la instantánea
+        sin ellas. El archivo se escribe primero: si el proceso se cae antes de reescribir la
+        instantánea, la cuenta queda en ambos lados, se sirve la activa y el siguiente
+        archivado la vuelve a mover."""
+        with bloqueo_archivo(self.ruta_bloqueo):
+            with self._lock:
+                self._sincronizar()
+                archivables = [c for c in self.datos if cuenta_archivable(c, limite_pago)]
+                if archivables:
+                    self.archivo.agregar(archivables)
+                    ids = {c['id'] for c in archivables}
+                    super().guardar([c for c in self.datos if c['id'] not in ids])
+                    self._vaciar_diario()
+                    self._reindexar()
+                return len(archivables)
+
+    def compactar_en_segundo_plano(self):
+        if self._compactando:
+            return
+        self._compactando = True
+        
+        def tarea():
+            try:
+                self.compactar(minimo=self.umbral_compactacion)
+            finally:
+                self._compactando = False
+        
+        threading.Thread(target=tarea, name='compactacion-cuentas', daemon=True).start()
+
+    def estadisticas(self):
+        stats = super().estadisticas()
+        stats.update({
+            'diario': self.ruta_diario,
+            'registros_diario': self.registros_diario,
+            'registros_reproducidos': self.registros_reproducidos,
+            'compactaciones': self.compactaciones,
+            'notificaciones_pendientes': sum(n['estado'] == 'pendiente' for n in self._notificaciones.values())
+        })
+        return stats
+
+# ==================== DIRECTORIO DE USUARIOS ====================
+class DirectorioUsuarios:
+    """Índices en memoria sobre la lista de usuarios: por id y por (rol, dependencia, activo).
+    Se reconstruye solo cuando cambia el archivo o la tabla de usuarios."""
+
+    def __init__(self, usuarios):
+        self.usuarios = usuarios
+        self.por_id = {u['id']: u for u in usuarios}
+        self.por_username = {u.get('username'): u for u in usuarios}
+        self._por_rol = {}
+        for usuario in usuarios:
+            activo = bool(usuario.get('activo', True))
+            # dependencia None agrupa a todos los usuarios del rol
+            for dependencia in (None, usuario.get('dependencia')):
+                self._por_rol.setdefault((usuario.get('rol'), dependencia, activo), []).append(usuario)
+
+    def obtener(self, usuario_id):
+        return self.por_id.get(usuario_id)
+
+    def obtener_por_username(self, username):
+        return self.por_username.get(username)
+
+    def por_rol(self, rol, dependencia=None, activo=True):
+        return self._por_rol.get((rol, dependencia, activo), [])
+
+# ==================== ARCHIVO DE CUENTAS PAGADAS ====================
+# Particiones del archivo que se mantienen en memoria (las consultadas más recientemente)
+PARTICIONES_EN_CACHE = 12
+
+def cuenta_archivable(cuenta, limite_pago):
+    """Solo se archivan cuentas pagadas: ninguna acción las vuelve a modificar"""
+    pago = cuenta.get('timestamps', {}).get('pago')
+    return cuenta['estado_actual'] == 'pagado' and bool(pago) and pago < limite_pago
+
+class ArchivoCuentas:
+    """Cuentas pagadas retiradas del conjunto activo, en archivos JSON por mes de pago
+    (AAAA-MM.json) que la aplicación no vuelve a modificar salvo para agregar cuentas.
+    indice.json dice en qué partición está cada cuenta; las particiones se leen bajo demanda."""
+
+    def __init__(self, directorio, codec=None):
+        self.directorio = directorio
+        self.codec = codec or CodecJSON()
+        self.indice = CacheArchivoJSON(os.path.join(directorio, 'indice.json'), codec=self.codec, etiqueta='archivo')
+        self._particiones = {}
+        self._por_id = {}
+        self._por_numero = {}
+        self._conteo = Counter()
+        self._generacion_indice = None
+
+    def _ruta(self, particion):
+        return os.path.join(self.directorio, f'{particion}.json')
+
+    def _entradas(self):
+        """Índice id → entrada, reconstruido solo cuando cambia indice.json"""
+        entradas = self.indice.obtener()
+        if self._generacion_indice != self.indice.generacion:
+            self._por_id = {e['id']: e for e in entradas}
+            self._por_numero = {e['numero_cuenta']: e['id'] for e in entradas if e.get('numero_cuenta')}
+            self._conteo = Counter(e.get('contratista_id') for e in entradas)
+            self._generacion_indice = self.indice.generacion
+        return self._por_id
+
+    def _particion(self, nombre):
+        # El diccionario conserva el orden de uso: se descarta la partición menos reciente
+        cache = self._particiones.pop(nombre, None) or CacheArchivoJSON(self._ruta(nombre), codec=self.codec, etiqueta='archivo')
+        self._particiones[nombre] = cache
+        while len(self._particiones) > PARTICIONES_EN_CACHE:
+            self._particiones.pop(next(iter(self._particiones)), None)
+        return cache.obtener()
+
+    def ultimo_id(self):
+        return max(self._entradas(), default=0)
+
+    def obtener_cuenta(self, cuenta_id):
+        entrada = self._entradas().get(cuenta_id)
+        if entrada is None:
+            return None
+        for cuenta in self._particion(entrada['particion']):
+            if cuenta['id'] == cuenta_id:
+                return copy.deepcopy(cuenta)
+        return None
+
+    def obtener_cuenta_por_numero(self, numero_cuenta):
+        self._entradas()
+        cuenta_id = self._por_numero.get(numero_cuenta)
+        return self.obtener_cuenta(cuenta_id) if cuenta_id is not None else None
+
+    def contar(self, contratista_id=None):
+        self._entradas()
+        return self._conteo[contratista_id] if contratista_id is not None else len(self._por_id)
+
+    def particiones(self, desde=None, hasta=None):
+        """Meses archivados (AAAA-MM) que se cruzan con el rango de fechas de pago"""
+        meses = sorted({e['particion'] for e in self._entradas().values()})
+        return [mes for mes in meses if (desde is None or mes >= desde[:7]) and (hasta is None or mes <= hasta[:7])]
+
+    def iterar(self, filtros, desde_pago=None, hasta_pago=None):
+        """Cuentas archivadas que cumplen los filtros, leyendo una partición a la vez"""
+        for particion in self.particiones(desde_pago, hasta_pago):
+            try:
+                cuentas = decodificar_datos(leer_archivo(self._ruta(particion), 'archivo'))
+            except FileNotFoundError:
+                continue
+            for cuenta in cuentas:
+                pago = cuenta.get('timestamps', {}).get('pago') or ''
+                if ((desde_pago is None or pago >= desde_pago) and (hasta_pago is None or pago <= hasta_pago)
+                        and cuenta_cumple_filtros(cuenta, filtros)):
+                    yield cuenta
+
+    def agregar(self, cuentas):
+        """Escribe las cuentas en sus particiones y después el índice. Una cuenta que ya
+        estaba archivada se reemplaza, así que repetir un archivado interrumpido es seguro."""
+        os.makedirs(self.directorio, exist_ok=True)
+        por_particion = {}
+        for cuenta in cuentas:
+            por_particion.setdefault(cuenta['timestamps']['pago'][:7], []).append(cuenta)
+        
+        with bloqueo_archivo(os.path.join(self.directorio, 'indice.lock')):
+            entradas = {e['id']: e for e in self.indice.obtener()}
+            for particion, nuevas in sorted(por_particion.items()):
+                ids = {c['id'] for c in nuevas}
+                try:
+                    existentes = [c for c in decodificar_datos(leer_archivo(self._ruta(particion), 'archivo')) if c['id'] not in ids]
+                except FileNotFoundError:
+                    existentes = []
+                escribir_atomico(self._ruta(particion), self.codec.codificar(sorted(existentes + nuevas, key=lambda c: c['id'])), 'archivo')
+                for cuenta in nuevas:
+                    entradas[cuenta['id']] = {
+                        'id': cuenta['id'],
+                        'numero_cuenta': cuenta.get('numero_cuenta'),
+                        'contratista_id': cuenta.get('contratista_id'),
+                        'particion': particion
+                    }
+            self.indice.guardar(sorted(entradas.values(), key=lambda e: e['id']))
+
+    def estadisticas(self):
+        return {'directorio': self.directorio, 'cuentas': self.contar(), 'particiones': len(self.particiones())}
+
+# ==================== BACKEND JSON ====================
+class AlmacenJSON:
+    """Backend por defecto: cuentas en cuentas.json + diario, usuarios en usuarios.json.
+    Los filtros recorren la lista en memoria."""
+
+    def __init__(self, ruta_cuentas='cuentas.json', ruta_diario='cuentas.journal', ruta_usuarios='usuarios.json', normalizar=None,
+                 ruta_archivo='archivo_cuentas', codec=None):
+        self.archivo = ArchivoCuentas(ruta_archivo, codec=codec)
+        self.cuentas = AlmacenCuentasJSON(ruta_cuentas, ruta_diario, normalizar=normalizar, archivo=self.archivo, codec=codec)
+        self.usuarios = CacheArchivoJSON(ruta_usuarios)
+        self._directorio = None
+        self._generacion_directorio = None
+
+    def cargar_cuentas(self):
+        return self.cuentas.obtener()
+
+    def contar_cuentas(self):
+        return len(self.cuentas.obtener())
+
+    def obtener_cuenta(self, cuenta_id):
+        return self.cuentas.obtener_cuenta(cuenta_id)
+
+    def obtener_cuenta_por_numero(self, numero_cuenta):
+        return self.cuentas.obtener_cuenta_por_numero(numero_cuenta)
+
+    def filtrar_cuentas(self, estado=None, contratista_id=None, responsable_id=None, con_historial=True, limite=None):
+        filtros = {'estado': estado, 'contratista_id': contratista_id, 'responsable_id': responsable_id}
+        return self._sin_historial(self.cuentas.filtrar(filtros, limite), con_historial)
+
+    def consultar_cuentas(self, filtros, orden='fecha', descendente=False, limite=50, cursor=None, desplazamiento=0,
+                          con_historial=False):
+        cuentas, clave_siguiente = self.cuentas.consultar(filtros, orden, descendente, limite, cursor, desplazamiento)
+        return self._sin_historial(cuentas, con_historial), clave_siguiente
+
+    @staticmethod
+    def _sin_historial(cuentas, con_historial):
+        """Como en SQLite, sin con_historial las cuentas no traen 'historial' (copias
+        superficiales: las del almacén no se modifican)"""
+        if con_historial:
+            return cuentas
+        return [{clave: valor for clave, valor in cuenta.items() if clave != 'historial'} for cuenta in cuentas]
+
+    def conteo_estados(self, contratista_id=None):
+        return self.cuentas.conteo_estados(contratista_id)
+
+    def buscar_cuentas(self, consulta, filtros, limite=20, desplazamiento=0):
+        return self.cuentas.buscar(consulta, filtros, limite, desplazamiento)
+
+    def reconstruir_contadores(self):
+        return self.cuentas.reconstruir_contadores()
+
+    def guardar_cuenta(self, cuenta):
+        self.cuentas.guardar_cuenta(cuenta)
+
+    def insertar_cuenta(self, cuenta):
+        self.cuentas.insertar_cuenta(cuenta)
+
+    def confirmar(self, modificadas=(), nuevas=(), notificaciones=()):
+        self.cuentas.confirmar(modificadas, nuevas, notificaciones)
+
+    def reclamar_notificaciones(self, ahora, limite, reserva_hasta):
+        return self.cuentas.reclamar_notificaciones(ahora, limite, reserva_hasta)
+
+    def actualizar_notificaciones(self, notificaciones):
+        self.cuentas.actualizar_notificaciones(notificaciones)
+
+    def guardar_cuentas(self, cuentas):
+        self.cuentas.guardar(cuentas)
+
+    def carga_responsables(self):
+        return self.cuentas.carga_responsables()
+
+    def marcar_vencidas(self, ahora):
+        return self.cuentas.marcar_vencidas(ahora)
+
+    def cuentas_vencidas(self, limite=None):
+        return self.cuentas.vencidas(limite)
+
+    def marca_cuentas(self):
+        return self.cuentas.marca()
+
+    def recalcular_plazos(self, ahora):
+        return self.cuentas.recalcular_plazos(ahora)
+
+    def cargar_usuarios(self):
+        # Copia de la lista para que agregar un usuario no altere la caché antes de guardar
+        return list(self.usuarios.obtener())
+
+    def guardar_usuarios(self, usuarios):
+        self.usuarios.guardar(usuarios)
+
+    def directorio_usuarios(self):
+        usuarios = self.usuarios.obtener()
+        if self._generacion_directorio != self.usuarios.generacion:
+            self._directorio = DirectorioUsuarios(usuarios)
+            self._generacion_directorio = self.usuarios.generacion
+        return self._directorio
+
+    def compactar(self):
+        self.cuentas.compactar()
+
+    def migrar_esquema(self):
+        """Las cuentas se migran en memoria al cargarse; compactar las deja así en cuentas.json"""
+        self.cuentas.compactar()
+        return len(self.cuentas.obtener())
+
+    def archivar(self, limite_pago):
+        return self.cuentas.archivar(limite_pago)
+
+    def estadisticas(self):
+        return {'backend': 'json', 'cuentas': self.cuentas.estadisticas(), 'usuarios': self.usuarios.estadisticas(),
+                'archivo_pagadas': self.archivo.estadisticas()}
+
+# ==================== BACKEND SQLITE ====================
+ESQUEMA_SQLITE = """
+CREATE TABLE IF NOT EXISTS cuentas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    version INTEGER NOT NULL DEFAULT 0,
+    numero_cuenta TEXT UNIQUE,
+    contratista_id INTEGER,
+    estado_actual TEXT NOT NULL,
+    responsable_actual INTEGER,
+    valor REAL,
+    fecha_radicacion TEXT,
+    fecha_limite TEXT,
+    vencida INTEGER NOT NULL DEFAULT 0,
+    datos TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cuentas_estado ON cuentas (estado_actual);
+CREATE INDEX IF NOT EXISTS idx_cuentas_contratista ON cuentas (contratista_id, estado_actual);
+CREATE INDEX IF NOT EXISTS idx_cuentas_responsable ON cuentas (responsable_actual);
+CREATE INDEX IF NOT EXISTS idx_cuentas_fecha ON cuentas (fecha_radicacion, id);
+CREATE INDEX IF NOT EXISTS idx_cuentas_valor ON cuentas (valor, id);
+CREATE INDEX IF NOT EXISTS idx_cuentas_estado_fecha ON cuentas (estado_actual, fecha_radicacion, id);
+
+CREATE TABLE IF NOT EXISTS historial (
+    cuenta_id INTEGER NOT NULL REFERENCES cuentas (id) ON DELETE CASCADE,
+    orden INTEGER NOT NULL,
+    datos TEXT NOT NULL,
+    PRIMARY KEY (cuenta_id, orden)
+);
+
+CREATE TABLE IF NOT EXISTS usuarios (
+    id INTEGER PRIMARY KEY,
+    username TEXT UNIQUE,
+    rol TEXT,
+    dependencia TEXT,
+    activo INTEGER NOT NULL DEFAULT 1,
+    datos TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_usuarios_rol ON usuarios (rol, dependencia, activo);
+
+-- Texto de búsqueda de cada cuenta (rowid = id de la cuenta), sin tildes ni mayúsculas
+CREATE VIRTUAL TABLE IF NOT EXISTS texto_cuentas USING fts5 (
+    numeros, contratista, descripcion, comentarios,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- Bandeja de salida de notificaciones por correo, escrita en la transacción de la cuenta
+-- que las origina; las enviadas se borran y las fallidas se conservan para revisarlas
+CREATE TABLE IF NOT EXISTS notificaciones (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    estado TEXT NOT NULL DEFAULT 'pendiente',
+    proximo_intento TEXT NOT NULL,
+    datos TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_notificaciones_pendientes ON notificaciones (estado, proximo_intento);
+
+CREATE TABLE IF NOT EXISTS metadatos (
+    clave TEXT PRIMARY KEY,
+    valor INTEGER NOT NULL
+);
+
+-- Contador de cambios en cuentas (ETag de la API), mantenido por triggers
+INSERT OR IGNORE INTO metadatos (clave, valor) VALUES ('version_cuentas', 0);
+CREATE TRIGGER IF NOT EXISTS trg_version_cuentas_insert AFTER INSERT ON cuentas
+BEGIN
+    UPDATE metadatos SET valor = valor + 1 WHERE clave = 'version_cuentas';
+END;
+CREATE TRIGGER IF NOT EXISTS trg_version_cuentas_update AFTER UPDATE ON cuentas
+BEGIN
+    UPDATE metadatos SET valor = valor + 1 WHERE clave = 'version_cuentas';
+END;
+CREATE TRIGGER IF NOT EXISTS trg_version_cuentas_delete AFTER DELETE ON cuentas
+BEGIN
+    UPDATE metadatos SET valor = valor + 1 WHERE clave = 'version_cuentas';
+END;
+
+-- Cuentas en revisión por responsable, mantenidas por triggers
+CREATE TABLE IF NOT EXISTS carga_responsables (
+    responsable_id INTEGER PRIMARY KEY,
+    pendientes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS trg_carga_insert AFTER INSERT ON cuentas
+WHEN NEW.responsable_actual IS NOT NULL
+  AND NEW.estado_actual IN ('revision_epb', 'revision_supervisor', 'revision_general', 'revision_hacienda')
+BEGIN
+    INSERT INTO carga_responsables (responsable_id, pendientes) VALUES (NEW.responsable_actual, 1)
+    ON CONFLICT (responsable_id) DO UPDATE SET pendientes = pendientes + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_carga_delete AFTER DELETE ON cuentas
+WHEN OLD.estado_actual IN ('revision_epb', 'revision_supervisor', 'revision_general', 'revision_hacienda')
+BEGIN
+    UPDATE carga_responsables SET pendientes = pendientes - 1 WHERE responsable_id IS OLD.responsable_actual;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_carga_update AFTER UPDATE OF estado_actual, responsable_actual ON cuentas
+BEGIN
+    UPDATE carga_responsables SET pendientes = pendientes - 1
+    WHERE responsable_id IS OLD.responsable_actual
+      AND OLD.estado_actual IN ('revision_epb', 'revision_supervisor', 'revision_general', 'revision_hacienda');
+    INSERT INTO carga_responsables (responsable_id, pendientes)
+    SELECT NEW.responsable_actual, 1
+    WHERE NEW.responsable_actual IS NOT NULL
+      AND NEW.estado_actual IN ('revision_epb', 'revision_supervisor', 'revision_general', 'revision_hacienda')
+    ON CONFLICT (responsable_id) DO UPDATE SET pendientes = pendientes + 1;
+END;
+
+-- Cuentas por estado y contratista (contratista_id = 0: todas), mantenidas por triggers
+CREATE TABLE IF NOT EXISTS conteo_estados (
+    contratista_id INTEGER NOT NULL,
+    estado TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (contratista_id, estado)
+);
+CREATE TRIGGER IF NOT EXISTS trg_conteo_insert AFTER INSERT ON cuentas
+BEGIN
+    INSERT INTO conteo_estados (contratista_id, estado, total)
+    SELECT id_ambito, NEW.estado_actual, 1 FROM (SELECT 0 AS id_ambito UNION ALL SELECT NEW.contratista_id) WHERE id_ambito IS NOT NULL
+    ON CONFLICT (contratista_id, estado) DO UPDATE SET total = total + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_conteo_delete AFTER DELETE ON cuentas
+BEGIN
+    UPDATE conteo_estados SET total = total - 1
+    WHERE contratista_id IN (0, OLD.contratista_id) AND estado = OLD.estado_actual;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_conteo_update AFTER UPDATE OF estado_actual, contratista_id ON cuentas
+BEGIN
+    UPDATE conteo_estados SET total = total - 1
+    WHERE contratista_id IN (0, OLD.contratista_id) AND estado = OLD.estado_actual;
+    INSERT INTO conteo_estados (contratista_id, estado, total)
+    SELECT id_ambito, NEW.estado_actual, 1 FROM (SELECT 0 AS id_ambito UNION ALL SELECT NEW.contratista_id) WHERE id_ambito IS NOT NULL
+    ON CONFLICT (contratista_id, estado) DO UPDATE SET total = total + 1;
+END;
+"""
+
+# Columnas agregadas después de la primera versión del esquema (se añaden a bases existentes)
+COLUMNAS_AGREGADAS_SQLITE = {
+    'fecha_limite': 'TEXT',
+    'vencida': 'INTEGER NOT NULL DEFAULT 0'
+}
+
+# Condición SQL de cada filtro de leer_filtros_cuentas
+CONDICIONES_FILTROS_SQLITE = (
+    ('estado', 'estado_actual = ?'), ('contratista_id', 'contratista_id = ?'), ('responsable_id', 'responsable_actual = ?'),
+    ('desde', 'fecha_radicacion >= ?'), ('hasta', 'fecha_radicacion <= ?'), ('valor_min', 'valor >= ?'), ('valor_max', 'valor <= ?')
+)
+
+class AlmacenSQLite:
+    """Backend SQLite en modo WAL. Las columnas usadas por los filtros de las vistas
+    están indexadas; el resto de la cuenta se guarda como JSON en la columna datos
+    y el historial va en una tabla hija (solo se insertan los movimientos nuevos)."""
+
+    def __init__(self, ruta, normalizar=None, ruta_archivo='archivo_cuentas', codec=None):
+        self.ruta = ruta
+        self.normalizar = normalizar
+        self.archivo = ArchivoCuentas(ruta_archivo, codec=codec)
+        self._local = threading.local()
+        self._directorio = None
+        self._version_directorio = None
+        self._conexion()
+
+    def _conexion(self):
+        # sqlite3 no comparte conexiones entre hilos: una por hilo
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            con.row_factory = sqlite3.Row
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            con.execute('PRAGMA foreign_keys=ON')
+            con.executescript(ESQUEMA_SQLITE)
+            self._migrar_esquema(con)
+            self._local.con = con
+        return con
+
+    def _version_esquema(self, con):
+        fila = con.execute("SELECT valor FROM metadatos WHERE clave = 'version_esquema'").fetchone()
+        return fila[0] if fila else 1
+
+    def _migrar_esquema(self, con):
+        """Actualiza una base creada con un esquema anterior: agrega las columnas nuevas y
+        reescribe las cuentas con migrar_cuenta. Solo trabaja la primera vez; la base
+        registra su versión en metadatos."""
+        existentes = {fila['name'] for fila in con.execute('PRAGMA table_info(cuentas)')}
+        faltantes = [c for c in COLUMNAS_AGREGADAS_SQLITE if c not in existentes]
+        if faltantes or self._version_esquema(con) < VERSION_ESQUEMA_CUENTAS:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                # Otro proceso pudo migrar mientras se esperaba el bloqueo
+                existentes = {fila['name'] for fila in con.execute('PRAGMA table_info(cuentas)')}
+                for columna in faltantes:
+                    if columna not in existentes:
+                        con.execute(f'ALTER TABLE cuentas ADD COLUMN {columna} {COLUMNAS_AGREGADAS_SQLITE[columna]}')
+                if self._version_esquema(con) < VERSION_ESQUEMA_CUENTAS:
+                    self._migrar_cuentas(con)
+                if 'fecha_limite' in faltantes:
+                    self._calcular_plazos(con, datetime.now().strftime(FORMATO_FECHA))
+                con.execute(
+                    """INSERT INTO metadatos (clave, valor) VALUES ('version_esquema', ?)
+                       ON CONFLICT (clave) DO UPDATE SET valor = excluded.valor""",
+                    (VERSION_ESQUEMA_CUENTAS,)
+                )
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+            con.execute('COMMIT')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_cuentas_plazo ON cuentas (vencida, fecha_limite)')
+        if self._falta_indexar_texto(con):
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                if self._falta_indexar_texto(con):
+                    self._indexar_texto(con, [json.loads(fila['datos']) for fila in con.execute('SELECT datos FROM cuentas')])
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+            con.execute('COMMIT')
+
+    def _falta_indexar_texto(self, con):
+        """Base con cuentas creada antes de la búsqueda de texto"""
+        return (con.execute('SELECT 1 FROM cuentas LIMIT 1').fetchone() is not None
+                and con.execute('SELECT 1 FROM texto_cuentas LIMIT 1').fetchone() is None)
+
+    def _borrar_texto(self, con, ids):
+        for i in range(0, len(ids), 900):
+            bloque = ids[i:i + 900]
+            con.execute(f"DELETE FROM texto_cuentas WHERE rowid IN ({','.join('?' * len(bloque))})", bloque)
+
+    def _indexar_texto(self, con, cuentas):
+        """Reemplaza el texto de búsqueda de las cuentas; el historial que no traigan se lee de la base"""
+        sin_historial = [cuenta['id'] for cuenta in cuentas if cuenta.get('historial') is None]
+        historiales = self._historiales(con, sin_historial) if sin_historial else {}
+        filas = []
+        for cuenta in cuentas:
+            if cuenta.get('historial') is None:
+                cuenta = dict(cuenta, historial=historiales.get(cuenta['id'], []))
+            textos = textos_busqueda(cuenta)
+            filas.append((cuenta['id'], *(textos[campo] for campo in CAMPOS_BUSQUEDA)))
+        self._borrar_texto(con, [cuenta['id'] for cuenta in cuentas])
+        con.executemany(
+            f"INSERT INTO texto_cuentas (rowid, {', '.join(CAMPOS_BUSQUEDA)}) VALUES (?, ?, ?, ?, ?)", filas
+        )
+
+    def _migrar_cuentas(self, con):
+        historiales = {}
+        for fila in con.execute('SELECT cuenta_id, orden, datos FROM historial ORDER BY cuenta_id, orden').fetchall():
+            movimiento = json.loads(fila['datos'])
+            historiales.setdefault(fila['cuenta_id'], []).append(movimiento)
+            if 'epoch' not in movimiento and movimiento.get('timestamp'):
+                movimiento['epoch'] = epoch_de(movimiento['timestamp'])
+                con.execute('UPDATE historial SET datos = ? WHERE cuenta_id = ? AND orden = ?',
+                            (json.dumps(movimiento, ensure_ascii=False), fila['cuenta_id'], fila['orden']))
+        for fila in con.execute('SELECT id, datos FROM cuentas').fetchall():
+            cuenta = json.loads(fila['datos'])
+            if 'estado_actual' not in cuenta:
+                continue
+            cuenta['historial'] = historiales.get(fila['id'], [])
+            migrar_cuenta(cuenta)
+            del cuenta['historial']
+            con.execute('UPDATE cuentas SET datos = ? WHERE id = ?', (json.dumps(cuenta, ensure_ascii=False), fila['id']))
+
+    def _calcular_plazos(self, con, ahora):
+        """Recalcula fecha_limite y vencida de las cuentas; devuelve cuántas cambiaron"""
+        cambiadas = 0
+        for fila in con.execute('SELECT id, datos FROM cuentas').fetchall():
+            cuenta = json.loads(fila['datos'])
+            if 'estado_actual' not in cuenta:
+                continue
+            anterior = (cuenta.get('fecha_limite'), cuenta.get('vencida'))
+            actualizar_plazo(cuenta, ahora)
+            if (cuenta['fecha_limite'], cuenta['vencida']) == anterior:
+                continue
+            con.execute(
+                'UPDATE cuentas SET fecha_limite = ?, vencida = ?, datos = ? WHERE id = ?',
+                (cuenta['fecha_limite'], int(cuenta['vencida']), json.dumps(cuenta, ensure_ascii=False), fila['id'])
+            )
+            cambiadas += 1
+        return cambiadas
+
+    def recalcular_plazos(self, ahora):
+        with self._transaccion() as con:
+            return self._calcular_plazos(con, ahora)
+
+    @contextmanager
+    def _transaccion(self):
+        con = self._conexion()
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            yield con
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        con.execute('COMMIT')
+
+    def _historiales(self, con, ids):
+        historiales = {}
+        # Respetar el límite de parámetros de SQLite
+        for i in range(0, len(ids), 900):
+            bloque = ids[i:i + 900]
+            marcas = ','.join('?' * len(bloque))
+            for fila in con.execute(
+                f'SELECT cuenta_id, datos FROM historial WHERE cuenta_id IN ({marcas}) ORDER BY cuenta_id, orden', bloque
+            ):
+                historiales.setdefault(fila['cuenta_id'], []).append(json.loads(fila['datos']))
+        return historiales
+
+    def _consultar(self, condicion='', parametros=(), con_historial=True, limite=None, orden='id', desplazamiento=0):
+        con = self._conexion()
+        condicion += f' ORDER BY {orden}'
+        if limite is not None:
+            condicion += f' LIMIT {int(limite)} OFFSET {int(desplazamiento)}'
+        filas = con.execute(f'SELECT id, datos FROM cuentas {condicion}', parametros).fetchall()
+        cuentas = [json.loads(fila['datos']) for fila in filas]
+        if con_historial:
+            historiales = self._historiales(con, [fila['id'] for fila in filas])
+            for cuenta in cuentas:
+                cuenta['historial'] = historiales.get(cuenta['id'], [])
+        if self.normalizar:
+            self.normalizar(cuentas)
+        return cuentas
+
+    def cargar_cuentas(self):
+        return self._consultar()
+
+    def contar_cuentas(self):
+        return self._conexion().execute('SELECT COUNT(*) FROM cuentas').fetchone()[0]
+
+    def obtener_cuenta(self, cuenta_id):
+        cuentas = self._consultar('WHERE id = ?', (cuenta_id,))
+        return cuentas[0] if cuentas else None
+
+    def obtener_cuenta_por_numero(self, numero_cuenta):
+        cuentas = self._consultar('WHERE numero_cuenta = ?', (numero_cuenta,))
+        return cuentas[0] if cuentas else None
+
+    def filtrar_cuentas(self, estado=None, contratista_id=None, responsable_id=None, con_historial=True, limite=None):
+        condiciones, parametros = [], []
+        for columna, valor in (('estado_actual', estado), ('contratista_id', contratista_id), ('responsable_actual', responsable_id)):
+            if valor is not None:
+                condiciones.append(f'{columna} = ?')
+                parametros.append(valor)
+        condicion = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+        return self._consultar(condicion, parametros, con_historial, limite)
+
+    def consultar_cuentas(self, filtros, orden='fecha', descendente=False, limite=50, cursor=None, desplazamiento=0,
+                          con_historial=False):
+        """Página de cuentas con paginación por cursor sobre los índices (columna, id)"""
+        columna = {'fecha': 'fecha_radicacion', 'valor': 'valor'}[orden]
+        condiciones, parametros = [], []
+        for campo, sql in CONDICIONES_FILTROS_SQLITE:
+            if filtros.get(campo) is not None:
+                condiciones.append(sql)
+                parametros.append(filtros[campo])
+        if cursor is not None:
+            condiciones.append(f"({columna}, id) {'<' if descendente else '>'} (?, ?)")
+            parametros.extend(cursor)
+        
+        direccion = 'DESC' if descendente else 'ASC'
+        condicion = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+        cuentas = self._consultar(condicion, parametros, con_historial=con_historial, limite=limite + 1,
+                                  orden=f'{columna} {direccion}, id {direccion}', desplazamiento=desplazamiento)
+        if len(cuentas) > limite:
+            return cuentas[:limite], CLAVES_ORDEN[orden](cuentas[limite - 1])
+        return cuentas, None
+
+    def buscar_cuentas(self, consulta, filtros, limite=20, desplazamiento=0):
+        """Página de cuentas que coinciden con la consulta en texto_cuentas (FTS5), ordenada
+        por bm25 con los pesos de CAMPOS_BUSQUEDA, y el total de coincidencias"""
+        terminos = terminos_consulta(consulta)
+        if not terminos:
+            return [], 0
+        # Los términos solo tienen letras y dígitos: entre comillas no alteran la sintaxis de MATCH
+        expresion = ' '.join(f'"{termino}"' for termino in terminos)
+        if len(terminos[-1]) >= PREFIJO_MINIMO:
+            expresion += '*'
+        condiciones, parametros = ['texto_cuentas MATCH ?'], [expresion]
+        for campo, sql in CONDICIONES_FILTROS_SQLITE:
+            if filtros.get(campo) is not None:
+                condiciones.append(sql)
+                parametros.append(filtros[campo])
+        
+        con = self._conexion()
+        origen = f"FROM texto_cuentas JOIN cuentas ON cuentas.id = texto_cuentas.rowid WHERE {' AND '.join(condiciones)}"
+        total = con.execute(f'SELECT COUNT(*) {origen}', parametros).fetchone()[0]
+        pesos = ', '.join(str(peso) for peso in CAMPOS_BUSQUEDA.values())
+        filas = con.execute(
+            f'SELECT cuentas.datos {origen} ORDER BY bm25(texto_cuentas, {pesos}), cuentas.id DESC LIMIT ? OFFSET ?',
+            parametros + [int(limite), int(desplazamiento)]
+        ).fetchall()
+        cuentas = [json.loads(fila['datos']) for fila in filas]
+        if self.normalizar:
+            self.normalizar(cuentas)
+        return cuentas, total
+
+    def conteo_estados(self, contratista_id=None):
+        conteo = dict.fromkeys(ESTADOS_FLUJO, 0)
+        for fila in self._conexion().execute(
+            'SELECT estado, total FROM conteo_estados WHERE contratista_id = ?', (contratista_id or 0,)
+        ):
+            conteo[fila['estado']] = fila['total']
+        return conteo
+
+    def _leer_contadores(self, con):
+        return {
+            'conteo': {
+                (fila[0] or None, fila[1]): fila[2]
+                for fila in con.execute('SELECT contratista_id, estado, total FROM conteo_estados')
+            },
+            'carga': dict(con.execute('SELECT responsable_id, pendientes FROM carga_responsables').fetchall())
+        }
+
+    def reconstruir_contadores(self):
+        """Recalcula las tablas de contadores desde cero y devuelve las diferencias con las mantenidas"""
+        estados_revision = ','.join('?' * len(ESTADOS_EN_REVISION))
+        with self._transaccion() as con:
+            antes = self._leer_contadores(con)
+            con.execute('DELETE FROM conteo_estados')
+            con.execute(
+                """INSERT INTO conteo_estados (contratista_id, estado, total)
+                   SELECT 0, estado_actual, COUNT(*) FROM cuentas GROUP BY estado_actual
+                   UNION ALL
+                   SELECT contratista_id, estado_actual, COUNT(*) FROM cuentas
+                   WHERE contratista_id IS NOT NULL GROUP BY contratista_id, estado_actual"""
+            )
+            con.execute('DELETE FROM carga_responsables')
+            con.execute(
+                f"""INSERT INTO carga_responsables (responsable_id, pendientes)
+                    SELECT responsable_actual, COUNT(*) FROM cuentas
+                    WHERE responsable_actual IS NOT NULL AND estado_actual IN ({estados_revision})
+                    GROUP BY responsable_actual""",
+                ESTADOS_EN_REVISION
+            )
+            despues = self._leer_contadores(con)
+        return diferencias_contadores(antes, despues)
+
+    def _escribir_cuenta(self, con, cuenta):
+        datos = {k: v for k, v in cuenta.items() if k != 'historial'}
+        con.execute(
+            """INSERT INTO cuentas (id, version, numero_cuenta, contratista_id, estado_actual, responsable_actual, valor, fecha_radicacion,
+                                   fecha_limite, vencida, datos)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET
+                   version = excluded.version,
+                   numero_cuenta = excluded.numero_cuenta,
+                   contratista_id = excluded.contratista_id,
+                   estado_actual = excluded.estado_actual,
+                   responsable_actual = excluded.responsable_actual,
+                   valor = excluded.valor,
+                   fecha_radicacion = excluded.fecha_radicacion,
+                   fecha_limite = excluded.fecha_limite,
+                   vencida = excluded.vencida,
+                   datos = excluded.datos""",
+            (cuenta['id'], cuenta.get('version', 0), cuenta.get('numero_cuenta'), cuenta.get('contratista_id'), cuenta['estado_actual'],
+             cuenta.get('responsable_actual'), float(cuenta.get('valor') or 0), cuenta.get('timestamps', {}).get('radicacion') or '',
+             cuenta.get('fecha_limite'), int(bool(cuenta.get('vencida'))), json.dumps(datos, ensure_ascii=False))
+        )
+        
+        self._escribir_historial(con, cuenta)
+
+    def _escribir_historial(self, con, cuenta):
+        # El historial solo crece: insertar los movimientos que aún no están guardados
+        historial = cuenta.get('historial')
+        if historial is not None:
+            existentes = con.execute('SELECT COUNT(*) FROM historial WHERE cuenta_id = ?', (cuenta['id'],)).fetchone()[0]
+            con.executemany(
+                'INSERT INTO historial (cuenta_id, orden, datos) VALUES (?, ?, ?)',
+                [(cuenta['id'], i, json.dumps(mov, ensure_ascii=False)) for i, mov in enumerate(historial) if i >= existentes]
+            )
+
+    def guardar_cuenta(self, cuenta):
+        self.confirmar(modificadas=[cuenta])
+
+    def insertar_cuenta(self, cuenta):
+        self.confirmar(nuevas=[cuenta])
+
+    def confirmar(self, modificadas=(), nuevas=(), notificaciones=()):
+        """Confirma cuentas modificadas y nuevas, y las notificaciones que originan, en una
+        transacción. Cada UPDATE exige que la versión guardada siga siendo la leída
+        (compare-and-swap); los ids nuevos los asigna AUTOINCREMENT, que nunca reutiliza valores."""
+        modificadas, nuevas = list(modificadas), list(nuevas)
+        with versiones_provisionales(modificadas) as anteriores, self._transaccion() as con:
+            for cuenta in modificadas + nuevas:
+                preparar_cuenta(cuenta)
+            for cuenta, version in zip(modificadas, anteriores):
+                datos = {k: v for k, v in cuenta.items() if k != 'historial'}
+                cursor = con.execute(
+                    """UPDATE cuentas SET version = ?, estado_actual = ?, responsable_actual = ?, fecha_limite = ?, vencida = ?, datos = ?
+                       WHERE id = ? AND version = ?""",
+                    (cuenta['version'], cuenta['estado_actual'], cuenta.get('responsable_actual'), cuenta['fecha_limite'],
+                     int(cuenta['vencida']), json.dumps(datos, ensure_ascii=False), cuenta['id'], version)
+                )
+                if cursor.rowcount == 0:
+                    raise ConflictoVersion(cuenta['id'])
+                self._escribir_historial(con, cuenta)
+            
+            for cuenta in nuevas:
+                cursor = con.execute("INSERT INTO cuentas (estado_actual, datos) VALUES (?, '{}')", (cuenta['estado_actual'],))
+                asignar_identificacion(cuenta, cursor.lastrowid)
+                try:
+                    self._escribir_cuenta(con, cuenta)
+                except sqlite3.IntegrityError:
+                    raise NumeroCuentaDuplicado(cuenta['numero_cuenta'])
+            self._indexar_texto(con, modificadas + nuevas)
+            self._insertar_notificaciones(con, notificaciones)
+
+    def _insertar_notificaciones(self, con, notificaciones):
+        for notificacion in notificaciones:
+            datos = {k: v for k, v in notificacion.items() if k not in ('id', 'estado', 'proximo_intento')}
+            cursor = con.execute(
+                'INSERT INTO notificaciones (estado, proximo_intento, datos) VALUES (?, ?, ?)',
+                (notificacion['estado'], notificacion['proximo_intento'], json.dumps(datos, ensure_ascii=False))
+            )
+            notificacion['id'] = cursor.lastrowid
+
+    def reclamar_notificaciones(self, ahora, limite, reserva_hasta):
+        """Reserva hasta reserva_hasta las notificaciones pendientes cuyo intento ya venció
+        (las más antiguas primero), para que ningún otro proceso las envíe entretanto"""
+        with self._transaccion() as con:
+            filas = con.execute(
+                """SELECT id, estado, datos FROM notificaciones WHERE estado = 'pendiente' AND proximo_intento <= ?
+                   ORDER BY proximo_intento, id LIMIT ?""",
+                (ahora, int(limite))
+            ).fetchall()
+            con.executemany('UPDATE notificaciones SET proximo_intento = ? WHERE id = ?', [(reserva_hasta, fila['id']) for fila in filas])
+        return [dict(json.loads(fila['datos']), id=fila['id'], estado=fila['estado'], proximo_intento=reserva_hasta) for fila in filas]
+
+    def actualizar_notificaciones(self, notificaciones):
+        """Registra el resultado de los envíos: las enviadas se borran y el resto se reprograma"""
+        with self._transaccion() as con:
+            for notificacion in notificaciones:
+                if notificacion['estado'] == 'enviada':
+                    con.execute('DELETE FROM notificaciones WHERE id = ?', (notificacion['id'],))
+                    continue
+                datos = {k: v for k, v in notificacion.items() if k not in ('id', 'estado', 'proximo_intento')}
+                con.execute(
+                    'UPDATE notificaciones SET estado = ?, proximo_intento = ?, datos = ? WHERE id = ?',
+                    (notificacion['estado'], notificacion['proximo_intento'], json.dumps(datos, ensure_ascii=False), notificacion['id'])
+                )
+
+    def guardar_cuentas(self, cuentas):
+        with self._transaccion() as con:
+            con.execute('DELETE FROM historial')
+            con.execute('DELETE FROM cuentas')
+            con.execute('DELETE FROM texto_cuentas')
+            for cuenta in cuentas:
+                self._escribir_cuenta(con, cuenta)
+            self._indexar_texto(con, cuentas)
+            # AUTOINCREMENT no debe volver a entregar ids que ya están en el archivo
+            ultimo_archivado = self.archivo.ultimo_id()
+            if ultimo_archivado:
+                if not con.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'cuentas'", (ultimo_archivado,)).rowcount:
+                    con.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('cuentas', ?)", (ultimo_archivado,))
+
+    def archivar(self, limite_pago):
+        """Pasa al archivo las cuentas pagadas antes de limite_pago y borra sus filas (el
+        historial se borra en cascada) en la misma transacción. AUTOINCREMENT garantiza que
+        sus ids no se vuelvan a asignar."""
+        with self._transaccion() as con:
+            pagadas = self._consultar("WHERE estado_actual = 'pagado'")
+            archivables = [c for c in pagadas if cuenta_archivable(c, limite_pago)]
+            if archivables:
+                self.archivo.agregar(archivables)
+                ids = [c['id'] for c in archivables]
+                for i in range(0, len(ids), 900):
+                    bloque = ids[i:i + 900]
+                    con.execute(f"DELETE FROM cuentas WHERE id IN ({','.join('?' * len(bloque))})", bloque)
+                self._borrar_texto(con, ids)
+        return len(archivables)
+
+    def marcar_vencidas(self, ahora):
+        """Marca las cuentas con plazo vencido usando el índice (vencida, fecha_limite);
+        no cambia su versión porque vencida se deriva del plazo"""
+        with self._transaccion() as con:
+            filas = con.execute(
+                'SELECT id, datos FROM cuentas WHERE vencida = 0 AND fecha_limite <= ?', (ahora,)
+            ).fetchall()
+            for fila in filas:
+                datos = dict(json.loads(fila['datos']), vencida=True)
+                con.execute('UPDATE cuentas SET vencida = 1, datos = ? WHERE id = ?', (json.dumps(datos, ensure_ascii=False), fila['id']))
+        return [fila['id'] for fila in filas]
+
+    def marca_cuentas(self):
+        fila = self._conexion().execute("SELECT valor FROM metadatos WHERE clave = 'version_cuentas'").fetchone()
+        return str(fila[0] if fila else 0)
+
+    def cuentas_vencidas(self, limite=None):
+        return self._consultar('WHERE vencida = 1', con_historial=False, limite=limite, orden='fecha_limite, id')
+
+    def cargar_usuarios(self):
+        return [json.loads(fila['datos']) for fila in self._conexion().execute('SELECT datos FROM usuarios ORDER BY id')]
+
+    def carga_responsables(self):
+        return {
+            fila['responsable_id']: fila['pendientes']
+            for fila in self._conexion().execute('SELECT responsable_id, pendientes FROM carga_responsables')
+        }
+
+    def _version_usuarios(self):
+        fila = self._conexion().execute("SELECT valor FROM metadatos WHERE clave = 'version_usuarios'").fetchone()
+        return fila[0] if fila else 0
+
+    def directorio_usuarios(self):
+        version = self._version_usuarios()
+        if self._directorio is None or version != self._version_directorio:
+            self._directorio = DirectorioUsuarios(self.cargar_usuarios())
+            self._version_directorio = version
+        return self._directorio
+
+    def guardar_usuarios(self, usuarios):
+        with self._transaccion() as con:
+            con.execute(
+                """INSERT INTO metadatos (clave, valor) VALUES ('version_usuarios', 1)
+                   ON CONFLICT (clave) DO UPDATE SET valor = valor + 1"""
+            )
+            con.execute('DELETE FROM usuarios')
+            con.executemany(
+                'INSERT INTO usuarios (id, username, rol, dependencia, activo, datos) VALUES (?, ?, ?, ?, ?, ?)',
+                [(u['id'], u.get('username'), u.get('rol'), u.get('dependencia'), int(u.get('activo', True)),
+                  json.dumps(u, ensure_ascii=False)) for u in usuarios]
+            )
+
+    def compactar(self):
+        self._conexion().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def migrar_esquema(self):
+        """La migración se hace al abrir la conexión; aquí solo se informa el total"""
+        return self.contar_cuentas()
+
+    def estadisticas(self):
+        con = self._conexion()
+        return {
+            'backend': 'sqlite',
+            'ruta': self.ruta,
+            'cuentas': con.execute('SELECT COUNT(*) FROM cuentas').fetchone()[0],
+            'usuarios': con.execute('SELECT COUNT(*) FROM usuarios').fetchone()[0],
+            'notificaciones_pendientes': con.execute("SELECT COUNT(*) FROM notificaciones WHERE estado = 'pendiente'").fetchone()[0],
+            'archivo_pagadas': self.archivo.estadisticas()
+        }
+
 # ==================== FUNCIONES DE BASE DE DATOS ====================
+def normalizar_cuentas(cuentas):
+    # Asegurar que todas las cuentas tengan campos nuevos
+    for cuenta in cuentas:
+        cuenta.setdefault('alertas', [])
+        cuenta.setdefault('dias_por_etapa', {})
+        cuenta.setdefault('version', 0)
+        if cuenta.get('esquema', 1) < VERSION_ESQUEMA_CUENTAS:
+            migrar_cuenta(cuenta)
+        if 'fecha_limite' not in cuenta:
+            cuenta['fecha_limite'] = calcular_fecha_limite(cuenta)
+            cuenta['vencida'] = False
+
+def crear_almacen(config):
+    backend = config['ALMACEN_BACKEND']
+    codec = crear_codec(config['CODEC_CUENTAS'])
+    if backend == 'json':
+        return AlmacenJSON(normalizar=normalizar_cuentas, ruta_archivo=config['ARCHIVO_CUENTAS'], codec=codec)
+    if backend == 'sqlite':
+        # En SQLite las filas siguen en JSON; el codec aplica al archivo de pagadas
+        return AlmacenSQLite(config['ALMACEN_SQLITE'], normalizar=normalizar_cuentas, ruta_archivo=config['ARCHIVO_CUENTAS'],
+                             codec=codec)
+    raise ValueError(f'Backend de almacenamiento desconocido: {backend}')
+
+_almacen = None
+_almacen_lock = threading.Lock()
+
+def obtener_almacen():
+    """Backend configurado en app.config['ALMACEN_BACKEND'], creado en el primer uso"""
+    global _almacen
+    if _almacen is None:
+        with _almacen_lock:
+            if _almacen is None:
+                _almacen = crear_almacen(app.config)
+    return _almacen
+
+@medir_almacen
 def cargar_usuarios():
-    if os.path.exists('usuarios.json'):
-        with open('usuarios.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    return obtener_almacen().cargar_usuarios()
+
+def obtener_directorio():
+    """Directorio de usuarios indexado (en caché hasta que cambien los usuarios)"""
+    return obtener_almacen().directorio_usuarios()
 
+@medir_almacen
 def guardar_usuarios(usuarios):
-    with open('usuarios.json', 'w', encoding='utf-8') as f:
-        json.dump(usuarios, f, indent=2, ensure_ascii=False)
+    obtener_almacen().guardar_usuarios(usuarios)
 
+@medir_almacen
 def cargar_cuentas():
-    if os.path.exists('cuentas.json'):
-        with open('cuentas.json', 'r', encoding='utf-8') as f:
-            cuentas = json.load(f)
-            # Asegurar que todas las cuentas tengan campos nuevos
-            for cuenta in cuentas:
-                cuenta.setdefault('alertas', [])
-                cuenta.setdefault('dias_por_etapa', {})
-            return cuentas
-    return []
+    """Devuelve todas las cuentas (con el backend JSON son las de la caché: no modificar sin guardar)"""
+    return obtener_almacen().cargar_cuentas()
+
+@medir_almacen
+def obtener_cuenta(cuenta_id):
+    """Cuenta activa o, si ya se archivó, su copia del archivo de pagadas marcada con
+    'archivada' (solo lectura: guardarla daría ConflictoVersion)"""
+    almacen = obtener_almacen()
+    return almacen.obtener_cuenta(cuenta_id) or marcar_archivada(almacen.archivo.obtener_cuenta(cuenta_id))
+
+@medir_almacen
+def obtener_cuenta_por_numero(numero_cuenta):
+    almacen = obtener_almacen()
+    return (almacen.obtener_cuenta_por_numero(numero_cuenta)
+            or marcar_archivada(almacen.archivo.obtener_cuenta_por_numero(numero_cuenta)))
+
+def marcar_archivada(cuenta):
+    if cuenta is not None:
+        cuenta['archivada'] = True
+    return cuenta
+
+def filtrar_cuentas(**filtros):
+    return obtener_almacen().filtrar_cuentas(**filtros)
+
+@medir_almacen
+def consultar_cuentas(filtros, orden='fecha', descendente=False, limite=50, cursor=None, desplazamiento=0,
+                      con_historial=False):
+    """Página de cuentas: devuelve (cuentas, clave_siguiente o None)"""
+    return obtener_almacen().consultar_cuentas(filtros, orden, descendente, limite, cursor, desplazamiento,
+                                               con_historial)
 
+@medir_almacen
+def buscar_cuentas(consulta, filtros, limite=20, desplazamiento=0):
+    """Cuentas activas (no archivadas) con las palabras de la consulta por relevancia: (página, total)"""
+    return obtener_almacen().buscar_cuentas(consulta, filtros, limite, desplazamiento)
+
+def iterar_cuentas(filtros, orden='fecha', con_historial=False, bloque=500):
+    """Recorre todas las cuentas filtradas por páginas con cursor, sin cargarlas a la vez"""
+    cursor = None
+    while True:
+        cuentas, cursor = consultar_cuentas(filtros, orden, limite=bloque, cursor=cursor,
+                                            con_historial=con_historial)
+        yield from cuentas
+        if cursor is None:
+            return
+
+def iterar_archivadas(filtros, desde_pago=None, hasta_pago=None):
+    """Cuentas del archivo de pagadas; con fechas de pago solo se leen las particiones del rango"""
+    return obtener_almacen().archivo.iterar(filtros, desde_pago, hasta_pago)
+
+@medir_almacen
+def conteo_estados(contratista_id=None):
+    """Cuentas por estado según los contadores materializados del almacén, más las pagadas archivadas"""
+    almacen = obtener_almacen()
+    conteo = almacen.conteo_estados(contratista_id)
+    conteo['pagado'] = conteo.get('pagado', 0) + almacen.archivo.contar(contratista_id)
+    return conteo
+
+@medir_almacen
 def guardar_cuentas(cuentas):
-    with open('cuentas.json', 'w', encoding='utf-8') as f:
-        json.dump(cuentas, f, indent=2, ensure_ascii=False)
+    """Reescribe todas las cuentas; para cambios puntuales usar guardar_cuenta"""
+    obtener_almacen().guardar_cuentas(cuentas)
+
+@medir_almacen
+def guardar_cuenta(cuenta, notificaciones=()):
+    """Confirma una cuenta modificada (con sus notificaciones); lanza ConflictoVersion si otro
+    la cambió antes"""
+    obtener_almacen().confirmar(modificadas=[cuenta], notificaciones=notificaciones)
+
+@medir_almacen
+def insertar_cuenta(cuenta):
+    """Registra una cuenta nueva asignándole id y número de cuenta"""
+    obtener_almacen().insertar_cuenta(cuenta)
+
+@medir_almacen
+def guardar_lote_cuentas(cuentas, notificaciones=()):
+    """Confirma varias cuentas modificadas juntas; si una cambió entretanto lanza
+    ConflictoVersion con su id y no se guarda ninguna"""
+    obtener_almacen().confirmar(modificadas=cuentas, notificaciones=notificaciones)
+
+@medir_almacen
+def insertar_cuentas(cuentas):
+    """Registra varias cuentas nuevas con una sola escritura (diario o transacción)"""
+    obtener_almacen().confirmar(nuevas=cuentas)
+
+@medir_almacen
+def reclamar_notificaciones(ahora, limite, reserva_hasta):
+    return obtener_almacen().reclamar_notificaciones(ahora, limite, reserva_hasta)
+
+@medir_almacen
+def actualizar_notificaciones(notificaciones):
+    obtener_almacen().actualizar_notificaciones(notificaciones)
+
+def marca_cuentas():
+    """Valor que cambia con cada modificación de cualquier cuenta (para ETags)"""
+    return obtener_almacen().marca_cuentas()
+
+def cuentas_vencidas(limite=None):
+    """Cuentas marcadas como vencidas por el motor de alertas, de la más atrasada a la más reciente"""
+    return obtener_almacen().cuentas_vencidas(limite)
+
+def migrar_json_a_sqlite(ruta_db, ruta_cuentas='cuentas.json', ruta_diario='cuentas.journal', ruta_usuarios='usuarios.json',
+                         ruta_archivo='archivo_cuentas'):
+    """Copia cuentas (instantánea + diario), usuarios y notificaciones sin enviar de los
+    archivos JSON a una base SQLite. El archivo de pagadas lo comparten ambos backends y no se copia."""
+    origen = AlmacenJSON(ruta_cuentas, ruta_diario, ruta_usuarios, normalizar=normalizar_cuentas, ruta_archivo=ruta_archivo)
+    destino = AlmacenSQLite(ruta_db, ruta_archivo=ruta_archivo)
+    cuentas = origen.cargar_cuentas()
+    usuarios = origen.cargar_usuarios()
+    destino.guardar_cuentas(cuentas)
+    destino.guardar_usuarios(usuarios)
+    with destino._transaccion() as con:
+        destino._insertar_notificaciones(con, [dict(n) for n in origen.cuentas._notificaciones.values()])
+    return len(cuentas), len(usuarios)
+
+# ==================== CALENDARIO DE DÍAS HÁBILES ====================
+# Festivos de Colombia (Ley 51 de 1983): fijos, trasladados al lunes siguiente (Ley Emiliani)
+# y los que dependen de la Pascua, como desplazamiento en días desde el domingo de Pascua
+FESTIVOS_FIJOS = [(1, 1), (5, 1), (7, 20), (8, 7), (12, 8), (12, 25)]
+FESTIVOS_TRASLADABLES = [(1, 6), (3, 19), (6, 29), (8, 15), (10, 12), (11, 1), (11, 11)]
+FESTIVOS_PASCUA = [-3, -2, 43, 64, 71]  # Jueves y Viernes Santo, Ascensión, Corpus Christi, Sagrado Corazón
+
+def domingo_de_pascua(anio):
+    """Algoritmo de Meeus/Jones/Butcher para el calendario gregoriano"""
+    a, b, c = anio % 19, anio // 100, anio % 100
+    d, e = divmod(b, 4)
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 19 * l) // 433
+    mes = (h + l - 7 * m + 90) // 25
+    dia = (h + l - 7 * m + 33 * mes + 19) % 32
+    return date(anio, mes, dia)
+
+def festivos_colombia(anio):
+    festivos = {date(anio, mes, dia) for mes, dia in FESTIVOS_FIJOS}
+    for mes, dia in FESTIVOS_TRASLADABLES:
+        fecha = date(anio, mes, dia)
+        festivos.add(fecha + timedelta(days=(7 - fecha.weekday()) % 7))
+    pascua = domingo_de_pascua(anio)
+    festivos.update(pascua + timedelta(days=desplazamiento) for desplazamiento in FESTIVOS_PASCUA)
+    return festivos
+
+class CalendarioHabil:
+    """Días hábiles (lunes a viernes que no son festivo) de un rango de años, con una
+    suma acumulada por día: contar días hábiles entre dos fechas es una resta y sumar
+    días hábiles una bisección. El rango se amplía solo si llega una fecha fuera de él."""
+
+    def __init__(self, festivos_adicionales=(), anio_inicio=None, anio_fin=None):
+        self.festivos_adicionales = set(festivos_adicionales)
+        hoy = date.today()
+        self._construir(anio_inicio or hoy.year - 2, anio_fin or hoy.year + 2)
+
+    def _construir(self, anio_inicio, anio_fin):
+        festivos = set(self.festivos_adicionales)
+        for anio in range(anio_inicio, anio_fin + 1):
+            festivos |= festivos_colombia(anio)
+        origen = date(anio_inicio, 1, 1)
+        total = (date(anio_fin + 1, 1, 1) - origen).days
+        habiles = [(origen + timedelta(days=i)).weekday() < 5 and origen + timedelta(days=i) not in festivos for i in range(total)]
+        # acumulado[i]: días hábiles en [origen, origen + i)
+        acumulado = [0, *itertools.accumulate(habiles)]
+        # Se reemplaza la tabla completa de una vez para que los demás hilos nunca vean una a medias
+        self._tabla = (origen, anio_inicio, anio_fin, habiles, acumulado)
+
+    def _tabla_para(self, *fechas):
+        tabla = self._tabla
+        _, anio_inicio, anio_fin, _, _ = tabla
+        anios = [f.year for f in fechas]
+        if min(anios) < anio_inicio or max(anios) > anio_fin:
+            self._construir(min(anio_inicio, *anios), max(anio_fin, *anios) + 1)
+            tabla = self._tabla
+        return tabla
+
+    def es_habil(self, fecha):
+        origen, _, _, habiles, _ = self._tabla_para(fecha)
+        return habiles[(fecha - origen).days]
+
+    def dias_habiles(self, inicio, fin):
+        """Días hábiles en (inicio, fin]: los transcurridos desde el día de inicio"""
+        origen, _, _, _, acumulado = self._tabla_para(inicio, fin)
+        return acumulado[(fin - origen).days + 1] - acumulado[(inicio - origen).days + 1]
+
+    def sumar(self, fecha, dias):
+        """Fecha del día hábil número `dias` después de `fecha` (dias >= 1)"""
+        origen, _, anio_fin, _, acumulado = self._tabla_para(fecha)
+        objetivo = acumulado[(fecha - origen).days + 1] + dias
+        if objetivo > acumulado[-1]:
+            origen, _, _, _, acumulado = self._tabla_para(date(anio_fin + 1 + dias // 200, 1, 1))
+        return origen + timedelta(days=bisect.bisect_left(acumulado, objetivo) - 1)
+
+def festivos_configurados(texto):
+    return [date.fromisoformat(valor.strip()) for valor in texto.split(',') if valor.strip()]
+
+calendario = CalendarioHabil(festivos_configurados(app.config['FESTIVOS_ADICIONALES']))
+
+def vencimiento_dias_habiles(momento, dias):
+    """Inicio (medianoche) del primer día en que han pasado más de `dias` días hábiles desde
+    el día de momento, contados como calcular_tiempo_entre_fechas"""
+    return datetime.combine(calendario.sumar(momento.date(), dias + 1), datetime.min.time())
 
 # ==================== FUNCIONES DE CALCULO DE TIEMPOS ====================
 def calcular_tiempo_entre_fechas(fecha_inicio, fecha_fin):
@@ -111,13 +2594,8 @@ def calcular_tiempo_entre_fechas(fecha_inicio, fecha_fin):
     if not fecha_inicio or not fecha_fin:
         return 0
     
-    inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d %H:%M:%S')
-    fin = datetime.strptime(fecha_fin, '%Y-%m-%d %H:%M:%S')
-    
-    # Diferencia en días naturales
-    dias_naturales = (fin - inicio).days
-    
-    return dias_naturales
+    # Solo importa el día: se toma la parte AAAA-MM-DD sin parsear la hora
+    return calendario.dias_habiles(date.fromisoformat(fecha_inicio[:10]), date.fromisoformat(fecha_fin[:10]))
 
 def verificar_alerta_3_dias(cuenta):
     """Verifica si alguna etapa lleva más de 3 días"""
@@ -148,52 +2626,228 @@ def verificar_alerta_3_dias(cuenta):
     
     return alertas
 
+def alertas_plazo(cuenta, ahora):
+    """Alertas según la fecha_limite guardada en la cuenta: no parsea ninguna fecha"""
+    limite = cuenta.get('fecha_limite')
+    if not limite or limite > ahora:
+        return []
+    return [f"{TITULOS_ESTADO[cuenta['estado_actual']]} superó el plazo de {DIAS_MAXIMOS_ETAPA} días hábiles (vencía {limite})"]
+
+# ==================== MOTOR DE ALERTAS ====================
+_motor_alertas = None
+_motor_alertas_lock = threading.Lock()
+
+def revisar_plazos():
+    """Marca como vencidas las cuentas cuyo plazo de etapa ya pasó; devuelve sus ids"""
+    return obtener_almacen().marcar_vencidas(datetime.now().strftime(FORMATO_FECHA))
+
+def iniciar_motor_alertas():
+    """Hilo de fondo (uno por proceso) que revisa los plazos cada INTERVALO_ALERTAS segundos.
+    El almacén solo mira el primer plazo del montículo o del índice, así que cada revisión
+    cuesta lo mismo sin importar cuántas cuentas haya."""
+    global _motor_alertas
+    intervalo = app.config['INTERVALO_ALERTAS']
+    if intervalo <= 0 or _motor_alertas is not None:
+        return
+    with _motor_alertas_lock:
+        if _motor_alertas is not None:
+            return
+        
+        def ciclo():
+            while True:
+                try:
+                    revisar_plazos()
+                except Exception:
+                    app.logger.exception('Error revisando los plazos de las cuentas')
+                time.sleep(intervalo)
+        
+        _motor_alertas = threading.Thread(target=ciclo, name='motor-alertas', daemon=True)
+        _motor_alertas.start()
+
+@app.before_request
+def arrancar_motor_alertas():
+    iniciar_motor_alertas()
+
+# ==================== NOTIFICACIONES POR CORREO ====================
+# Las asignaciones y devoluciones dejan notificaciones en una bandeja de salida que se guarda
+# con la cuenta (misma escritura del diario o misma transacción): no se pierden si el proceso
+# cae y no salen por transiciones que no se guardaron. Un hilo por proceso las reserva por
+# NOTIFICACIONES_RESERVA segundos, envía un correo por destinatario y reprograma las que fallan.
+NOTIFICACIONES_LOTE = 100  # notificaciones reservadas por ronda de envío
+NOTIFICACIONES_RESERVA = 300  # segundos antes de que otro worker retome lo que una ronda no terminó
+NOTIFICACIONES_ESPERA_BASE = 60  # segundos hasta el primer reintento; se duplica en cada fallo
+NOTIFICACIONES_ESPERA_MAXIMA = 3600
+NOTIFICACIONES_INTENTOS_MAXIMO = 8  # después queda 'fallida' en la bandeja
+
+_envio_notificaciones = None
+_envio_notificaciones_lock = threading.Lock()
+
+def nueva_notificacion(destinatario, cuenta, texto, ahora):
+    return {
+        'destinatario_id': destinatario['id'],
+        'nombre': destinatario['nombre'],
+        'email': destinatario['email'],
+        'cuenta_id': cuenta['id'],
+        'numero_cuenta': cuenta.get('numero_cuenta'),
+        'texto': texto,
+        'creada': ahora,
+        'estado': 'pendiente',
+        'proximo_intento': ahora,
+        'intentos': 0,
+        'error': None
+    }
+
+def notificaciones_transicion(cuentas):
+    """Notificaciones del último movimiento de cada cuenta: al responsable asignado en una
+    aprobación y al contratista en una devolución, si tienen correo y hay servidor SMTP"""
+    if not app.config['SMTP_SERVIDOR']:
+        return []
+    directorio = obtener_directorio()
+    ahora = datetime.now().strftime(FORMATO_FECHA)
+    notificaciones = []
+    for cuenta in cuentas:
+        movimiento = cuenta['historial'][-1]
+        destinatario = directorio.obtener(movimiento.get('responsable_id'))
+        if not destinatario or not destinatario.get('email') or not destinatario.get('activo', True):
+            continue
+        if movimiento['accion'] == 'aprobacion':
+            texto = (f"Se le asignó la cuenta {cuenta['numero_cuenta']} de {cuenta['contratista_nombre']} "
+                     f"({TITULOS_ESTADO.get(cuenta['estado_actual'], cuenta['estado_actual'])})")
+        elif movimiento['accion'] == 'devolucion':
+            texto = f"La cuenta {cuenta['numero_cuenta']} fue devuelta por {movimiento['usuario']}: {movimiento['comentario']}"
+        else:
+            continue
+        notificaciones.append(nueva_notificacion(destinatario, cuenta, texto, ahora))
+    return notificaciones
+
+def mensaje_notificaciones(grupo):
+    """Un solo correo con las notificaciones de un destinatario"""
+    mensaje = EmailMessage()
+    mensaje['From'] = app.config['SMTP_REMITENTE']
+    mensaje['To'] = grupo[0]['email']
+    if len(grupo) == 1:
+        mensaje['Subject'] = f"Novedad en la cuenta {grupo[0]['numero_cuenta']}"
+    else:
+        mensaje['Subject'] = f'{len(grupo)} novedades en cuentas de cobro'
+    lineas = [f"Hola {grupo[0]['nombre']}:", ''] + [f"- {n['creada']}  {n['texto']}" for n in grupo]
+    mensaje.set_content('\n'.join(lineas))
+    return mensaje
+
+@contextmanager
+def conexion_smtp():
+    config = app.config
+    with smtplib.SMTP(config['SMTP_SERVIDOR'], config['SMTP_PUERTO'], timeout=30) as smtp:
+        if config['SMTP_STARTTLS']:
+            smtp.starttls()
+        if config['SMTP_USUARIO']:
+            smtp.login(config['SMTP_USUARIO'], config['SMTP_PASSWORD'])
+        yield smtp
+
+def reprogramar_notificacion(notificacion, error, ahora):
+    """Siguiente intento con espera exponencial, o 'fallida' si ya se agotaron"""
+    intentos = notificacion['intentos'] + 1
+    espera = min(NOTIFICACIONES_ESPERA_BASE * 2 ** (intentos - 1), NOTIFICACIONES_ESPERA_MAXIMA)
+    return dict(
+        notificacion, intentos=intentos, error=error,
+        estado='fallida' if intentos >= NOTIFICACIONES_INTENTOS_MAXIMO else 'pendiente',
+        proximo_intento=(ahora + timedelta(seconds=espera)).strftime(FORMATO_FECHA)
+    )
+
+def enviar_notificaciones(limite=NOTIFICACIONES_LOTE):
+    """Una ronda de envío: reserva las notificaciones vencidas, manda un correo por
+    destinatario por una sola conexión SMTP y guarda el resultado. Devuelve (enviadas, fallidas)."""
+    ahora = datetime.now()
+    reservadas = reclamar_notificaciones(ahora.strftime(FORMATO_FECHA), limite,
+                                         (ahora + timedelta(seconds=NOTIFICACIONES_RESERVA)).strftime(FORMATO_FECHA))
+    if not reservadas:
+        return 0, 0
+    grupos = {}
+    for notificacion in reservadas:
+        grupos.setdefault((notificacion['destinatario_id'], notificacion['email']), []).append(notificacion)
+    
+    resultados = []
+    try:
+        with conexion_smtp() as smtp:
+            for grupo in grupos.values():
+                try:
+                    smtp.send_message(mensaje_notificaciones(grupo))
+                except smtplib.SMTPException as e:
+                    resultados.extend(reprogramar_notificacion(n, str(e), ahora) for n in grupo)
+                else:
+                    resultados.extend(dict(n, estado='enviada', intentos=n['intentos'] + 1, error=None) for n in grupo)
+    except (OSError, smtplib.SMTPException) as e:
+        # Sin conexión (o se cortó): se reprograma lo que no alcanzó a enviarse
+        procesadas = {n['id'] for n in resultados}
+        resultados.extend(reprogramar_notificacion(n, str(e), ahora) for n in reservadas if n['id'] not in procesadas)
+        app.logger.warning('No se pudo enviar el correo de notificaciones: %s', e)
+    actualizar_notificaciones(resultados)
+    
+    enviadas = sum(n['estado'] == 'enviada' for n in resultados)
+    for resultado, cantidad in (('enviada', enviadas), ('reintento', len(resultados) - enviadas)):
+        if cantidad:
+            metricas.incrementar('seguimiento_notificaciones_total', cantidad, resultado=resultado)
+    return enviadas, len(resultados) - enviadas
+
+def iniciar_envio_notificaciones():
+    """Hilo de fondo (uno por proceso) que envía la bandeja cada INTERVALO_NOTIFICACIONES
+    segundos. Las reservas reparten las notificaciones entre los workers."""
+    global _envio_notificaciones
+    intervalo = app.config['INTERVALO_NOTIFICACIONES']
+    if intervalo <= 0 or not app.config['SMTP_SERVIDOR'] or _envio_notificaciones is not None:
+        return
+    with _envio_notificaciones_lock:
+        if _envio_notificaciones is not None:
+            return
+        
+        def ciclo():
+            while True:
+                try:
+                    enviar_notificaciones()
+                except Exception:
+                    app.logger.exception('Error enviando las notificaciones por correo')
+                time.sleep(intervalo)
+        
+        _envio_notificaciones = threading.Thread(target=ciclo, name='envio-notificaciones', daemon=True)
+        _envio_notificaciones.start()
+
+@app.before_request
+def arrancar_envio_notificaciones():
+    iniciar_envio_notificaciones()
+
 # ==================== SISTEMA DE ASIGNACIÓN AUTOMÁTICA ====================
 def obtener_usuario_por_rol_y_dependencia(rol, dependencia=None):
-    """Obtiene un usuario activo por rol y dependencia"""
-    usuarios = cargar_usuarios()
-    usuarios_filtrados = [u for u in usuarios if u.get('rol') == rol and u.get('activo', True)]
-    
-    if dependencia:
-        usuarios_filtrados = [u for u in usuarios_filtrados if u.get('dependencia') == dependencia]
+    """Obtiene el usuario activo del rol (y dependencia) con menos cuentas en revisión"""
+    candidatos = obtener_directorio().por_rol(rol, dependencia)
+    if not candidatos:
+        return None
     
-    # Por simplicidad, tomamos el primer usuario disponible
-    return usuarios_filtrados[0] if usuarios_filtrados else None
+    # A igual carga se prefiere el usuario más antiguo
+    carga = obtener_almacen().carga_responsables()
+    return min(candidatos, key=lambda u: (carga.get(u['id'], 0), u['id']))
+
+# Mapeo de estados a roles responsables
+ROL_RESPONSABLE_POR_ESTADO = {
+    'radicado': 'epb',
+    'revision_epb': 'supervisor',
+    'revision_supervisor': 'general',
+    'revision_general': 'hacienda',
+    'revision_hacienda': 'hacienda',
+    'devuelto': 'contratista'
+}
 
 def asignar_siguiente_responsable(cuenta, estado_anterior, nuevo_estado):
     """Asigna automáticamente el siguiente responsable según el estado"""
-    usuarios = cargar_usuarios()
-    
-    # Mapeo de estados a roles responsables
-    mapeo_estado_rol = {
-        'radicado': 'epb',
-        'revision_epb': 'supervisor',
-        'revision_supervisor': 'general',
-        'revision_general': 'hacienda',
-        'revision_hacienda': 'hacienda',
-        'devuelto': 'contratista'
-    }
-    
-    rol_responsable = mapeo_estado_rol.get(nuevo_estado)
+    rol_responsable = ROL_RESPONSABLE_POR_ESTADO.get(nuevo_estado)
     
     if not rol_responsable:
         return None
     
     # Para el estado devuelto, asignar al contratista original
     if nuevo_estado == 'devuelto':
-        return next((u for u in usuarios if u['id'] == cuenta.get('contratista_id')), None)
-    
-    # Para otros estados, buscar usuario del rol correspondiente
-    if rol_responsable == 'supervisor':
-        return obtener_usuario_por_rol_y_dependencia('supervisor')
-    elif rol_responsable == 'general':
-        return obtener_usuario_por_rol_y_dependencia('general')
-    elif rol_responsable == 'hacienda':
-        return obtener_usuario_por_rol_y_dependencia('hacienda')
-    elif rol_responsable == 'epb':
-        return obtener_usuario_por_rol_y_dependencia('epb')
+        return obtener_directorio().obtener(cuenta.get('contratista_id'))
     
-    return None
+    # Para otros estados, el usuario del rol correspondiente con menos carga
+    return obtener_usuario_por_rol_y_dependencia(rol_responsable)
 
 # ==================== RUTAS DE AUTENTICACIÓN ====================
 @app.route('/')
@@ -204,15 +2858,16 @@ def index():
 def login():
     if request.method == 'POST':
         username = request.form['username']
-        password = request.form['password']  # hash seguro
+        password = request.form['password']
         
-        usuarios = cargar_usuarios()
-        usuario = next((u for u in usuarios if u['username'] == username and u['password'] == password), None)
+        # Solo se verifica el hash del usuario con ese nombre
+        usuario = obtener_directorio().obtener_por_username(username)
         
-        if usuario:
+        if usuario and usuario.get('activo', True) and verificar_password(usuario, password):
+            if not password_cifrada(usuario.get('password') or ''):
+                actualizar_password(usuario['id'], password)
+            session.clear()
             session['user_id'] = usuario['id']
-            session['user_rol'] = usuario['rol']
-            session['user_nombre'] = usuario['nombre']
             flash(f'Bienvenido {usuario["nombre"]}', 'success')
             return redirect('/dashboard')
         else:
@@ -257,11 +2912,14 @@ def logout():
 def crear_usuario():
     if request.method == 'POST':
         usuarios = cargar_usuarios()
+        if obtener_directorio().obtener_por_username(request.form['username']):
+            flash('Ese nombre de usuario ya existe', 'error')
+            return redirect('/crear-usuario')
         
         nuevo_usuario = {
             'id': len(usuarios) + 1,
             'username': request.form['username'],
-            'password': request.form['password'],
+            'password': cifrar_password(request.form['password']),
             'rol': request.form['rol'],
             'nombre': request.form['nombre'],
             'email': request.form.get('email', ''),
@@ -327,13 +2985,49 @@ def crear_usuario():
     '''
 
 # ==================== RUTAS DE RADICACIÓN ====================
+def construir_cuenta_radicada(contratista, datos, usuario_epb, ahora=None):
+    """Cuenta nueva en revisión EPB con su historial inicial (sin id ni número todavía)"""
+    ahora = ahora or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return {
+        'contratista_id': contratista['id'],
+        'contratista_nombre': contratista['nombre'],
+        'numero_contrato': datos['numero_contrato'],
+        'numero_acta': datos['numero_acta'],
+        'valor': datos['valor'],
+        'descripcion': datos['descripcion'],
+        'estado_actual': 'revision_epb',  # ✅ CAMBIADO de 'radicado' a 'revision_epb'
+        'responsable_actual': usuario_epb['id'],
+        'responsable_nombre': usuario_epb['nombre'],
+        'timestamps': {
+            'radicacion': ahora,
+            'asignacion_epb': ahora,
+            'inicio_revision_epb': ahora  # ✅ AGREGADO
+        },
+        'historial': [
+            {
+                'estado': 'radicado',
+                'usuario': contratista['nombre'],
+                'timestamp': ahora,
+                'accion': 'radicacion',
+                'comentario': 'Cuenta radicada inicialmente'
+            },
+            {
+                'estado': 'revision_epb',
+                'usuario': 'Sistema',
+                'timestamp': ahora,
+                'accion': 'asignacion',
+                'comentario': f'Cuenta asignada automáticamente a {usuario_epb["nombre"]}',
+                'responsable_asignado': usuario_epb['nombre'],
+                'responsable_id': usuario_epb['id']
+            }
+        ]
+    }
+
 @app.route('/radicar', methods=['GET', 'POST'])
 @login_required
 @permiso_required('radicar_cuenta')
 def radicar_cuenta():
     if request.method == 'POST':
-        cuentas = cargar_cuentas()
-        
         # Obtener el primer usuario EPB para asignación automática
         usuario_epb = obtener_usuario_por_rol_y_dependencia('epb')
         
@@ -341,49 +3035,21 @@ def radicar_cuenta():
             flash('❌ No hay usuarios EPB disponibles para asignar la revisión', 'error')
             return redirect('/radicar')
         
-        # Generar número de cuenta automático
-        numero_cuenta = f"CC-{datetime.now().strftime('%Y%m%d')}-{len(cuentas) + 1:03d}"
-        
-        nueva_cuenta = {
-            'id': len(cuentas) + 1,
-            'numero_cuenta': numero_cuenta,
-            'contratista_id': session['user_id'],
-            'contratista_nombre': session['user_nombre'],
-            'numero_contrato': request.form['numero_contrato'],
-            'numero_acta': request.form['numero_acta'],
-            'valor': float(request.form['valor']),
-            'descripcion': request.form['descripcion'],
-            'estado_actual': 'revision_epb',  # ✅ CAMBIADO de 'radicado' a 'revision_epb'
-            'responsable_actual': usuario_epb['id'],
-            'responsable_nombre': usuario_epb['nombre'],
-            'timestamps': {
-                'radicacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'asignacion_epb': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'inicio_revision_epb': datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # ✅ AGREGADO
+        # El id y el número de cuenta los asigna el almacén al insertar
+        nueva_cuenta = construir_cuenta_radicada(
+            {'id': g.usuario['id'], 'nombre': g.usuario['nombre']},
+            {
+                'numero_contrato': request.form['numero_contrato'],
+                'numero_acta': request.form['numero_acta'],
+                'valor': float(request.form['valor']),
+                'descripcion': request.form['descripcion']
             },
-            'historial': [
-                {
-                    'estado': 'radicado',
-                    'usuario': session['user_nombre'],
-                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'accion': 'radicacion',
-                    'comentario': 'Cuenta radicada inicialmente'
-                },
-                {
-                    'estado': 'revision_epb',
-                    'usuario': 'Sistema',
-                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'accion': 'asignacion',
-                    'comentario': f'Cuenta asignada automáticamente a {usuario_epb["nombre"]}',
-                    'responsable_asignado': usuario_epb['nombre'],
-                    'responsable_id': usuario_epb['id']
-                }
-            ]
-        }
-        cuentas.append(nueva_cuenta)
-        guardar_cuentas(cuentas)
+            usuario_epb
+        )
+        insertar_cuenta(nueva_cuenta)
+        registrar_transicion('radicacion', 'contratista', [nueva_cuenta])
         
-        flash(f'✅ Cuenta de cobro {numero_cuenta} radicada exitosamente. Asignada a: {usuario_epb["nombre"]}', 'success')
+        flash(f'✅ Cuenta de cobro {nueva_cuenta["numero_cuenta"]} radicada exitosamente. Asignada a: {usuario_epb["nombre"]}', 'success')
         return redirect('/cuentas')
     
     return '''
@@ -428,202 +3094,366 @@ def radicar_cuenta():
                     <a href="/cuentas" class="btn-volver" style="background: #6c757d; color: white; padding: 12px 20px; text-decoration: none; border-radius: 5px; display: inline-block;">← Volver</a>
                 </div>
             </form>
+            <p style="margin-top: 20px;"><a href="/radicar/masivo">📥 ¿Muchas actas? Radique en lote desde un archivo CSV o JSONL</a></p>
         </div>
     </body>
     </html>
     '''
 
+# ==================== RADICACIÓN MASIVA ====================
+CAMPOS_IMPORTACION = ('numero_contrato', 'numero_acta', 'valor', 'descripcion')
+CAMPOS_IMPORTACION_OBLIGATORIOS = ('numero_contrato', 'numero_acta', 'valor')
+IMPORTACION_MAXIMA_FILAS = 5000
+
+def leer_filas_importacion(archivo, formato):
+    """Genera (línea, fila) de un archivo binario CSV (separado por ',' o ';') o JSONL,
+    leyéndolo por partes. Una línea JSONL inválida se entrega como fila None."""
+    texto = io.TextIOWrapper(archivo, encoding='utf-8-sig', newline='')
+    if formato == 'jsonl':
+        for numero, linea in enumerate(texto, start=1):
+            if not linea.strip():
+                continue
+            try:
+                yield numero, json.loads(linea)
+            except ValueError:
+                yield numero, None
+        return
+    
+    primera = texto.readline()
+    separador = ';' if primera.count(';') > primera.count(',') else ','
+    lector = csv.DictReader(itertools.chain([primera], texto), delimiter=separador)
+    for fila in lector:
+        yield lector.line_num, fila
+
+def validar_fila_importacion(fila):
+    """Datos de radicación de una fila, o ValueError con el motivo del rechazo"""
+    if not isinstance(fila, dict):
+        raise ValueError('La línea no es un objeto JSON válido')
+    datos = {campo: str(fila.get(campo) or '').strip() for campo in CAMPOS_IMPORTACION}
+    faltantes = [campo for campo in CAMPOS_IMPORTACION_OBLIGATORIOS if not datos[campo]]
+    if faltantes:
+        raise ValueError(f"Faltan campos: {', '.join(faltantes)}")
+    try:
+        datos['valor'] = float(datos['valor'])
+    except ValueError:
+        raise ValueError(f"Valor inválido: {datos['valor']}")
+    if not math.isfinite(datos['valor']) or datos['valor'] <= 0:
+        raise ValueError('El valor debe ser mayor que cero')
+    return datos
+
+def repartidor_por_carga(rol, dependencia=None):
+    """Función que devuelve, en cada llamada, el usuario del rol con menos carga contando
+    las asignaciones ya hechas. Directorio y carga se leen una sola vez por lote."""
+    candidatos = obtener_directorio().por_rol(rol, dependencia)
+    if not candidatos:
+        return None
+    carga = Counter(obtener_almacen().carga_responsables())
+    
+    def siguiente():
+        usuario = min(candidatos, key=lambda u: (carga[u['id']], u['id']))
+        carga[usuario['id']] += 1
+        return usuario
+    return siguiente
+
+def importar_cuentas(filas, contratista, maximo=IMPORTACION_MAXIMA_FILAS):
+    """Valida las filas una a una y radica todas las válidas con una sola escritura.
+    Devuelve (cuentas radicadas, [(línea, motivo)] de las filas rechazadas)."""
+    siguiente_epb = repartidor_por_carga('epb')
+    if siguiente_epb is None:
+        raise ValueError('No hay usuarios EPB disponibles para asignar la revisión')
+    
+    ahora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    nuevas, errores, vistas = [], [], set()
+    for numero, fila in filas:
+        if len(nuevas) + len(errores) >= maximo:
+            errores.append((numero, f'Se superó el máximo de {maximo} filas; el resto del archivo no se procesó'))
+            break
+        try:
+            datos = validar_fila_importacion(fila)
+        except ValueError as e:
+            errores.append((numero, str(e)))
+            continue
+        clave = (datos['numero_contrato'], datos['numero_acta'])
+        if clave in vistas:
+            errores.append((numero, f'Contrato {clave[0]} y acta {clave[1]} repetidos en el archivo'))
+            continue
+        vistas.add(clave)
+        nuevas.append(construir_cuenta_radicada(contratista, datos, siguiente_epb(), ahora))
+    
+    if nuevas:
+        insertar_cuentas(nuevas)
+        registrar_transicion('radicacion', 'contratista', nuevas)
+    return nuevas, errores
+
+def formato_importacion(nombre_archivo):
+    return 'jsonl' if nombre_archivo.lower().endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+
+@app.route('/radicar/masivo', methods=['GET', 'POST'])
+@login_required
+@permiso_required('radicar_cuenta')
+def radicar_masivo():
+    if request.method == 'POST':
+        archivo = request.files.get('archivo')
+        if not archivo or not archivo.filename:
+            flash('❌ Seleccione un archivo CSV o JSONL', 'error')
+            return redirect('/radicar/masivo')
+        
+        contratista = {'id': g.usuario['id'], 'nombre': g.usuario['nombre']}
+        try:
+            nuevas, errores = importar_cuentas(leer_filas_importacion(archivo.stream, formato_importacion(archivo.filename)), contratista)
+        except (ValueError, csv.Error, UnicodeDecodeError) as e:
+            flash(f'❌ No se pudo importar el archivo: {e}', 'error')
+            return redirect('/radicar/masivo')
+        return render_template('radicar_masivo.html', campos=CAMPOS_IMPORTACION, resultado=True, nuevas=nuevas, errores=errores)
+    
+    return render_template('radicar_masivo.html', campos=CAMPOS_IMPORTACION, maximo=IMPORTACION_MAXIMA_FILAS, resultado=False)
+
 # ==================== LISTA DE CUENTAS ====================
+TAMANO_PAGINA = 50
+TAMANO_PAGINA_MAXIMO = 200
+
+def leer_filtros_cuentas(args):
+    """Filtros de /cuentas desde la query string; los valores inválidos se ignoran"""
+    filtros = {}
+    if args.get('estado') in ESTADOS_FLUJO:
+        filtros['estado'] = args['estado']
+    for campo, parametro in (('contratista_id', 'contratista'), ('responsable_id', 'responsable')):
+        valor = args.get(parametro, type=int)
+        if valor is not None:
+            filtros[campo] = valor
+    for campo, hora in (('desde', '00:00:00'), ('hasta', '23:59:59')):
+        fecha = args.get(campo, '')
+        try:
+            datetime.strptime(fecha, '%Y-%m-%d')
+        except ValueError:
+            continue
+        filtros[campo] = f'{fecha} {hora}'
+    for campo in ('valor_min', 'valor_max'):
+        valor = args.get(campo, type=float)
+        if valor is not None:
+            filtros[campo] = valor
+    return filtros
+
 @app.route('/cuentas')
 @login_required
 def listar_cuentas():
-    cuentas = cargar_cuentas()
-    user_rol = session['user_rol']
-    user_id = session['user_id']
+    user_rol = g.usuario['rol']
+    user_id = g.usuario['id']
+    
+    filtros = leer_filtros_cuentas(request.args)
     
     # Filtrar según el rol
     if user_rol == 'contratista':
-        cuentas = [c for c in cuentas if c.get('contratista_id') == user_id]
+        filtros['contratista_id'] = user_id
         titulo = "Mis Cuentas de Cobro"
     else:
         titulo = "Todas las Cuentas de Cobro"
     
-    # Calcular alertas para cada cuenta
-    for cuenta in cuentas:
-        cuenta['alertas'] = verificar_alerta_3_dias(cuenta)
+    # Paginación: ?pagina=N salta por desplazamiento; los enlaces "Siguiente" usan un
+    # cursor con la clave de la última cuenta, que no se degrada en páginas profundas
+    orden = request.args.get('orden') if request.args.get('orden') in CLAVES_ORDEN else 'fecha'
+    descendente = request.args.get('dir', 'desc') != 'asc'
+    tamano = min(max(request.args.get('tam', TAMANO_PAGINA, type=int), 1), TAMANO_PAGINA_MAXIMO)
+    pagina = max(request.args.get('pagina', 1, type=int), 1)
+    cursor = decodificar_cursor(request.args.get('cursor'), orden)
+    desplazamiento = 0 if cursor else (pagina - 1) * tamano
     
-    cuentas_html = ""
+    cuentas, clave_siguiente = consultar_cuentas(filtros, orden, descendente, tamano, cursor, desplazamiento)
     
-    for cuenta in cuentas:
-        estado_color = {
-            'radicado': '#ffc107',
-            'revision_epb': '#17a2b8', 
-            'revision_supervisor': '#fd7e14',
-            'revision_general': '#20c997',
-            'revision_hacienda': '#6f42c1',
-            'pagado': '#28a745',
-            'devuelto': '#dc3545'
-        }.get(cuenta['estado_actual'], '#6c757d')
-        
-        alertas_html = ""
-        if cuenta.get('alertas'):
-            alertas_html = f"<div style='color: red; font-weight: bold; margin: 5px 0;'>⚠️ {' | '.join(cuenta['alertas'])}</div>"
-        
-        acciones_html = ""
-
-        # LÓGICA SIMPLIFICADA Y CORRECTA DE ACCIONES
-        if user_rol == 'admin' and cuenta['estado_actual'] in ['revision_admin', 'devuelto']:
-            acciones_html = f"""
-            <div style="margin-top: 10px;">
-                <a href="/accion-cuenta/{cuenta['id']}/aprobar" style="background: #28a745; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; margin-right: 5px; font-size: 12px;">✅ Aprobar</a>
-                <a href="/accion-cuenta/{cuenta['id']}/devolver" style="background: #dc3545; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; font-size: 12px;">↩️ Devolver</a>
-                <a href="/cuenta/{cuenta['id']}" style="background: #17a2b8; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; margin-left: 5px; font-size: 12px;">📝 Ver Detalle</a>
-            </div>
-            """
-        
-        elif user_rol == 'general' and cuenta['estado_actual'] == 'revision_general':
-            acciones_html = f"""
-            <div style="margin-top: 10px;">
-                <a href="/accion-cuenta/{cuenta['id']}/aprobar" style="background: #28a745; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; margin-right: 5px; font-size: 12px;">✅ Aprobar</a>
-                <a href="/accion-cuenta/{cuenta['id']}/devolver" style="background: #dc3545; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; font-size: 12px;">↩️ Devolver</a>
-                <a href="/cuenta/{cuenta['id']}" style="background: #17a2b8; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; margin-left: 5px; font-size: 12px;">📝 Ver Detalle</a>
-            </div>
-            """
-        
-        elif user_rol == 'hacienda' and cuenta['estado_actual'] == 'revision_hacienda':
-            acciones_html = f"""
-            <div style="margin-top: 10px;">
-                <a href="/accion-cuenta/{cuenta['id']}/pagar" style="background: #28a745; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; margin-right: 5px; font-size: 12px;">💰 Pagar</a>
-                <a href="/accion-cuenta/{cuenta['id']}/devolver" style="background: #dc3545; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; font-size: 12px;">↩️ Devolver</a>
-                <a href="/cuenta/{cuenta['id']}" style="background: #17a2b8; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; margin-left: 5px; font-size: 12px;">📝 Ver Detalle</a>
-            </div>
-            """
-        
-        elif user_rol == 'contratista' and cuenta['estado_actual'] == 'devuelto':
-            acciones_html = f"""
-            <div style="margin-top: 10px;">
-                <a href="/cuenta/{cuenta['id']}" style="background: #17a2b8; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; font-size: 12px;">📝 Ver Correcciones</a>
-            </div>
-            """
-        
-        else:
-            # Para otros casos, mostrar solo el botón de detalle
-            acciones_html = f"""
-            <div style="margin-top: 10px;">
-                <a href="/cuenta/{cuenta['id']}" style="background: #17a2b8; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; font-size: 12px;">📝 Ver Detalle</a>
-            </div>
-            """
-        
-        cuentas_html += f"""
-        <div style="background: white; padding: 15px; margin: 10px 0; border-radius: 8px; border-left: 4px solid {estado_color}; box-shadow: 0 2px 5px rgba(0,0,0,0.1);">
-            <div style="display: flex; justify-content: between; align-items: center;">
-                <div style="flex: 1;">
-                    <h3 style="margin: 0 0 5px 0;">{cuenta['numero_cuenta']}</h3>
-                    <p style="margin: 2px 0; color: #666;">Contrato: {cuenta['numero_contrato']} | Acta: {cuenta['numero_acta']}</p>
-                    <p style="margin: 2px 0;"><strong>Contratista:</strong> {cuenta['contratista_nombre']}</p>
-                    <p style="margin: 2px 0;"><strong>Valor:</strong> ${cuenta['valor']:,.0f}</p>
-                    <p style="margin: 2px 0;"><strong>Estado:</strong> <span style="background: {estado_color}; color: white; padding: 2px 8px; border-radius: 12px; font-size: 12px;">{cuenta['estado_actual'].replace('_', ' ').title()}</span></p>
-                    <p style="margin: 2px 0;"><strong>Responsable actual:</strong> 
-                        <span style="background: #6f42c1; color: white; padding: 2px 8px; border-radius: 12px; font-size: 11px;">
-                            {cuenta.get('responsable_nombre', 'No asignado')}
-                        </span>
-                    </p>
-                    <p style="margin: 2px 0; font-size: 12px; color: #888;">Radicado: {cuenta['timestamps']['radicacion']}</p>
-                </div>
-            </div>
-            {alertas_html}
-            {acciones_html}
-        </div>
-        """
+    parametros = {k: v for k, v in request.args.items() if k not in ('cursor', 'pagina')}
+    siguiente = None
+    if clave_siguiente:
+        siguiente = dict(parametros, cursor=codificar_cursor(clave_siguiente, orden), pagina=pagina + 1)
+    
+    # Las alertas salen de la fecha_limite guardada en cada cuenta, comparada con la hora
+    # de la petición mientras se envía la respuesta
+    ahora = datetime.now().strftime(FORMATO_FECHA)
+    cuentas_con_alertas = ((cuenta, alertas_plazo(cuenta, ahora)) for cuenta in cuentas)
+    
+    return stream_template(
+        'cuentas.html',
+        titulo=titulo,
+        user_rol=user_rol,
+        estados_accion=ROLES_PERMISOS[user_rol]['estados_permitidos'] if 'aprobar' in g.usuario['permisos'] else (),
+        args=request.args,
+        filtros=filtros,
+        orden=orden,
+        descendente=descendente,
+        tamano=tamano,
+        cuentas=cuentas_con_alertas,
+        pagina=pagina,
+        parametros=parametros,
+        siguiente=siguiente
+    )
+
+# ==================== BÚSQUEDA ====================
+TAMANO_PAGINA_BUSQUEDA = 20
+
+def leer_busqueda(args):
+    """Consulta, filtros (los de /cuentas; un contratista solo ve las suyas) y página"""
+    filtros = leer_filtros_cuentas(args)
+    if g.usuario['rol'] == 'contratista':
+        filtros['contratista_id'] = g.usuario['id']
+    return args.get('q', '').strip(), filtros, max(args.get('pagina', 1, type=int), 1)
+
+@app.route('/buscar')
+@login_required
+def buscar():
+    """Búsqueda por número de cuenta, contrato o acta, contratista, descripción y comentarios"""
+    consulta, filtros, pagina = leer_busqueda(request.args)
+    cuentas, total = [], 0
+    if consulta:
+        cuentas, total = buscar_cuentas(consulta, filtros, TAMANO_PAGINA_BUSQUEDA, (pagina - 1) * TAMANO_PAGINA_BUSQUEDA)
+    parametros = {k: v for k, v in request.args.items() if k != 'pagina'}
+    return stream_template(
+        'buscar.html',
+        user_rol=g.usuario['rol'],
+        consulta=consulta,
+        filtros=filtros,
+        cuentas=cuentas,
+        total=total,
+        pagina=pagina,
+        paginas=math.ceil(total / TAMANO_PAGINA_BUSQUEDA),
+        parametros=parametros
+    )
+
+# ==================== ALERTAS DE PLAZO ====================
+@app.route('/alertas')
+@login_required
+@permiso_required('ver_todas')
+def listar_alertas():
+    return stream_template('alertas.html', cuentas=cuentas_vencidas(), dias_maximos=DIAS_MAXIMOS_ETAPA)
+
+# ==================== ACCIONES SOBRE CUENTAS ====================
+MENSAJE_CONFLICTO = '⚠️ Otro usuario modificó esta cuenta mientras la procesaba. Revise su estado e intente de nuevo.'
+
+# Definir el flujo de estados
+FLUJO_ESTADOS = {
+    'radicado': 'revision_epb',
+    'revision_epb': 'revision_supervisor',
+    'revision_supervisor': 'revision_general',
+    'revision_general': 'revision_hacienda',
+    'revision_hacienda': 'pagado'
+}
+
+class AccionNoPermitida(Exception):
+    """La acción no corresponde al rol del usuario o al estado de la cuenta"""
+
+def usuario_sesion():
+    return g.usuario
+
+def validar_no_archivada(cuenta):
+    if cuenta.get('archivada'):
+        raise AccionNoPermitida(f"La cuenta {cuenta['numero_cuenta']} ya fue pagada y archivada; no admite más acciones")
+
+def validar_accion(cuenta, usuario):
+    validar_no_archivada(cuenta)
+    # Validar que el usuario puede realizar la acción en este estado
+    if cuenta['estado_actual'] not in ROLES_PERMISOS[usuario['rol']]['estados_permitidos']:
+        raise AccionNoPermitida('No puede realizar esta acción en el estado actual de la cuenta')
+
+def aplicar_aprobacion(cuenta, usuario, siguiente_responsable, timestamp_actual):
+    """Avanza la cuenta al siguiente estado del flujo (modifica la cuenta en el lugar)"""
+    nuevo_estado = FLUJO_ESTADOS.get(cuenta['estado_actual'])
+    if not nuevo_estado:
+        raise AccionNoPermitida('La cuenta no tiene una etapa siguiente')
+    
+    # Actualizar cuenta con nuevo estado y responsable
+    cuenta['estado_actual'] = nuevo_estado
+    cuenta['responsable_actual'] = siguiente_responsable['id']
+    cuenta['responsable_nombre'] = siguiente_responsable['nombre']
+    
+    # Registrar timestamp
+    timestamp_key = f"inicio_revision_{nuevo_estado.split('_')[1]}"
+    cuenta['timestamps'][timestamp_key] = timestamp_actual
+    cuenta['timestamps'][f'asignado_{nuevo_estado}'] = timestamp_actual
+    
+    # Agregar al historial
+    cuenta['historial'].append({
+        'estado': nuevo_estado,
+        'usuario': usuario['nombre'],
+        'timestamp': timestamp_actual,
+        'accion': 'aprobacion',
+        'comentario': f'Aprobado por {usuario["rol"]} - Avanza a {nuevo_estado.replace("_", " ").title()}',
+        'responsable_asignado': siguiente_responsable['nombre'],
+        'responsable_id': siguiente_responsable['id']
+    })
+
+def aplicar_devolucion(cuenta, usuario, usuario_contratista, comentario, tipo_correccion, timestamp_actual):
+    """Devuelve la cuenta al contratista con el comentario en el historial"""
+    if usuario_contratista:
+        cuenta['responsable_actual'] = usuario_contratista['id']
+        cuenta['responsable_nombre'] = usuario_contratista['nombre']
     
-    return f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>{titulo}</title>
-        <style>
-            body {{ font-family: Arial; margin: 0; padding: 20px; background: #f5f5f5; }}
-            .header {{ background: white; padding: 20px; border-radius: 10px; margin-bottom: 20px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            .btn {{ background: #007bff; color: white; padding: 10px 15px; text-decoration: none; border-radius: 5px; margin-right: 10px; display: inline-block; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>📋 {titulo}</h1>
-            <div>
-                <a href="/dashboard" class="btn">← Dashboard</a>
-                {'<a href="/radicar" class="btn" style="background: #28a745;">📝 Nueva Cuenta</a>' if session['user_rol'] == 'contratista' else ''}
-            </div>
-        </div>
-        
-        {cuentas_html if cuentas_html else '<div style="background: white; padding: 30px; text-align: center; border-radius: 8px;"><p>No hay cuentas de cobro registradas</p></div>'}
-    </body>
-    </html>
-    '''
-# ==================== ACCIONES SOBRE CUENTAS ====================
+    # Cambiar estado a devuelto
+    cuenta['estado_actual'] = 'devuelto'
+    
+    # Agregar comentario detallado al historial
+    cuenta['historial'].append({
+        'estado': 'devuelto',
+        'usuario': usuario['nombre'],
+        'timestamp': timestamp_actual,
+        'accion': 'devolucion',
+        'comentario': comentario,
+        'tipo_correccion': tipo_correccion,
+        'rol_responsable': usuario['rol'],
+        'responsable_asignado': usuario_contratista['nombre'] if usuario_contratista else 'No asignado',
+        'responsable_id': usuario_contratista['id'] if usuario_contratista else None
+    })
+
+def aplicar_pago(cuenta, usuario, timestamp_actual):
+    cuenta['estado_actual'] = 'pagado'
+    cuenta['timestamps']['pago'] = timestamp_actual
+    cuenta['historial'].append({
+        'estado': 'pagado',
+        'usuario': usuario['nombre'],
+        'timestamp': timestamp_actual,
+        'accion': 'pago',
+        'comentario': 'Cuenta pagada exitosamente'
+    })
+
 @app.route('/accion-cuenta/<int:cuenta_id>/<accion>', methods=['GET', 'POST'])
 @login_required
 def accion_cuenta(cuenta_id, accion):
-    cuentas = cargar_cuentas()
-    cuenta = next((c for c in cuentas if c['id'] == cuenta_id), None)
+    cuenta = obtener_cuenta(cuenta_id)
     
     if not cuenta:
         flash('Cuenta no encontrada', 'error')
         return redirect('/cuentas')
     
-    user_rol = session['user_rol']
+    usuario = usuario_sesion()
+    user_rol = usuario['rol']
     estado_actual = cuenta['estado_actual']
     
-    # Validar que el usuario puede realizar la acción en este estado
-    if estado_actual not in ROLES_PERMISOS[user_rol]['estados_permitidos']:
-        flash('No puede realizar esta acción en el estado actual de la cuenta', 'error')
+    try:
+        validar_accion(cuenta, usuario)
+    except AccionNoPermitida as e:
+        flash(str(e), 'error')
         return redirect('/cuentas')
     
-    # Definir el flujo de estados
-    flujo_estados = {
-        'radicado': 'revision_epb',
-        'revision_epb': 'revision_supervisor',
-        'revision_supervisor': 'revision_general', 
-        'revision_general': 'revision_hacienda',
-        'revision_hacienda': 'pagado'
-    }
-    
     timestamp_actual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     if accion == 'aprobar':
-        # Mover al siguiente estado
-        nuevo_estado = flujo_estados[estado_actual]
-        
         # Asignar siguiente responsable automáticamente
+        nuevo_estado = FLUJO_ESTADOS.get(estado_actual)
         siguiente_responsable = asignar_siguiente_responsable(cuenta, estado_actual, nuevo_estado)
         
         if not siguiente_responsable:
             flash('❌ No hay usuario disponible para asignar la siguiente etapa', 'error')
             return redirect('/cuentas')
         
-        # Actualizar cuenta con nuevo estado y responsable
-        cuenta['estado_actual'] = nuevo_estado
-        cuenta['responsable_actual'] = siguiente_responsable['id']
-        cuenta['responsable_nombre'] = siguiente_responsable['nombre']
-        
-        # Registrar timestamp
-        timestamp_key = f"inicio_revision_{nuevo_estado.split('_')[1]}"
-        cuenta['timestamps'][timestamp_key] = timestamp_actual
-        cuenta['timestamps'][f'asignado_{nuevo_estado}'] = timestamp_actual
-        
-        # Agregar al historial
-        cuenta['historial'].append({
-            'estado': nuevo_estado,
-            'usuario': session['user_nombre'],
-            'timestamp': timestamp_actual,
-            'accion': 'aprobacion',
-            'comentario': f'Aprobado por {user_rol} - Avanza a {nuevo_estado.replace("_", " ").title()}',
-            'responsable_asignado': siguiente_responsable['nombre'],
-            'responsable_id': siguiente_responsable['id']
-        })
+        try:
+            aplicar_aprobacion(cuenta, usuario, siguiente_responsable, timestamp_actual)
+            guardar_cuenta(cuenta, notificaciones_transicion([cuenta]))
+        except AccionNoPermitida as e:
+            flash(str(e), 'error')
+            return redirect('/cuentas')
+        except ConflictoVersion:
+            flash(MENSAJE_CONFLICTO, 'error')
+            return redirect('/cuentas')
+        registrar_transicion('aprobacion', user_rol, [cuenta])
         
         flash(f'✅ Cuenta aprobada. Asignada a: {siguiente_responsable["nombre"]}', 'success')
-        guardar_cuentas(cuentas)
         return redirect('/cuentas')
     
     elif accion == 'devolver':
@@ -688,17 +3518,15 @@ def accion_cuenta(cuenta_id, accion):
         '''
     
     elif accion == 'pagar' and user_rol == 'hacienda':
-        cuenta['estado_actual'] = 'pagado'
-        cuenta['timestamps']['pago'] = timestamp_actual
-        cuenta['historial'].append({
-            'estado': 'pagado',
-            'usuario': session['user_nombre'],
-            'timestamp': timestamp_actual,
-            'accion': 'pago',
-            'comentario': 'Cuenta pagada exitosamente'
-        })
+        aplicar_pago(cuenta, usuario, timestamp_actual)
+        try:
+            guardar_cuenta(cuenta)
+        except ConflictoVersion:
+            flash(MENSAJE_CONFLICTO, 'error')
+            return redirect('/cuentas')
+        registrar_transicion('pago', user_rol, [cuenta])
+        
         flash('💰 Cuenta marcada como pagada', 'success')
-        guardar_cuentas(cuentas)
         return redirect('/cuentas')
     
     return redirect('/cuentas')
@@ -706,61 +3534,140 @@ def accion_cuenta(cuenta_id, accion):
 @app.route('/procesar-devolucion/<int:cuenta_id>', methods=['POST'])
 @login_required
 def procesar_devolucion(cuenta_id):
-    cuentas = cargar_cuentas()
-    cuenta = next((c for c in cuentas if c['id'] == cuenta_id), None)
+    cuenta = obtener_cuenta(cuenta_id)
     
     if not cuenta:
         flash('Cuenta no encontrada', 'error')
         return redirect('/cuentas')
+    try:
+        validar_no_archivada(cuenta)
+    except AccionNoPermitida as e:
+        flash(str(e), 'error')
+        return redirect('/cuentas')
     
     comentario = request.form['comentario']
     tipo_correccion = request.form.get('tipo_correccion', 'no especificado')
     timestamp_actual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     # Asignar al contratista para correcciones
-    usuario_contratista = next((u for u in cargar_usuarios() if u['id'] == cuenta.get('contratista_id')), None)
+    usuario_contratista = obtener_directorio().obtener(cuenta.get('contratista_id'))
+    aplicar_devolucion(cuenta, usuario_sesion(), usuario_contratista, comentario, tipo_correccion, timestamp_actual)
     
-    if usuario_contratista:
-        cuenta['responsable_actual'] = usuario_contratista['id']
-        cuenta['responsable_nombre'] = usuario_contratista['nombre']
+    # Guardar cambios (con el aviso al contratista)
+    try:
+        guardar_cuenta(cuenta, notificaciones_transicion([cuenta]))
+    except ConflictoVersion:
+        flash(MENSAJE_CONFLICTO, 'error')
+        return redirect('/cuentas')
+    registrar_transicion('devolucion', g.usuario['rol'], [cuenta])
     
-    # Cambiar estado a devuelto
-    cuenta['estado_actual'] = 'devuelto'
+    flash('✅ Cuenta devuelta exitosamente. Asignada al contratista para correcciones.', 'success')
+    return redirect('/cuentas')
+
+# ==================== ACCIONES EN LOTE ====================
+LOTE_MAXIMO = 200
+ACCIONES_LOTE = ('aprobar', 'devolver')
+TRANSICION_ACCION = {'aprobar': 'aprobacion', 'devolver': 'devolucion'}
+
+def procesar_lote(ids, accion, usuario, comentario='', tipo_correccion='no especificado'):
+    """Aplica la misma acción a varias cuentas y las guarda con una sola escritura.
     
-    # Agregar comentario detallado al historial
-    cuenta['historial'].append({
-        'estado': 'devuelto',
-        'usuario': session['user_nombre'],
-        'timestamp': timestamp_actual,
-        'accion': 'devolucion',
-        'comentario': comentario,
-        'tipo_correccion': tipo_correccion,
-        'rol_responsable': session['user_rol'],
-        'responsable_asignado': usuario_contratista['nombre'] if usuario_contratista else 'No asignado',
-        'responsable_id': usuario_contratista['id'] if usuario_contratista else None
-    })
+    Cada cuenta se valida por separado; las que no admiten la acción quedan fuera con su
+    motivo. Los responsables siguientes se reparten por carga leyendo el directorio una vez
+    por rol. Si otro usuario modificó alguna cuenta mientras tanto, esa se excluye y se
+    confirma el resto. Devuelve un resultado por id en el orden recibido."""
+    timestamp_actual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    directorio = obtener_directorio()
+    repartidores = {}
+    resultados = {}
+    cuentas = []
     
-    # Guardar cambios
-    guardar_cuentas(cuentas)
+    for cuenta_id in dict.fromkeys(ids):
+        cuenta = obtener_cuenta(cuenta_id)
+        if not cuenta:
+            resultados[cuenta_id] = {'id': cuenta_id, 'ok': False, 'mensaje': 'Cuenta no encontrada'}
+            continue
+        try:
+            validar_accion(cuenta, usuario)
+            if accion == 'aprobar':
+                rol = ROL_RESPONSABLE_POR_ESTADO.get(FLUJO_ESTADOS.get(cuenta['estado_actual']))
+                if rol not in repartidores:
+                    repartidores[rol] = repartidor_por_carga(rol) if rol else None
+                if not repartidores[rol]:
+                    raise AccionNoPermitida('No hay usuario disponible para asignar la siguiente etapa')
+                siguiente_responsable = repartidores[rol]()
+                aplicar_aprobacion(cuenta, usuario, siguiente_responsable, timestamp_actual)
+                mensaje = f'Aprobada. Asignada a: {siguiente_responsable["nombre"]}'
+            else:
+                usuario_contratista = directorio.obtener(cuenta.get('contratista_id'))
+                aplicar_devolucion(cuenta, usuario, usuario_contratista, comentario, tipo_correccion, timestamp_actual)
+                mensaje = 'Devuelta al contratista para correcciones'
+        except AccionNoPermitida as e:
+            resultados[cuenta_id] = {'id': cuenta_id, 'numero_cuenta': cuenta['numero_cuenta'], 'ok': False, 'mensaje': str(e)}
+            continue
+        cuentas.append(cuenta)
+        resultados[cuenta_id] = {'id': cuenta_id, 'numero_cuenta': cuenta['numero_cuenta'], 'ok': True, 'mensaje': mensaje}
     
-    flash('✅ Cuenta devuelta exitosamente. Asignada al contratista para correcciones.', 'success')
-    return redirect('/cuentas')
+    while cuentas:
+        try:
+            guardar_lote_cuentas(cuentas, notificaciones_transicion(cuentas))
+            break
+        except ConflictoVersion as e:
+            resultados[e.cuenta_id].update(ok=False, mensaje=MENSAJE_CONFLICTO)
+            cuentas = [cuenta for cuenta in cuentas if cuenta['id'] != e.cuenta_id]
+    registrar_transicion(TRANSICION_ACCION[accion], usuario['rol'], cuentas)
+    return list(resultados.values())
+
+@app.route('/cuentas/lote', methods=['POST'])
+@login_required
+def acciones_lote():
+    """Aprobar o devolver varias cuentas a la vez (formulario de /cuentas o JSON)"""
+    datos = request.get_json(silent=True) if request.is_json else None
+    if datos is not None:
+        ids = [i for i in datos.get('ids', []) if isinstance(i, int)]
+        accion, comentario = datos.get('accion'), (datos.get('comentario') or '').strip()
+        tipo_correccion = datos.get('tipo_correccion') or 'no especificado'
+    else:
+        ids = request.form.getlist('ids', type=int)
+        accion, comentario = request.form.get('accion'), request.form.get('comentario', '').strip()
+        tipo_correccion = request.form.get('tipo_correccion') or 'no especificado'
+    
+    usuario = usuario_sesion()
+    error = None
+    if accion not in ACCIONES_LOTE or accion not in usuario['permisos']:
+        error = 'No tiene permiso para esta acción'
+    elif not ids:
+        error = 'Seleccione al menos una cuenta'
+    elif len(ids) > LOTE_MAXIMO:
+        error = f'Se pueden procesar máximo {LOTE_MAXIMO} cuentas por lote'
+    elif accion == 'devolver' and not comentario:
+        error = 'Indique el motivo de la devolución'
+    if error:
+        if datos is not None:
+            return jsonify({'error': error}), 400
+        flash(f'❌ {error}', 'error')
+        return redirect('/cuentas')
+    
+    resultados = procesar_lote(ids, accion, usuario, comentario, tipo_correccion)
+    if datos is not None:
+        return jsonify({'resultados': resultados})
+    return render_template('resultado_lote.html', accion=accion, resultados=resultados,
+                           exitosas=sum(1 for r in resultados if r['ok']))
 
 # ==================== VISTA DETALLADA DE CUENTA CON COMENTARIOS ====================
 
 @app.route('/cuenta/<int:cuenta_id>')
 @login_required
 def ver_cuenta_detalle(cuenta_id):
-    cuentas = cargar_cuentas()
-    cuenta = next((c for c in cuentas if c['id'] == cuenta_id), None)
+    cuenta = obtener_cuenta(cuenta_id)
     
     if not cuenta:
         flash('Cuenta no encontrada', 'error')
         return redirect('/cuentas')
     
     # Verificar permisos: contratistas solo ven sus cuentas
-    user_rol = session['user_rol']
-    user_id = session['user_id']
+    user_rol = g.usuario['rol']
+    user_id = g.usuario['id']
     if user_rol == 'contratista' and cuenta.get('contratista_id') != user_id:
         flash('No tiene permisos para ver esta cuenta', 'error')
         return redirect('/cuentas')
@@ -810,6 +3717,15 @@ def ver_cuenta_detalle(cuenta_id):
         </div>
         """
     
+    # Tiempos por etapa calculados al guardar con las marcas epoch (sin parsear fechas aquí)
+    tiempos_html = ''.join(
+        f'<p><strong>{TITULOS_ESTADO.get(estado, estado)}:</strong> {dias:g} días</p>'
+        for estado, dias in cuenta.get('dias_por_etapa', {}).items()
+    )
+    inicio_etapa = cuenta.get('timestamps_epoch', {}).get(f"inicio_{cuenta['estado_actual']}")
+    if inicio_etapa:
+        tiempos_html += f"<p><strong>En la etapa actual:</strong> {(time.time() - inicio_etapa) / 86400:.2f} días</p>"
+    
     return f'''
     <!DOCTYPE html>
     <html>
@@ -851,6 +3767,13 @@ def ver_cuenta_detalle(cuenta_id):
                 </div>
             </div>
             
+            {f'''
+            <div class="info-section">
+                <h2>⏱️ Tiempo por Etapa</h2>
+                {tiempos_html}
+            </div>
+            ''' if tiempos_html else ''}
+            
             <div class="info-section">
                 <h2>🕒 Historial y Comentarios</h2>
                 {historial_html if historial_html else '<p>No hay historial registrado</p>'}
@@ -860,233 +3783,817 @@ def ver_cuenta_detalle(cuenta_id):
     </html>
     '''
 
-# ==================== DASHBOARD PRINCIPAL ====================
-@app.route('/dashboard')
+@app.route('/cuenta/por-numero/<numero>')
 @login_required
-def dashboard():
-    user_rol = session['user_rol']
-    user_nombre = session['user_nombre']
+def ver_cuenta_por_numero(numero):
+    cuenta = obtener_cuenta_por_numero(numero)
     
-    cuentas = cargar_cuentas()
+    if not cuenta:
+        flash(f'No existe la cuenta {numero}', 'error')
+        return redirect('/cuentas')
     
-    # Filtrar cuentas según el rol
-    if user_rol == 'contratista':
-        mis_cuentas = [c for c in cuentas if c.get('contratista_id') == session['user_id']]
-        cuentas_mostrar = mis_cuentas
-    else:
-        cuentas_mostrar = cuentas
-    
-    # Estadísticas básicas
-    stats = {
-        'total': len(cuentas_mostrar),
-        'radicado': len([c for c in cuentas_mostrar if c['estado_actual'] == 'radicado']),
-        'revision_epb': len([c for c in cuentas_mostrar if c['estado_actual'] == 'revision_epb']),
-        'revision_supervisor': len([c for c in cuentas_mostrar if c['estado_actual'] == 'revision_supervisor']),
-        'revision_general': len([c for c in cuentas_mostrar if c['estado_actual'] == 'revision_general']),
-        'revision_hacienda': len([c for c in cuentas_mostrar if c['estado_actual'] == 'revision_hacienda']),
-        'pagado': len([c for c in cuentas_mostrar if c['estado_actual'] == 'pagado']),
-        'devuelto': len([c for c in cuentas_mostrar if c['estado_actual'] == 'devuelto'])
+    # Los permisos se verifican en la vista de detalle
+    return redirect(f"/cuenta/{cuenta['id']}")
+
+# ==================== EXPORTACIÓN ====================
+COLUMNAS_EXPORTACION = (
+    'numero_cuenta', 'numero_contrato', 'numero_acta', 'contratista_id', 'contratista_nombre', 'valor',
+    'estado_actual', 'fecha_radicacion', 'fecha_pago',
+    'movimiento_fecha', 'movimiento_estado', 'movimiento_accion', 'movimiento_usuario', 'movimiento_comentario'
+)
+EXPORTACION_BLOQUE_BYTES = 64 * 1024
+# Inicios con los que Excel/LibreOffice interpretan una celda de texto como fórmula
+INICIOS_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+def celda_segura(valor):
+    """Antepone ' al texto que una hoja de cálculo ejecutaría como fórmula (descripción,
+    contratista, contrato o acta vienen del usuario)"""
+    if isinstance(valor, str) and valor.startswith(INICIOS_FORMULA):
+        return "'" + valor
+    return valor
+
+def leer_filtros_exportacion(args):
+    """Filtros de /cuentas más ?fecha=pago para acotar desde/hasta a la fecha de pago"""
+    filtros = leer_filtros_cuentas(args)
+    if g.usuario['rol'] == 'contratista':
+        filtros['contratista_id'] = g.usuario['id']
+    rango_pago = None
+    if args.get('fecha') == 'pago':
+        rango_pago = (filtros.pop('desde', None), filtros.pop('hasta', None))
+    return filtros, rango_pago
+
+def filas_exportacion(filtros, rango_pago=None):
+    """Una fila por movimiento del historial, repitiendo los datos de su cuenta; el texto ya
+    viene neutralizado para las hojas de cálculo (CSV y xlsx)"""
+    desde, hasta = rango_pago or (None, None)
+    cuentas = iterar_cuentas(filtros, con_historial=True)
+    if filtros.get('estado') in (None, 'pagado'):
+        cuentas = itertools.chain(cuentas, iterar_archivadas(filtros, desde, hasta))
+    for cuenta in cuentas:
+        timestamps = cuenta.get('timestamps', {})
+        fecha_pago = timestamps.get('pago')
+        if rango_pago and not (fecha_pago and (desde is None or fecha_pago >= desde)
+                               and (hasta is None or fecha_pago <= hasta)):
+            continue
+        datos = (
+            cuenta.get('numero_cuenta'), cuenta.get('numero_contrato'), cuenta.get('numero_acta'),
+            cuenta.get('contratista_id'), cuenta.get('contratista_nombre'), cuenta.get('valor'),
+            cuenta.get('estado_actual'), timestamps.get('radicacion'), fecha_pago
+        )
+        for movimiento in cuenta.get('historial') or [{}]:
+            yield tuple(map(celda_segura, datos + (
+                movimiento.get('timestamp'), movimiento.get('estado'), movimiento.get('accion'),
+                movimiento.get('usuario'), movimiento.get('comentario')
+            )))
+
+def nombre_exportacion(extension):
+    return f'cuentas_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+
+@app.route('/export/cuentas.csv')
+@login_required
+def exportar_cuentas_csv():
+    filtros, rango_pago = leer_filtros_exportacion(request.args)
+    
+    def generar():
+        # El búfer se vacía cada ~64 KB: la memoria no crece con el número de filas
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        buffer.write('\ufeff')  # BOM para que Excel reconozca UTF-8
+        escritor.writerow(COLUMNAS_EXPORTACION)
+        for fila in filas_exportacion(filtros, rango_pago):
+            escritor.writerow(fila)
+            if buffer.tell() >= EXPORTACION_BLOQUE_BYTES:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    return Response(stream_with_context(generar()), mimetype='text/csv; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename={nombre_exportacion("csv")}'})
+
+@app.route('/export/cuentas.xlsx')
+@login_required
+def exportar_cuentas_xlsx():
+    if openpyxl is None:
+        flash('La exportación a Excel requiere openpyxl; use la exportación CSV', 'error')
+        return redirect('/cuentas')
+    filtros, rango_pago = leer_filtros_exportacion(request.args)
+    
+    # El libro en modo write_only escribe las filas a disco a medida que llegan;
+    # luego se envía el archivo por bloques y se borra al terminar
+    libro = openpyxl.Workbook(write_only=True)
+    hoja = libro.create_sheet('Cuentas')
+    hoja.append(COLUMNAS_EXPORTACION)
+    for fila in filas_exportacion(filtros, rango_pago):
+        hoja.append(fila)
+    archivo = tempfile.TemporaryFile()
+    libro.save(archivo)
+    archivo.seek(0)
+    
+    def generar():
+        with archivo:
+            while bloque := archivo.read(EXPORTACION_BLOQUE_BYTES):
+                yield bloque
+    
+    return Response(generar(), mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    headers={'Content-Disposition': f'attachment; filename={nombre_exportacion("xlsx")}'})
+
+# ==================== API JSON ====================
+# Campos que devuelve la API por defecto; ?campos=a,b,c elige un subconjunto de CAMPOS_API
+CAMPOS_API_DEFECTO = (
+    'id', 'numero_cuenta', 'numero_contrato', 'numero_acta', 'contratista_id', 'contratista_nombre',
+    'valor', 'estado_actual', 'responsable_actual', 'responsable_nombre', 'timestamps',
+    'fecha_limite', 'vencida', 'version'
+)
+CAMPOS_API = CAMPOS_API_DEFECTO + ('descripcion', 'dias_por_etapa', 'timestamps_epoch', 'historial')
+
+def leer_campos_api(args, permitidos=CAMPOS_API):
+    if not args.get('campos'):
+        return CAMPOS_API_DEFECTO
+    return tuple(campo for campo in args['campos'].split(',') if campo in permitidos) or CAMPOS_API_DEFECTO
+
+def proyectar_cuenta(cuenta, campos):
+    return {campo: cuenta[campo] for campo in campos if campo in cuenta}
+
+def calcular_etag(*partes):
+    return hashlib.sha1(repr(partes).encode('utf-8')).hexdigest()[:20]
+
+def respuesta_no_modificada(etag):
+    """304 si el cliente ya tiene esta versión (If-None-Match); None en otro caso"""
+    if request.if_none_match.contains_weak(etag):
+        respuesta = Response(status=304)
+        respuesta.set_etag(etag, weak=True)
+        return respuesta
+    return None
+
+def respuesta_json(datos, etag):
+    respuesta = jsonify(datos)
+    respuesta.set_etag(etag, weak=True)
+    respuesta.headers['Cache-Control'] = 'private, no-cache'
+    return respuesta
+
+@app.route('/api/cuentas')
+@api_login_required
+def api_listar_cuentas():
+    """Página de cuentas en JSON con los mismos filtros y orden que /cuentas.
+    La ETag depende de la marca del almacén y de la consulta: si nada cambió se responde
+    304 sin consultar las cuentas."""
+    filtros = leer_filtros_cuentas(request.args)
+    if g.usuario['rol'] == 'contratista':
+        filtros['contratista_id'] = g.usuario['id']
+    
+    etag = calcular_etag(marca_cuentas(), sorted(filtros.items()), sorted(request.args.items(multi=True)))
+    no_modificada = respuesta_no_modificada(etag)
+    if no_modificada:
+        return no_modificada
+    
+    orden = request.args.get('orden') if request.args.get('orden') in CLAVES_ORDEN else 'fecha'
+    descendente = request.args.get('dir', 'desc') != 'asc'
+    tamano = min(max(request.args.get('tam', TAMANO_PAGINA, type=int), 1), TAMANO_PAGINA_MAXIMO)
+    campos = leer_campos_api(request.args, CAMPOS_API_DEFECTO + ('descripcion', 'dias_por_etapa', 'timestamps_epoch'))
+    cuentas, clave_siguiente = consultar_cuentas(filtros, orden, descendente, tamano, decodificar_cursor(request.args.get('cursor'), orden))
+    
+    return respuesta_json({
+        'cuentas': [proyectar_cuenta(cuenta, campos) for cuenta in cuentas],
+        'siguiente': codificar_cursor(clave_siguiente, orden) if clave_siguiente else None
+    }, etag)
+
+@app.route('/api/buscar')
+@api_login_required
+def api_buscar():
+    """Resultados de /buscar en JSON, con el total de coincidencias"""
+    consulta, filtros, pagina = leer_busqueda(request.args)
+    tamano = min(max(request.args.get('tam', TAMANO_PAGINA_BUSQUEDA, type=int), 1), TAMANO_PAGINA_MAXIMO)
+    cuentas, total = buscar_cuentas(consulta, filtros, tamano, (pagina - 1) * tamano) if consulta else ([], 0)
+    campos = leer_campos_api(request.args, CAMPOS_API_DEFECTO + ('descripcion',))
+    return jsonify({'cuentas': [proyectar_cuenta(cuenta, campos) for cuenta in cuentas], 'total': total, 'pagina': pagina})
+
+@app.route('/api/cuentas/<int:cuenta_id>')
+@api_login_required
+def api_ver_cuenta(cuenta_id):
+    """Una cuenta en JSON; la ETag sale de su versión (y de su plazo, que cambia sin versión)"""
+    cuenta = obtener_cuenta(cuenta_id)
+    if not cuenta or (g.usuario['rol'] == 'contratista' and cuenta.get('contratista_id') != g.usuario['id']):
+        return jsonify({'error': 'Cuenta no encontrada'}), 404
+    
+    campos = leer_campos_api(request.args)
+    etag = calcular_etag(cuenta['id'], cuenta.get('version'), cuenta.get('fecha_limite'), cuenta.get('vencida'), campos)
+    return respuesta_no_modificada(etag) or respuesta_json(proyectar_cuenta(cuenta, campos), etag)
+
+# ==================== EVENTOS EN VIVO ====================
+# Cada transición se agrega como una línea JSON a ARCHIVO_EVENTOS, que hace de bus entre los
+# workers de gunicorn: en cada proceso un hilo lector sigue el archivo y reparte las líneas
+# nuevas a las conexiones /eventos abiertas en él, y cada conexión deja pasar solo lo que le
+# interesa a su usuario.
+#
+# Cada conexión ocupa un hilo del worker, así que hay a lo sumo EVENTOS_MAXIMO_POR_WORKER por
+# worker y cada una se cierra tras EVENTOS_DURACION_MAXIMA (el navegador se reconecta con
+# Last-Event-ID y recibe lo que se perdió). Sin cupo se responde 503 y la página consulta
+# /eventos/recientes periódicamente.
+EVENTOS_LATIDO = 15  # segundos sin eventos antes de enviar un comentario que mantiene la conexión
+EVENTOS_REINTENTO_MS = 3000  # espera del navegador antes de reconectarse
+EVENTOS_DURACION_MAXIMA = 300  # segundos que dura una conexión antes de que el navegador la renueve
+EVENTOS_CONSULTA = 30  # segundos entre consultas a /eventos/recientes cuando no hay cupo
+EVENTOS_PENDIENTES_MAXIMO = 100  # eventos en cola por conexión; si el cliente no lee, se descartan
+EVENTOS_RECIENTES = 500  # últimos eventos que cada worker conserva para reconexiones y consultas
+TEXTO_TRANSICION = {'radicacion': 'Radicada', 'aprobacion': 'Aprobada', 'devolucion': 'Devuelta', 'pago': 'Pagada'}
+
+class BusEventos:
+    """Registro de eventos en un archivo compartido por los procesos, con reparto a las colas
+    de los suscriptores del proceso. Al pasar de tamano_maximo el archivo se rota a '.1'.
+    Cada evento lleva un id creciente (nanosegundos, asignado bajo el bloqueo exclusivo)."""
+
+    def __init__(self, ruta, intervalo=0.5, tamano_maximo=1 << 20):
+        self.ruta = ruta
+        self.intervalo = intervalo
+        self.tamano_maximo = tamano_maximo
+        self._reiniciar()
+        # El hilo lector no sobrevive al fork: cada worker arranca el suyo con su primer suscriptor
+        os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        self._lock = threading.Lock()
+        self._suscriptores = set()
+        self._recientes = deque(maxlen=EVENTOS_RECIENTES)
+        self._lector = None
+
+    def publicar(self, eventos):
+        """Agrega los eventos con una sola escritura. El bloqueo exclusivo hace que el orden
+        del archivo sea el de los ids, y rota el archivo si creció demasiado."""
+        if not eventos:
+            return
+        with bloqueo_archivo(f'{self.ruta}.lock'):
+            for i, evento in enumerate(eventos):
+                evento['id'] = time.time_ns() + i
+            datos = b''.join(CODEC_JSON_RAPIDO.codificar(evento) + b'\n' for evento in eventos)
+            with open(self.ruta, 'ab') as f:
+                f.write(datos)
+                tamano = f.tell()
+            if tamano > self.tamano_maximo:
+                os.replace(self.ruta, f'{self.ruta}.1')
+
+    def _iniciar_lector(self):
+        # Con self._lock tomado
+        if self._lector is None:
+            self._lector = threading.Thread(target=self._seguir, name='bus-eventos', daemon=True)
+            self._lector.start()
+
+    def suscribir(self, maximo):
+        """Cola que recibe los eventos publicados por cualquier proceso, o None si el proceso
+        ya tiene `maximo` suscriptores"""
+        with self._lock:
+            if len(self._suscriptores) >= maximo:
+                return None
+            cola = queue.Queue(maxsize=EVENTOS_PENDIENTES_MAXIMO)
+            self._suscriptores.add(cola)
+            self._iniciar_lector()
+            return cola
+
+    def desuscribir(self, cola):
+        with self._lock:
+            self._suscriptores.discard(cola)
+
+    def recientes(self, desde):
+        """Eventos conservados con id mayor que desde, y el id hasta el que se consultó.
+        Sin desde solo se devuelve el punto de partida para la consulta siguiente."""
+        with self._lock:
+            self._iniciar_lector()
+            if desde is None:
+                return [], time.time_ns()
+            eventos = [evento for evento in self._recientes if evento['id'] > desde]
+        return eventos, eventos[-1]['id'] if eventos else desde
+
+    def _seguir(self):
+        """Lee lo que se agrega al archivo desde que arrancó el hilo. Si el archivo se rotó,
+        termina de leer el viejo (ya nadie escribe en él) y sigue el nuevo desde el principio;
+        si entre dos lecturas se rotó dos veces, la generación intermedia se lee de '.1'."""
+        archivo, resto = self._abrir(self.ruta, desde_el_final=True), b''
+        while True:
+            try:
+                if archivo is None:
+                    archivo = self._abrir(self.ruta)
+                if archivo is not None:
+                    resto = self._repartir(resto + archivo.read())
+                    if self._rotado(archivo):
+                        self._repartir(resto + archivo.read())
+                        leido = os.fstat(archivo.fileno()).st_ino
+                        archivo.close()
+                        intermedio = self._abrir(f'{self.ruta}.1')
+                        if intermedio is not None:
+                            with intermedio:
+                                if os.fstat(intermedio.fileno()).st_ino != leido:
+                                    self._repartir(intermedio.read())
+                        archivo, resto = self._abrir(self.ruta), b''
+            except Exception:
+                app.logger.exception('Error leyendo el bus de eventos')
+            time.sleep(self.intervalo)
+
+    def _abrir(self, ruta, desde_el_final=False):
+        try:
+            archivo = open(ruta, 'rb')
+        except FileNotFoundError:
+            return None
+        if desde_el_final:
+            archivo.seek(0, os.SEEK_END)
+        return archivo
+
+    def _rotado(self, archivo):
+        try:
+            return os.stat(self.ruta).st_ino != os.fstat(archivo.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _repartir(self, datos):
+        """Entrega las líneas completas a cada suscriptor; devuelve la línea a medio escribir"""
+        *lineas, resto = datos.split(b'\n')
+        eventos = [CODEC_JSON_RAPIDO.decodificar(linea) for linea in lineas if linea]
+        if eventos:
+            with self._lock:
+                self._recientes.extend(eventos)
+                suscriptores = list(self._suscriptores)
+            for cola in suscriptores:
+                for evento in eventos:
+                    try:
+                        cola.put_nowait(evento)
+                    except queue.Full:
+                        break
+        return resto
+
+bus_eventos = BusEventos(app.config['ARCHIVO_EVENTOS'])
+
+def evento_transicion(accion, cuenta):
+    """Lo que necesita el navegador para avisar y ajustar sus contadores sin recargar"""
+    historial = cuenta.get('historial') or []
+    estado_anterior = historial[-2]['estado'] if accion != 'radicacion' and len(historial) > 1 else None
+    return {
+        'tipo': accion,
+        'cuenta_id': cuenta['id'],
+        'numero_cuenta': cuenta.get('numero_cuenta'),
+        'contratista_id': cuenta.get('contratista_id'),
+        'estado': cuenta['estado_actual'],
+        'estado_anterior': estado_anterior,
+        'responsable_id': cuenta.get('responsable_actual'),
+        'texto': f"{TEXTO_TRANSICION[accion]} · {TITULOS_ESTADO.get(cuenta['estado_actual'], cuenta['estado_actual'])}",
+        'momento': datetime.now().strftime(FORMATO_FECHA)
     }
+
+def publicar_transiciones(accion, cuentas):
+    """Publica un evento por cuenta; si el bus falla la transición ya quedó guardada, así
+    que solo se registra el error"""
+    try:
+        bus_eventos.publicar([evento_transicion(accion, cuenta) for cuenta in cuentas])
+    except OSError:
+        app.logger.exception('No se pudieron publicar los eventos de %s', accion)
+
+def evento_visible(evento, usuario):
+    """El contratista ve sus cuentas; un revisor, las que le asignan y las que entran o salen
+    de los estados de su rol (los que cuenta su dashboard)"""
+    if usuario['rol'] == 'contratista':
+        return evento['contratista_id'] == usuario['id']
+    estados = ROLES_PERMISOS[usuario['rol']]['estados_permitidos']
+    return (evento['responsable_id'] == usuario['id']
+            or evento['estado'] in estados or evento['estado_anterior'] in estados)
+
+def mensaje_evento(evento):
+    return f"id: {evento['id']}\nevent: transicion\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+
+@app.route('/eventos')
+@login_required
+def eventos():
+    """Server-Sent Events con las transiciones visibles para el usuario. En cada latido se
+    verifica que siga activo, como hace cargar_usuario_actual en cada petición. Al reconectarse,
+    el navegador envía Last-Event-ID y se le reenvía lo que se publicó entretanto."""
+    cola = bus_eventos.suscribir(app.config['EVENTOS_MAXIMO_POR_WORKER'])
+    if cola is None:
+        return Response('Sin cupo para más conexiones en vivo\n', status=503, mimetype='text/plain',
+                        headers={'Retry-After': str(EVENTOS_CONSULTA)})
+    usuario = g.usuario
+    ultimo = request.headers.get('Last-Event-ID', type=int)
     
-    # Cuentas asignadas al usuario actual según su rol
-    cuentas_asignadas = []
-    if user_rol == 'epb':
-        cuentas_asignadas = [c for c in cuentas if c['estado_actual'] == 'revision_epb']
-    elif user_rol == 'supervisor':
-        cuentas_asignadas = [c for c in cuentas if c['estado_actual'] == 'revision_supervisor']
-    elif user_rol == 'general':
-        cuentas_asignadas = [c for c in cuentas if c['estado_actual'] == 'revision_general']
-    elif user_rol == 'hacienda':
-        cuentas_asignadas = [c for c in cuentas if c['estado_actual'] == 'revision_hacienda']
-    elif user_rol == 'contratista':
-        cuentas_asignadas = [c for c in cuentas if c.get('contratista_id') == session['user_id'] and c['estado_actual'] == 'devuelto']
-    
-    # Cuentas pendientes de acción (para mostrar en el dashboard)
-    cuentas_pendientes_html = ""
-    if cuentas_asignadas:
-        for cuenta in cuentas_asignadas[:5]:  # Mostrar máximo 5 cuentas
-            estado_color = {
-                'revision_epb': '#17a2b8', 
-                'revision_supervisor': '#fd7e14',
-                'revision_general': '#20c997',
-                'revision_hacienda': '#6f42c1',
-                'devuelto': '#dc3545'
-            }.get(cuenta['estado_actual'], '#6c757d')
-            
-            cuentas_pendientes_html += f"""
-            <div style="background: white; padding: 10px; margin: 5px 0; border-radius: 5px; border-left: 3px solid {estado_color};">
-                <strong>{cuenta['numero_cuenta']}</strong>
-                <div style="font-size: 12px; color: #666;">
-                    {cuenta['contratista_nombre']} - ${cuenta['valor']:,.0f}
-                </div>
-                <a href="/cuentas" style="background: #007bff; color: white; padding: 3px 8px; text-decoration: none; border-radius: 3px; font-size: 11px; display: inline-block; margin-top: 5px;">
-                    Ver detalles
-                </a>
-            </div>
-            """
+    def generar():
+        nonlocal ultimo
+        yield f'retry: {EVENTOS_REINTENTO_MS}\n\n'
+        if ultimo is not None:
+            perdidos, _ = bus_eventos.recientes(ultimo)
+            for evento in perdidos:
+                if evento_visible(evento, usuario):
+                    yield mensaje_evento(evento)
+            ultimo = max([ultimo] + [evento['id'] for evento in perdidos])
+        fin = time.monotonic() + EVENTOS_DURACION_MAXIMA
+        while time.monotonic() < fin:
+            try:
+                evento = cola.get(timeout=min(EVENTOS_LATIDO, max(fin - time.monotonic(), 0.01)))
+            except queue.Empty:
+                vigente = obtener_directorio().obtener(usuario['id'])
+                if not vigente or not vigente.get('activo', True):
+                    return
+                yield ': latido\n\n'
+                continue
+            # Lo ya reenviado tras la reconexión también puede llegar por la cola
+            if ultimo is not None and evento['id'] <= ultimo:
+                continue
+            if evento_visible(evento, usuario):
+                yield mensaje_evento(evento)
     
-    return f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Dashboard - {user_nombre}</title>
-        <style>
-            body {{ font-family: Arial; margin: 0; padding: 20px; background: #f5f5f5; }}
-            .header {{ background: white; padding: 20px; border-radius: 10px; margin-bottom: 20px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            .stats {{ display: grid; grid-template-columns: repeat(auto-fit, minmax(150px, 1fr)); gap: 15px; margin: 20px 0; }}
-            .stat-card {{ background: white; padding: 15px; border-radius: 8px; text-align: center; box-shadow: 0 2px 5px rgba(0,0,0,0.1); }}
-            .stat-number {{ font-size: 24px; font-weight: bold; margin: 10px 0; }}
-            .nav {{ margin: 20px 0; }}
-            .btn {{ background: #007bff; color: white; padding: 10px 15px; text-decoration: none; border-radius: 5px; margin-right: 10px; display: inline-block; }}
-            .pendientes-section {{ background: white; padding: 20px; border-radius: 10px; margin: 20px 0; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>📊 Dashboard - {user_nombre}</h1>
-            <p>Rol: <strong>{user_rol}</strong> | <a href="/logout">Cerrar sesión</a></p>
-        </div>
+    respuesta = Response(stream_with_context(generar()), mimetype='text/event-stream',
+                         headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # call_on_close también se ejecuta si el cliente se desconecta antes de la primera línea
+    respuesta.call_on_close(lambda: bus_eventos.desuscribir(cola))
+    return respuesta
 
-        <div class="nav">
-            <a href="/cuentas" class="btn">📋 Ver Cuentas</a>
-            {'<a href="/radicar" class="btn">📝 Radicar Cuenta</a>' if user_rol == 'contratista' else ''}
-            <a href="/usuarios" class="btn">👥 Usuarios</a>
-        </div>
+@app.route('/eventos/recientes')
+@login_required
+def eventos_recientes():
+    """Alternativa por consulta periódica cuando /eventos no tiene cupo"""
+    eventos, ultimo = bus_eventos.recientes(request.args.get('desde', type=int))
+    return jsonify({'eventos': [evento for evento in eventos if evento_visible(evento, g.usuario)], 'ultimo': ultimo})
 
-        {f'''
-        <div class="pendientes-section">
-            <h2>📌 Cuentas Pendientes de Mi Revisión</h2>
-            <div class="stats">
-                <div class="stat-card">
-                    <div>Pendientes</div>
-                    <div class="stat-number">{len(cuentas_asignadas)}</div>
-                </div>
-            </div>
-            {cuentas_pendientes_html if cuentas_pendientes_html else '<p>No tienes cuentas pendientes de revisión</p>'}
-            {f'<p><a href="/cuentas" class="btn">Ver todas las cuentas pendientes</a></p>' if cuentas_asignadas else ''}
-        </div>
-        ''' if user_rol != 'contratista' else ''}
-
-        {f'''
-        <div class="pendientes-section">
-            <h2>📌 Cuentas Devueltas para Corrección</h2>
-            <div class="stats">
-                <div class="stat-card">
-                    <div>Devueltas</div>
-                    <div class="stat-number">{len(cuentas_asignadas)}</div>
-                </div>
-            </div>
-            {cuentas_pendientes_html if cuentas_pendientes_html else '<p>No tienes cuentas devueltas</p>'}
-            {f'<p><a href="/cuentas" class="btn">Ver cuentas devueltas</a></p>' if cuentas_asignadas else ''}
-        </div>
-        ''' if user_rol == 'contratista' and cuentas_asignadas else ''}
+# ==================== MÉTRICAS HTTP ====================
+@app.before_request
+def iniciar_cronometro_peticion():
+    metricas.activar()
+    g.inicio_peticion = time.perf_counter()
 
-        <h2>📈 Resumen de Cuentas</h2>
-        <div class="stats">
-            <div class="stat-card">
-                <div>Total</div>
-                <div class="stat-number">{stats['total']}</div>
-            </div>
-            <div class="stat-card">
-                <div>Radicado</div>
-                <div class="stat-number">{stats['radicado']}</div>
-            </div>
-            <div class="stat-card">
-                <div>Revisión EPB</div>
-                <div class="stat-number">{stats['revision_epb']}</div>
-            </div>
-            <div class="stat-card">
-                <div>Revisión Supervisor</div>
-                <div class="stat-number">{stats['revision_supervisor']}</div>
-            </div>
-            <div class="stat-card">
-                <div>Revisión General</div>
-                <div class="stat-number">{stats['revision_general']}</div>
-            </div>
-            <div class="stat-card">
-                <div>Revisión Hacienda</div>
-                <div class="stat-number">{stats['revision_hacienda']}</div>
-            </div>
-            <div class="stat-card">
-                <div>Pagado</div>
-                <div class="stat-number">{stats['pagado']}</div>
-            </div>
-            <div class="stat-card">
-                <div>Devuelto</div>
-                <div class="stat-number">{stats['devuelto']}</div>
-            </div>
-        </div>
-    </body>
-    </html>
-    '''
+@app.after_request
+def registrar_metricas_peticion(respuesta):
+    """Cuenta la petición por ruta (el patrón, no la URL) y registra su duración. Se registra
+    antes que la compresión, así que se ejecuta después e incluye su costo; las respuestas en
+    streaming se miden al cerrarse, cuando ya se generó todo el cuerpo. Las conexiones de
+    /eventos (text/event-stream) duran minutos: solo se cuentan, sin entrar al histograma."""
+    inicio = g.get('inicio_peticion')
+    if inicio is None:
+        return respuesta
+    ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+    metodo, estado = request.method, str(respuesta.status_code)
+    if respuesta.mimetype == 'text/event-stream':
+        metricas.incrementar('seguimiento_peticiones_total', ruta=ruta, metodo=metodo, estado=estado)
+        return respuesta
+    
+    def registrar():
+        metricas.observar('seguimiento_peticion_segundos', time.perf_counter() - inicio, ruta=ruta, metodo=metodo)
+        metricas.incrementar('seguimiento_peticiones_total', ruta=ruta, metodo=metodo, estado=estado)
+    
+    if respuesta.is_streamed:
+        respuesta.call_on_close(registrar)
+    else:
+        registrar()
+    return respuesta
+
+@app.route('/metrics')
+def exponer_metricas():
+    token = app.config['METRICAS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('No autorizado\n', status=401, mimetype='text/plain')
+    return Response(metricas.exponer(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# ==================== PERFILADO DE PETICIONES ====================
+# Un usuario incluido en PERFILADO_USUARIOS puede perfilar una petición con ?perfilar=<modo> o con
+# la cabecera X-Perfilar: <modo>. 'pstats' usa cProfile (determinista; se abre con
+# python -m pstats o snakeviz) y 'muestreo' toma la pila del hilo cada pocos milisegundos
+# y la guarda en formato colapsado (flamegraph.pl, speedscope). La cabecera X-Perfil de la
+# respuesta trae el nombre del archivo, que se descarga desde /sistema/perfiles/<nombre>.
+# Sin la marca el costo es una búsqueda en los argumentos y las cabeceras.
+#
+# cProfile no se limita a un hilo: desde Python 3.12 usa sys.monitoring y registra todos los
+# hilos del proceso. Con workers de hilos (gthread, wsgi.multithread) el .pstats mezclaría
+# las peticiones concurrentes y todas pagarían el costo, así que ahí 'pstats' se atiende con
+# el muestreo, que solo sigue al hilo de la petición. 'pstats' queda para workers sync.
+PERFILADO_MUESTREO_SEGUNDOS = 0.005
+
+class PerfilDeterminista:
+    extension = 'pstats'
+
+    def __init__(self):
+        self.perfil = cProfile.Profile()
+
+    def iniciar(self):
+        self.perfil.enable()  # ValueError si ya hay otro perfilador activo (Python 3.12+)
+
+    def detener(self):
+        self.perfil.disable()
+
+    def guardar(self, ruta):
+        self.perfil.dump_stats(ruta)
+
+class PerfilMuestreo:
+    """Muestrea desde otro hilo la pila del hilo que atiende la petición"""
+    extension = 'collapsed'
+
+    def __init__(self, intervalo=PERFILADO_MUESTREO_SEGUNDOS):
+        self.intervalo = intervalo
+        self.hilo_id = threading.get_ident()
+        self.pilas = Counter()
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ciclo, name='perfil-muestreo', daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join()
+
+    def _ciclo(self):
+        while not self._detener.wait(self.intervalo):
+            marco = sys._current_frames().get(self.hilo_id)
+            pila = []
+            while marco is not None:
+                pila.append(f'{os.path.basename(marco.f_code.co_filename)}:{marco.f_code.co_qualname}')
+                marco = marco.f_back
+            if pila:
+                self.pilas[';'.join(reversed(pila))] += 1
+
+    def guardar(self, ruta):
+        with open(ruta, 'w', encoding='utf-8') as f:
+            f.writelines(f'{pila} {muestras}\n' for pila, muestras in self.pilas.most_common())
+
+MODOS_PERFILADO = {'pstats': PerfilDeterminista, 'muestreo': PerfilMuestreo}
+_ultimo_perfil = {'momento': float('-inf')}
+_ultimo_perfil_lock = threading.Lock()
+
+def turno_perfilado():
+    """Limita los perfiles a uno cada PERFILADO_INTERVALO segundos por worker"""
+    intervalo = app.config['PERFILADO_INTERVALO']
+    if intervalo <= 0:
+        return False
+    with _ultimo_perfil_lock:
+        ahora = time.monotonic()
+        if ahora - _ultimo_perfil['momento'] < intervalo:
+            return False
+        _ultimo_perfil['momento'] = ahora
+        return True
+
+def puede_perfilar():
+    """Los perfiles exponen código y datos de otras peticiones: solo los usuarios nombrados en
+    PERFILADO_USUARIOS, no un permiso de rol, que tienen todos los revisores"""
+    usuarios = {nombre.strip() for nombre in app.config['PERFILADO_USUARIOS'].split(',') if nombre.strip()}
+    return g.get('usuario') is not None and g.usuario['username'] in usuarios
+
+def perfilado_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not puede_perfilar():
+            flash('No tiene permiso para ver los perfiles', 'error')
+            return redirect('/dashboard')
+        return f(*args, **kwargs)
+    return decorated_function
+
+def podar_perfiles(directorio, maximo):
+    """Borra los perfiles más antiguos por encima de PERFILADO_MAXIMO"""
+    rutas = sorted((os.path.join(directorio, nombre) for nombre in os.listdir(directorio)), key=os.path.getmtime)
+    for ruta in rutas[:max(0, len(rutas) - maximo)]:
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass  # otro worker ya lo borró
+
+@app.before_request
+def iniciar_perfilado():
+    modo = request.args.get('perfilar') or request.headers.get('X-Perfilar')
+    if not modo:
+        return
+    if modo not in MODOS_PERFILADO or not puede_perfilar():
+        return
+    if not turno_perfilado():
+        return
+    if modo == 'pstats' and request.environ.get('wsgi.multithread'):
+        modo = 'muestreo'
+    perfil = MODOS_PERFILADO[modo]()
+    try:
+        perfil.iniciar()
+    except ValueError:
+        return
+    ruta = request.url_rule.rule if request.url_rule else request.path
+    ruta = ''.join(c if c.isalnum() else '_' for c in ruta).strip('_') or 'raiz'
+    g.perfil = perfil
+    g.perfil_nombre = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{ruta}.{perfil.extension}"
+
+@app.after_request
+def terminar_perfilado(respuesta):
+    """Guarda el perfil; en las respuestas en streaming, al cerrarse, para incluir la
+    generación del cuerpo"""
+    perfil = g.pop('perfil', None)
+    if perfil is None:
+        return respuesta
+    nombre = g.perfil_nombre
+    respuesta.headers['X-Perfil'] = nombre
+    
+    def terminar():
+        perfil.detener()
+        directorio = app.config['PERFILADO_DIRECTORIO']
+        os.makedirs(directorio, exist_ok=True)
+        perfil.guardar(os.path.join(directorio, nombre))
+        podar_perfiles(directorio, app.config['PERFILADO_MAXIMO'])
+    
+    if respuesta.is_streamed:
+        respuesta.call_on_close(terminar)
+    else:
+        terminar()
+    return respuesta
+
+@app.route('/sistema/perfiles')
+@login_required
+@perfilado_required
+def listar_perfiles():
+    directorio = app.config['PERFILADO_DIRECTORIO']
+    nombres = sorted(os.listdir(directorio), reverse=True) if os.path.isdir(directorio) else []
+    return jsonify([
+        {'nombre': nombre, 'bytes': os.path.getsize(os.path.join(directorio, nombre)), 'url': f'/sistema/perfiles/{nombre}'}
+        for nombre in nombres
+    ])
+
+@app.route('/sistema/perfiles/<nombre>')
+@login_required
+@perfilado_required
+def descargar_perfil(nombre):
+    return send_from_directory(os.path.abspath(app.config['PERFILADO_DIRECTORIO']), nombre, as_attachment=True)
+
+# ==================== COMPRESIÓN DE RESPUESTAS ====================
+COMPRESION_TAMANO_MINIMO = 500
+COMPRESION_TIPOS = ('application/json', 'text/html', 'text/csv')
+
+@app.after_request
+def comprimir_respuesta(respuesta):
+    """gzip para respuestas completas de texto/JSON; las transmitidas por partes se envían tal cual"""
+    if (
+        respuesta.status_code != 200
+        or respuesta.is_streamed
+        or respuesta.direct_passthrough
+        or 'Content-Encoding' in respuesta.headers
+        or respuesta.mimetype not in COMPRESION_TIPOS
+        or 'gzip' not in request.headers.get('Accept-Encoding', '')
+    ):
+        return respuesta
+    datos = respuesta.get_data()
+    if len(datos) < COMPRESION_TAMANO_MINIMO:
+        return respuesta
+    respuesta.set_data(gzip.compress(datos, compresslevel=6))
+    respuesta.headers['Content-Encoding'] = 'gzip'
+    respuesta.vary.add('Accept-Encoding')
+    return respuesta
+
+# ==================== DASHBOARD PRINCIPAL ====================
+@app.route('/dashboard')
+@login_required
+def dashboard():
+    user_rol = g.usuario['rol']
+    user_nombre = g.usuario['nombre']
+    
+    # Estadísticas básicas (contadores materializados: no se recorren las cuentas)
+    contratista_id = g.usuario['id'] if user_rol == 'contratista' else None
+    stats = conteo_estados(contratista_id)
+    stats['total'] = sum(stats.values())
+    
+    # Cuentas asignadas al usuario actual según su rol
+    estado_asignado = {
+        'epb': 'revision_epb',
+        'supervisor': 'revision_supervisor',
+        'general': 'revision_general',
+        'hacienda': 'revision_hacienda',
+        'contratista': 'devuelto'
+    }.get(user_rol)
+    total_asignadas = stats.get(estado_asignado, 0)
+    cuentas_asignadas = []
+    if total_asignadas:
+        # Mostrar máximo 5 cuentas
+        cuentas_asignadas = filtrar_cuentas(estado=estado_asignado, contratista_id=contratista_id, con_historial=False, limite=5)
+    
+    # Contadores que /eventos mantiene exactos: solo llegan las transiciones que entran o salen
+    # de los estados del rol (el contratista recibe todas las de sus cuentas). Toda cuenta nueva
+    # entra en revision_epb, así que el total solo se sigue si ese estado está cubierto.
+    if user_rol == 'contratista':
+        estados_en_vivo = set(ESTADOS_FLUJO)
+    else:
+        estados_en_vivo = set(ROLES_PERMISOS[user_rol]['estados_permitidos'])
+    if 'revision_epb' in estados_en_vivo:
+        estados_en_vivo.add('total')
+    
+    return stream_template(
+        'dashboard.html',
+        user_nombre=user_nombre,
+        user_rol=user_rol,
+        stats=stats,
+        estado_asignado=estado_asignado,
+        estados_en_vivo=estados_en_vivo,
+        total_asignadas=total_asignadas,
+        cuentas_asignadas=cuentas_asignadas
+    )
 
 # ==================== GESTIÓN DE USUARIOS ====================
 @app.route('/usuarios')
 @login_required
 @permiso_required('ver_todas')
 def listar_usuarios():
-    usuarios = cargar_usuarios()
-    
-    usuarios_html = ""
-    for usuario in usuarios:
-        rol_color = {
-            'contratista': '#6c757d',
-            'epb': '#007bff',
-            'supervisor': '#fd7e14',
-            'general': '#20c997',
-            'hacienda': '#6f42c1'
-        }.get(usuario['rol'], '#000')
-        
-        usuarios_html += f"""
-        <div style="background: white; padding: 15px; margin: 10px 0; border-radius: 8px; border-left: 4px solid {rol_color}; box-shadow: 0 2px 5px rgba(0,0,0,0.1);">
-            <h3 style="margin: 0 0 5px 0;">{usuario['nombre']}</h3>
-            <p style="margin: 2px 0;"><strong>Usuario:</strong> {usuario['username']}</p>
-            <p style="margin: 2px 0;"><strong>Rol:</strong> 
-                <span style="background: {rol_color}; color: white; padding: 2px 8px; border-radius: 12px; font-size: 12px;">
-                    {usuario['rol']}
-                </span>
-            </p>
-            <p style="margin: 2px 0;"><strong>Dependencia:</strong> {usuario.get('dependencia', 'No especificada')}</p>
-            <p style="margin: 2px 0; font-size: 12px; color: #888;">Creado: {usuario['fecha_creacion']}</p>
-        </div>
-        """
-    
-    return f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Usuarios del Sistema</title>
-        <style>
-            body {{ font-family: Arial; margin: 0; padding: 20px; background: #f5f5f5; }}
-            .header {{ background: white; padding: 20px; border-radius: 10px; margin-bottom: 20px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            .btn {{ background: #007bff; color: white; padding: 10px 15px; text-decoration: none; border-radius: 5px; margin-right: 10px; display: inline-block; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>👥 Usuarios del Sistema</h1>
-            <div>
-                <a href="/dashboard" class="btn">← Dashboard</a>
-                <a href="/crear-usuario" class="btn" style="background: #28a745;">➕ Crear Usuario</a>
-            </div>
-        </div>
-        
-        {usuarios_html if usuarios_html else '<div style="background: white; padding: 30px; text-align: center; border-radius: 8px;"><p>No hay usuarios registrados</p></div>'}
-    </body>
-    </html>
-    '''
+    return stream_template('usuarios.html', usuarios=cargar_usuarios())
+
+# ==================== ESTADO DEL SISTEMA ====================
+@app.route('/sistema/cache')
+@login_required
+@permiso_required('ver_todas')
+def estado_cache():
+    return jsonify(obtener_almacen().estadisticas())
+
+@app.cli.command('compactar-cuentas')
+def compactar_cuentas_comando():
+    """Vuelca el diario de cambios en cuentas.json (con el formato de CODEC_CUENTAS)"""
+    obtener_almacen().compactar()
+    print(f"✅ Diario compactado ({len(cargar_cuentas())} cuentas)")
+
+@app.cli.command('migrar-sqlite')
+@click.option('--destino', default=None, help='Archivo SQLite (por defecto ALMACEN_SQLITE)')
+@click.option('--forzar', is_flag=True, help='Reemplazar los datos si la base ya tiene cuentas')
+def migrar_sqlite_comando(destino, forzar):
+    """Copia cuentas.json (más su diario) y usuarios.json a SQLite"""
+    destino = destino or app.config['ALMACEN_SQLITE']
+    if not forzar and os.path.exists(destino) and AlmacenSQLite(destino).contar_cuentas():
+        raise click.ClickException(f'{destino} ya contiene cuentas; use --forzar para reemplazarlas')
+    total_cuentas, total_usuarios = migrar_json_a_sqlite(destino, ruta_archivo=app.config['ARCHIVO_CUENTAS'])
+    print(f"✅ Migradas {total_cuentas} cuentas y {total_usuarios} usuarios a {destino}")
+    print("   Active el backend con ALMACEN_BACKEND=sqlite")
+
+@app.cli.command('reconstruir-contadores')
+def reconstruir_contadores_comando():
+    """Recalcula desde cero los contadores por estado y por responsable y reporta diferencias"""
+    diferencias = obtener_almacen().reconstruir_contadores()
+    if not diferencias:
+        print("✅ Los contadores mantenidos coinciden con el recálculo")
+        return
+    for nombre, claves in diferencias.items():
+        for clave, (mantenido, recalculado) in sorted(claves.items(), key=str):
+            print(f"⚠️ {nombre} {clave}: mantenido={mantenido} recalculado={recalculado}")
+    print("✅ Contadores reconstruidos")
+
+@app.cli.command('migrar-esquema')
+def migrar_esquema_comando():
+    """Reescribe las cuentas guardadas con el esquema actual (marcas de tiempo en epoch)"""
+    total = obtener_almacen().migrar_esquema()
+    print(f"✅ {total} cuentas en el esquema {VERSION_ESQUEMA_CUENTAS}")
+
+@app.cli.command('importar-cuentas')
+@click.argument('archivo', type=click.File('rb'))
+@click.option('--contratista', 'contratista_id', type=int, required=True, help='Id del contratista que radica')
+@click.option('--formato', type=click.Choice(['csv', 'jsonl']), default=None, help='Por defecto según la extensión')
+def importar_cuentas_comando(archivo, contratista_id, formato):
+    """Radica en lote las cuentas de un CSV o JSONL (numero_contrato, numero_acta, valor, descripcion)"""
+    contratista = obtener_directorio().obtener(contratista_id)
+    if not contratista or contratista.get('rol') != 'contratista':
+        raise click.ClickException(f'No existe un contratista con id {contratista_id}')
+    formato = formato or formato_importacion(archivo.name)
+    try:
+        nuevas, errores = importar_cuentas(leer_filas_importacion(archivo, formato), contratista)
+    except (ValueError, csv.Error, UnicodeDecodeError) as e:
+        raise click.ClickException(str(e))
+    for numero, motivo in errores:
+        print(f"⚠️ Línea {numero}: {motivo}")
+    print(f"✅ {len(nuevas)} cuentas radicadas, {len(errores)} filas rechazadas")
+
+@app.cli.command('archivar-cuentas')
+@click.option('--dias', type=int, default=None, help='Días desde el pago (por defecto DIAS_PARA_ARCHIVAR)')
+def archivar_cuentas_comando(dias):
+    """Mueve las cuentas pagadas hace más de N días al archivo por meses de pago"""
+    dias = app.config['DIAS_PARA_ARCHIVAR'] if dias is None else dias
+    limite = (datetime.now() - timedelta(days=dias)).strftime(FORMATO_FECHA)
+    total = obtener_almacen().archivar(limite)
+    print(f"✅ {total} cuentas pagadas antes del {limite[:10]} archivadas en {app.config['ARCHIVO_CUENTAS']}")
+
+@app.cli.command('enviar-notificaciones')
+def enviar_notificaciones_comando():
+    """Envía ya las notificaciones pendientes, sin esperar al hilo de fondo"""
+    if not app.config['SMTP_SERVIDOR']:
+        raise click.ClickException('Defina SMTP_SERVIDOR para enviar notificaciones')
+    total_enviadas = total_fallidas = 0
+    while True:
+        enviadas, fallidas = enviar_notificaciones()
+        if not enviadas and not fallidas:
+            break
+        total_enviadas += enviadas
+        total_fallidas += fallidas
+    print(f"✅ {total_enviadas} notificaciones enviadas, {total_fallidas} reprogramadas")
+
+@app.cli.command('limpiar-metricas')
+def limpiar_metricas_comando():
+    """Borra los volcados de métricas de workers anteriores (ejecutar antes de arrancar gunicorn)"""
+    metricas.limpiar()
+    print(f"✅ Métricas reiniciadas en {app.config['DIRECTORIO_METRICAS']}")
+
+@app.cli.command('recalcular-plazos')
+def recalcular_plazos_comando():
+    """Recalcula los plazos de revisión con el calendario de días hábiles vigente"""
+    cambiadas = obtener_almacen().recalcular_plazos(datetime.now().strftime(FORMATO_FECHA))
+    print(f"✅ Plazos recalculados ({cambiadas} cuentas cambiaron)")
 
 # ==================== FUNCIÓN DE INICIALIZACIÓN ====================
 def inicializar_sistema():
     """Crear algunos usuarios de ejemplo si no existen"""
+    precompilar_plantillas()
     usuarios = cargar_usuarios()
     if not usuarios:
         usuarios_ejemplo = [
-            {'id': 1, 'username': 'admin_epb', 'password': '123', 'rol': 'epb', 'nombre': 'Administrador EPB', 'dependencia': 'EPB', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
-            {'id': 2, 'username': 'contratista1', 'password': '123', 'rol': 'contratista', 'nombre': 'Empresa Constructora S.A.', 'dependencia': '', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
-            {'id': 3, 'username': 'supervisor1', 'password': '123', 'rol': 'supervisor', 'nombre': 'Supervisor Calidad', 'dependencia': 'Calidad', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
-            {'id': 4, 'username': 'general1', 'password': '123', 'rol': 'general', 'nombre': 'Secretaría General', 'dependencia': 'Secretaría General', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
-            {'id': 5, 'username': 'hacienda1', 'password': '123', 'rol': 'hacienda', 'nombre': 'Departamento Hacienda', 'dependencia': 'Hacienda', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+            {'id': 1, 'username': 'admin_epb', 'password': cifrar_password('123'), 'rol': 'epb', 'nombre': 'Administrador EPB', 'dependencia': 'EPB', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+            {'id': 2, 'username': 'contratista1', 'password': cifrar_password('123'), 'rol': 'contratista', 'nombre': 'Empresa Constructora S.A.', 'dependencia': '', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+            {'id': 3, 'username': 'supervisor1', 'password': cifrar_password('123'), 'rol': 'supervisor', 'nombre': 'Supervisor Calidad', 'dependencia': 'Calidad', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+            {'id': 4, 'username': 'general1', 'password': cifrar_password('123'), 'rol': 'general', 'nombre': 'Secretaría General', 'dependencia': 'Secretaría General', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+            {'id': 5, 'username': 'hacienda1', 'password': cifrar_password('123'), 'rol': 'hacienda', 'nombre': 'Departamento Hacienda', 'dependencia': 'Hacienda', 'activo': True, 'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
             
         ]
         guardar_usuarios(usuarios_ejemplo)